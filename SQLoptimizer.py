@@ -1,4 +1,11 @@
+import bisect
 import fnmatch # Quick hack to enable wildcards
+import io
+import re
+import weakref
+from collections import Counter
+
+import profiling
 
 ASSIGN = "="
 RENAME = "rho"
@@ -44,6 +51,9 @@ for boolean in BOOLEAN:
     canonical_select_stmt[boolean] = (BOOL_EXPR, BOOL_EXPR)
 
 class TreeNode:
+    # No __dict__ per node: large expressions have hundreds of thousands of nodes
+    __slots__ = ("node_type", "children", "parent", "parent_index")
+
     def __init__(self, node_type, children):
         self.node_type = node_type
         self.children = children
@@ -83,8 +93,10 @@ class TreeNode:
         child.set_parent(self, n)
 
 class ConstNode(TreeNode):
+    __slots__ = ("value",)
+
     def __init__(self, value):
-        TreeNode.__init__(self, CONSTANT, [])
+        TreeNode.__init__(self, CONSTANT, ())   # Leaves share the empty tuple
         self.value = value
     def show(self):
         print(self.node_type)
@@ -94,6 +106,90 @@ class ConstNode(TreeNode):
     def clone(self):
         return ConstNode(self.value)
 
+class PersistentNode:
+    """An immutable node. Nodes are hash-consed: make_persistent_node returns the existing
+       node for the same type, children and value, so equal subtrees are shared (and can
+       be compared with is). Nodes have no parent; a rewrite returns a new root that
+       copies the path to the changed node and shares everything else."""
+
+    __slots__ = ("node_type", "children", "value", "__weakref__")
+
+    def get_nodetype(self):
+        return self.node_type
+    def get_children(self):
+        return self.children
+    def get_value(self):
+        return self.value
+    def set_child(self, n, child):
+        children = list(self.children)
+        children[n] = child
+        return make_persistent_node(self.node_type, children, self.value)
+    def clone(self):
+        return self
+    def show(self):
+        print(self.node_type)
+        if self.node_type == CONSTANT:
+            print(self.value)
+            return
+        print("{")
+        for child in self.children:
+            if child:
+                child.show()
+            else:
+                print("None")
+            print(",")
+        print("}")
+
+persistent_nodes = weakref.WeakValueDictionary()
+
+def make_persistent_node(node_type, children = (), value = None):
+    if isinstance(value, (list, set)):
+        value = tuple(value)
+    children = tuple(children)
+    key = (node_type, tuple(id(child) for child in children), value)
+    node = persistent_nodes.get(key)
+    if node is None:
+        node = PersistentNode()
+        node.node_type = node_type
+        node.children = children
+        node.value = value
+        persistent_nodes[key] = node
+    return node
+
+def make_persistent(expr):
+    """The persistent version of a TreeNode tree"""
+
+    results = { id(None): None }
+    stack = [ (expr, False) ]
+    while stack:
+        (node, is_visited) = stack.pop()
+        if node is None:
+            continue
+        if is_visited:
+            children = [ results[id(child)] for child in node.get_children() ]
+            value = node.get_value() if node.get_nodetype() == CONSTANT else None
+            results[id(node)] = make_persistent_node(node.get_nodetype(), children, value)
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.get_children())
+    return results[id(expr)]
+
+def get_path_nodes(expr, path):
+    """The nodes from expr down along path (a list of child indexes)"""
+
+    nodes = [ expr ]
+    for n in path:
+        nodes.append(nodes[-1].get_children()[n])
+    return nodes
+
+def replace_path(expr, path, node):
+    """Returns expr with the node at path replaced, copying only the nodes on path"""
+
+    nodes = get_path_nodes(expr, path)
+    for level in range(len(path) - 1, -1, -1):
+        node = nodes[level].set_child(path[level], node)
+    return node
+
 def test_treenode_init():
     X_expr = ConstNode("X")
     RHOX_expr = TreeNode(RENAME_ALL, [X_expr, X_expr])
@@ -122,11 +218,46 @@ def test_treenode_init():
     equals_expr.show()
     return equals_expr
 
+def make_rename_chain(values, node_class = TreeNode, const_class = ConstNode):
+    """B = rho(values[0])(...rho(values[-1])(X)), built with the given node classes"""
+
+    def make_node(node_type, children):
+        node = TreeNode.__new__(node_class)
+        TreeNode.__init__(node, node_type, children)
+        return node
+
+    expr = make_node(INPUT1, [ const_class("X") ])
+    for value in reversed(values):
+        expr = make_node(RENAME, [ const_class(value), expr ])
+    return make_node(ASSIGN, [ const_class("B"), expr ])
+
+def test_tree_memory(n = 100000):
+    import tracemalloc
+
+    class DictTreeNode(TreeNode):   # With a __dict__, as before __slots__
+        pass
+    class DictConstNode(ConstNode):
+        pass
+
+    values = [ [f"c{i + 1}", f"c{i}"] for i in range(n) ]
+    sizes = []
+    for (node_class, const_class) in [ (DictTreeNode, DictConstNode), (TreeNode, ConstNode) ]:
+        tracemalloc.start()
+        expr = make_rename_chain(values, node_class, const_class)
+        sizes.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+        print(f"{node_class.__name__}: {sizes[-1] / (2 * n + 4):.0f} bytes per node")
+        del expr
+    print(f"{1 - sizes[1] / sizes[0]:.0%} less memory") # The values are shared, and not counted
+
 def find_deviation_node(expr, expr_format, expected_types):
     """Finds the first node in expr that has a type that is not expected based on expr_format.
        When calling find_deviation_node, expected_types must be assigned the expected type
        for the root node."""
 
+    if profiling.n_active:
+        profiling.count("find_deviation_node_visits")
+
     if expr.get_nodetype() not in expected_types:
         return expr
     children = expr.get_children()
@@ -137,6 +268,36 @@ def find_deviation_node(expr, expr_format, expected_types):
             return result 
     return None
 
+def find_deviation_nodes(expr, expr_format, expected_types):
+    """Finds all nodes in expr that have a type that is not expected based on expr_format,
+       in the same (depth first) order in which find_deviation_node would find them.
+       Unlike find_deviation_node, the subtrees of deviating nodes are searched as well."""
+
+    if profiling.n_active:
+        profiling.count("find_deviation_nodes")
+
+    result = []
+    stack = [(expr, expected_types)]
+    while stack:
+        (node, node_types) = stack.pop()
+        if node.get_nodetype() not in node_types:
+            result.append(node)
+        children = node.get_children()
+        if children:
+            node_format = expr_format[node.get_nodetype()]
+            for n in range(len(children) - 1, -1, -1):
+                stack.append((children[n], node_format[n]))
+    return result
+
+def is_deviation_node(node, expr_format):
+    """Checks a single node against the format of its parent"""
+
+    if profiling.n_active:
+        profiling.count("is_deviation_node")
+
+    (parent, index) = node.get_parent()
+    return node.get_nodetype() not in expr_format[parent.get_nodetype()][index]
+
 def validate_expression_format(expr, expr_format, expected_types):
 
     return find_deviation_node(expr, expr_format, expected_types) is None
@@ -203,9 +364,10 @@ def get_skip_nodes(expr, nodetype):
     nextnode = expr
     return (typenodes, nextnode)
 
-def gen_columns_stmt(expr):
+def write_columns_stmt(expr, out):
     if not expr:
-        return "*"
+        out.write("*")
+        return
 
     (rename_columns, expr) = get_skip_nodes(expr, RENAME)        
     (extra_columns, expr) = get_skip_nodes(expr, EXTRA_COLUMN)
@@ -215,88 +377,184 @@ def gen_columns_stmt(expr):
         projection_expr = None
 
     if not projection_expr:
-        return "*"
-    columns = {}
+        out.write("*")
+        return
 
     columns = [ [ colname, None ] for colname in projection_expr.get_children()[0].get_value() ] 
     for extra_column in extra_columns:
         columns.append([extra_column[1], extra_column[0]])
+    # Each rename applies to the first column that has its old name at that point
+    positions = {}   # current column name -> sorted indexes of the columns with that name
+    for n, column in enumerate(columns):
+        positions.setdefault(column[1] or column[0], []).append(n)
     for rename_column in rename_columns:
-        for column in columns:
-            colname = column[1] or column[0]
-            if colname == rename_column[1]:
-                column[1] = rename_column[0]
-                break
+        indexes = positions.get(rename_column[1])
+        if indexes:
+            n = indexes.pop(0)
+            columns[n][1] = rename_column[0]
+            bisect.insort(positions.setdefault(columns[n][1] or columns[n][0], []), n)
 
-    stmt = ""
+    is_empty = True
     for column in columns:
-        if stmt:
-            stmt += ", "
-        stmt += column[0]
+        if not is_empty:
+            out.write(", ")
+        out.write(column[0])
         if column[1]:
-            stmt += " AS " + column[1]
-    
-    return stmt
+            out.write(" AS ")
+            out.write(column[1])
+        is_empty = is_empty and not (column[0] or column[1])
+
+def gen_columns_stmt(expr):
+
+    out = io.StringIO()
+    write_columns_stmt(expr, out)
+    return out.getvalue()
 
 def gen_into_stmt(expr):
 
     return "INTO " + expr.get_value()
 
-def gen_from_stmt(expr):
+def write_from_stmt(expr, out):
 
-    stmt = ""
+    out.write("FROM ")
+    is_empty = True
     names_expr = expr.get_children()
     for name_expr in names_expr:
         if name_expr.get_nodetype() == CONSTANT:
             name = name_expr.get_value()
         else:
             name = name_expr.get_children()[1].get_value()
-        if stmt:
-            stmt += " JOIN "
-        stmt += name
+        if not is_empty:
+            out.write(" JOIN ")
+        out.write(name)
+        is_empty = is_empty and not name
+
+def gen_from_stmt(expr):
 
-    return "FROM " + stmt
+    out = io.StringIO()
+    write_from_stmt(expr, out)
+    return out.getvalue()
+
+sql_operators = {
+    OR: " OR ",
+    AND: " AND ",
+    EQUALS: " = ",
+    NOT_EQUAL: " <> ",
+    SMALLER: " < ",
+    BIGGER: " > ",
+    SMALLER_EQUAL: " <= ",
+    BIGGER_EQUAL: " >= "
+}
+
+def write_conditional(expr, out):
+    """Writes the condition expr to out. The nodes that still have to be written (and the
+       text between them) are kept on a stack, so deep AND and OR chains do not hit the
+       recursion limit."""
+
+    stack = [ expr ]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.write(item)
+        elif item.get_nodetype() == CONSTANT:
+            out.write("(")
+            out.write(item.get_value())
+            out.write(")")
+        elif item.get_nodetype() == NOT:
+            out.write("(NOT ")
+            stack.extend([ ")", item.get_children()[0] ])
+        else:
+            out.write("(")
+            children = item.get_children()
+            stack.extend([ ")", children[1], sql_operators[item.get_nodetype()], children[0] ])
 
 def gen_conditional(expr):
-    
-    if expr.get_nodetype() == CONSTANT:
-        return "(" + expr.get_value() + ")"
-    if expr.get_nodetype() == NOT:
-        return "(NOT " + gen_conditional(expr.get_children()[0]) + ")"
-    if expr.get_nodetype() == OR:
-        operator = " OR "
-    elif expr.get_nodetype() == AND:
-        operator = " AND "
-    elif expr.get_nodetype() == EQUALS:
-        operator = " = "
-    elif expr.get_nodetype() == NOT_EQUAL:
-        operator = " <> "
-    elif expr.get_nodetype() == SMALLER:
-        operator = " < "
-    elif expr.get_nodetype() == BIGGER:
-        operator = " > "
-    elif expr.get_nodetype() == SMALLER_EQUAL:
-        operator = " <= "
-    elif expr.get_nodetype() == BIGGER_EQUAL:
-        operator = " >= "
-    
-    return "(" + gen_conditional(expr.get_children()[0]) + operator + gen_conditional(expr.get_children()[1]) + ")"
-    
-def gen_where_stmt(expr):
+
+    out = io.StringIO()
+    write_conditional(expr, out)
+    return out.getvalue()
+
+def write_where_stmt(expr, out):
     if not expr:
-        return ""
-    return "WHERE " + gen_conditional(expr.get_children()[0])
+        return
+    out.write("WHERE ")
+    write_conditional(expr.get_children()[0], out)
 
-def gen_select_stmt(expr):
+def gen_where_stmt(expr):
+
+    out = io.StringIO()
+    write_where_stmt(expr, out)
+    return out.getvalue()
+
+def write_select_stmt(expr, out):
+    """Writes the SELECT statement expr (see make_select_expr) to out, a text stream such
+       as a file or io.StringIO"""
 
     children = expr.get_children()
-    stmt = "SELECT " + gen_columns_stmt(children[0]) + " " + gen_into_stmt(children[1]) + " " + gen_from_stmt(children[2]) + " " + gen_where_stmt(children[3])
-    return stmt
+    out.write("SELECT ")
+    write_columns_stmt(children[0], out)
+    out.write(" ")
+    out.write(gen_into_stmt(children[1]))
+    out.write(" ")
+    write_from_stmt(children[2], out)
+    out.write(" ")
+    write_where_stmt(children[3], out)
+
+def gen_select_stmt(expr):
+
+    with profiling.timed("codegen"):
+        out = io.StringIO()
+        write_select_stmt(expr, out)
+        return out.getvalue()
+
+def make_select_view(expr):
+    """Like make_select_expr, but leaves expr as it is: only the RENAME, EXTRA_COLUMN and
+       PROJECTION nodes above the condition are copied (as persistent nodes), the rest of
+       the SELECT node shares the nodes of expr"""
+
+    into_expr = expr.get_children()[0]
+    subexpr = expr.get_children()[1]
+    columns_nodes = []
+    while subexpr.get_nodetype() in [ RENAME, EXTRA_COLUMN, PROJECTION ]:
+        columns_nodes.append(subexpr)
+        subexpr = subexpr.get_children()[1]
+    columns_expr = None
+    for node in reversed(columns_nodes):
+        columns_expr = make_persistent_node(node.get_nodetype(), [ node.get_children()[0], columns_expr ])
+    if subexpr.get_nodetype() == CONDITION:
+        where_expr = make_persistent_node(CONDITION, [ subexpr.get_children()[0], None ])
+        subexpr = subexpr.get_children()[1]
+    else:
+        where_expr = None
+    from_expr = subexpr
+
+    return make_persistent_node(SELECT, [ columns_expr, into_expr, from_expr, where_expr ])
 
 def print_as_SQL(expr):
-    clone_expr = expr.clone()
-    select_expr = make_select_expr(clone_expr)
-    print(gen_select_stmt(select_expr))
+    print(gen_select_stmt(make_select_view(expr)))
+
+def test_write_select_stmt():
+    def gen_conditional_recursive(expr):   # How conditions were written before write_conditional
+        if expr.get_nodetype() == CONSTANT:
+            return "(" + expr.get_value() + ")"
+        if expr.get_nodetype() == NOT:
+            return "(NOT " + gen_conditional_recursive(expr.get_children()[0]) + ")"
+        (left, right) = expr.get_children()
+        return "(" + gen_conditional_recursive(left) + sql_operators[expr.get_nodetype()] + gen_conditional_recursive(right) + ")"
+
+    condition_expr = ConstNode("a0")
+    for n in range(1, 100000):
+        condition_expr = TreeNode(AND if n % 2 else OR, [condition_expr, ConstNode(f"a{n}")])
+        if n == 200:
+            condition_expr = TreeNode(NOT, [condition_expr])
+            print(gen_conditional(condition_expr) == gen_conditional_recursive(condition_expr)) # Should be 'True'
+    sigma_expr = TreeNode(CONDITION, [condition_expr, TreeNode(INPUT1, [ConstNode("X")])])
+    pi_expr = TreeNode(PROJECTION, [ConstNode([f"a{n}" for n in range(1000)]), sigma_expr])
+    equals_expr = TreeNode(ASSIGN, [ConstNode("B"), pi_expr])
+    print(len(gen_select_stmt(make_select_view(equals_expr)))) # No RecursionError
+    out = io.StringIO()
+    write_select_stmt(make_select_view(equals_expr), out) # Streams the statement
+    print(out.getvalue() == gen_select_stmt(make_select_view(equals_expr))) # Should be 'True'
 
 def elementary_test():
     # Build up select statement
@@ -336,7 +594,7 @@ def elementary_test():
 
 
 def find_node(expr, node_types):
-    if not isinstance(node_types, set):
+    if not isinstance(node_types, (set, list)):
         node_types = [ node_types ]
 
     if expr.get_nodetype() in node_types:
@@ -348,6 +606,17 @@ def find_node(expr, node_types):
             return found
     return None
 
+def find_nodes(expr, node_type):
+
+    result = []
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if node.get_nodetype() == node_type:
+            result.append(node)
+        stack.extend(child for child in node.get_children() if child)
+    return result
+
 def substitute(source, target):
     """ Substitutes any reference of source in target by source """
 
@@ -368,7 +637,600 @@ def replace_columns_conditional(expr, src_column, tgt_column):
         for child in expr.get_children():
             replace_columns_conditional(child, src_column, tgt_column)
 
+def split_conjuncts(expr):
+    """Returns the operands of a tree of ANDs"""
+
+    conjuncts = []
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if node.get_nodetype() == AND:
+            stack.extend(reversed(node.get_children()))
+        else:
+            conjuncts.append(node)
+    return conjuncts
+
+def join_conjuncts(conjuncts):
+
+    expr = conjuncts[0]
+    for conjunct in conjuncts[1:]:
+        expr = TreeNode(AND, [expr, conjunct])
+    return expr
+
+def get_condition_aliases(expr, aliases):
+    """Returns the input aliases (A in A.x) that the columns in a condition refer to"""
+
+    result = set()
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if node.get_nodetype() == CONSTANT:
+            if isinstance(node.value, str) and "." in node.value and node.value.split(".")[0] in aliases:
+                result.add(node.value.split(".")[0])
+        else:
+            stack.extend(node.get_children())
+    return result
+
+def get_source_column(source, column):
+    """Follows column, an output column of the select statement source, back through the
+       renames and the projection (A.x is output as x) to the name it has in the input of
+       source. Returns None for extra columns."""
+
+    expr = source.get_children()[1]
+    while expr.get_nodetype() in [ RENAME, EXTRA_COLUMN ]:
+        value = expr.get_children()[0].get_value()
+        if value[0] == column:
+            if expr.get_nodetype() == EXTRA_COLUMN:
+                return None
+            column = value[1]
+        expr = expr.get_children()[1]
+    if expr.get_nodetype() == PROJECTION:
+        for projected in expr.get_children()[0].get_value():
+            if split_column(projected)[1] == column:
+                return projected
+    return column
+
+def add_condition(source, condition):
+    """ANDs condition to the CONDITION of the select statement source, adding one if needed"""
+
+    cond_node = find_node(source, CONDITION)
+    if cond_node:
+        cond_node.set_child(0, TreeNode(AND, [cond_node.get_children()[0], condition]))
+        return
+    parent = source
+    while parent.get_children()[1].get_nodetype() in [ RENAME, EXTRA_COLUMN, PROJECTION ]:
+        parent = parent.get_children()[1]
+    parent.set_child(1, TreeNode(CONDITION, [condition, parent.get_children()[1]]))
+
+def push_down_conditions(expr, sources):
+    """Moves the conjuncts of the condition of expr that only refer to a single input
+       below the join, into the select statement that computes that input. sources maps
+       table names to those statements (ASSIGN expressions, in canonical form); only
+       tables that are not read anywhere else should be in it. Column names are renamed
+       the way lift_cleanup_node renames them. Returns the number of moved conjuncts."""
+
+    cond_node = find_node(expr, CONDITION)
+    if not cond_node:
+        return 0
+    input_node = cond_node.get_children()[1]
+    tables = {}
+    for child in input_node.get_children():
+        if child.get_nodetype() == RENAME_ALL:
+            tables[child.get_children()[0].get_value()] = child.get_children()[1].get_value()
+
+    n_moved = 0
+    remaining = []
+    for conjunct in split_conjuncts(cond_node.get_children()[0]):
+        aliases = get_condition_aliases(conjunct, tables)
+        if len(aliases) == 1:
+            alias = aliases.pop()
+            source = sources.get(tables[alias])
+            if source is not None:
+                pushed = conjunct.clone()
+                for column_node in find_nodes(pushed, CONSTANT):
+                    if isinstance(column_node.value, str) and column_node.value.startswith(alias + "."):
+                        column_node.value = get_source_column(source, column_node.value[len(alias) + 1:])
+                        if column_node.value is None:
+                            break
+                else:
+                    add_condition(source, pushed)
+                    n_moved += 1
+                    continue
+        remaining.append(conjunct)
+
+    if remaining:
+        cond_node.set_child(0, join_conjuncts(remaining))
+    else:
+        (parent, index) = cond_node.get_parent()
+        parent.set_child(index, input_node)
+    return n_moved
+
+def test_push_down_conditions():
+    statements = make_test_statements(TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("'Utrecht'")]))
+    print(push_down_conditions(statements[2], { "B": statements[1] })) # Should be 1
+    print_as_SQL(statements[1]) # Should be "SELECT id, gemeente AS x INTO B FROM tbl_adres WHERE ((gemeente) = ('Utrecht'))"
+    print_as_SQL(statements[2]) # Should be 'SELECT A.id, B.x INTO C FROM A JOIN B WHERE ((A.x) = (B.id))'
+
+TRUE = "TRUE"
+FALSE = "FALSE"
+
+negated_compare = {
+    EQUALS: NOT_EQUAL,
+    NOT_EQUAL: EQUALS,
+    SMALLER: BIGGER_EQUAL,
+    BIGGER_EQUAL: SMALLER,
+    BIGGER: SMALLER_EQUAL,
+    SMALLER_EQUAL: BIGGER
+}
+mirrored_compare = {
+    EQUALS: EQUALS,
+    NOT_EQUAL: NOT_EQUAL,
+    SMALLER: BIGGER,
+    BIGGER: SMALLER,
+    SMALLER_EQUAL: BIGGER_EQUAL,
+    BIGGER_EQUAL: SMALLER_EQUAL
+}
+number_pattern = re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$")
+
+def get_literal(value):
+    """The Python value of a number or quoted string constant, or None for a column"""
+
+    if not isinstance(value, str):
+        return None
+    if number_pattern.match(value):
+        return float(value)
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return None
+
+def compare_literals(operator, lvalue, rvalue):
+    if operator == EQUALS:
+        return lvalue == rvalue
+    if operator == NOT_EQUAL:
+        return lvalue != rvalue
+    if operator == SMALLER:
+        return lvalue < rvalue
+    if operator == BIGGER:
+        return lvalue > rvalue
+    if operator == SMALLER_EQUAL:
+        return lvalue <= rvalue
+    return lvalue >= rvalue
+
+def make_compare_term(operator, lvalue, rvalue):
+    """A comparison as a term (see simplify_condition), folded if both sides are
+       literals of the same kind, with the column on the left if there is one"""
+
+    lliteral = get_literal(lvalue)
+    rliteral = get_literal(rvalue)
+    if lliteral is not None and rliteral is not None and type(lliteral) == type(rliteral):
+        return compare_literals(operator, lliteral, rliteral)
+    if lliteral is not None and rliteral is None:
+        return (mirrored_compare[operator], rvalue, lvalue)
+    return (operator, lvalue, rvalue)
+
+def negate_term(term):
+    if isinstance(term, bool):
+        return not term
+    if term[0] == CONSTANT:
+        return (NOT, term[1])
+    if term[0] == NOT:
+        return (CONSTANT, term[1])
+    if term[0] in negated_compare:
+        return (negated_compare[term[0]], term[1], term[2])
+    return None
+
+def is_contradiction(terms):
+    """Checks whether a conjunction of terms can never be true: it has a term and its
+       negation, or compares a column with literals in a way no value satisfies. Only
+       literals of the same kind are compared with each other: depending on the column, SQL
+       converts a number to a string or the other way around, so a = 2 AND a = '2' can hold."""
+
+    term_set = set(terms)
+    values = {}   # column -> ([ equal literals ], [ unequal literals ], [ (literal, is_strict) lower bounds ], upper bounds)
+    for term in terms:
+        if isinstance(term, bool) or term[0] in (AND, OR):
+            continue
+        if negate_term(term) in term_set:
+            return True
+        if term[0] not in negated_compare:
+            continue
+        literal = get_literal(term[2])
+        if literal is None or get_literal(term[1]) is not None:
+            continue
+        column_values = values.setdefault(term[1], ([], [], [], []))
+        if term[0] == EQUALS:
+            column_values[0].append(literal)
+        elif term[0] == NOT_EQUAL:
+            column_values[1].append(literal)
+        elif term[0] in (BIGGER, BIGGER_EQUAL):
+            column_values[2].append((literal, term[0] == BIGGER))
+        else:
+            column_values[3].append((literal, term[0] == SMALLER))
+
+    for (equal, unequal, lower, upper) in values.values():
+        if len(set(equal)) > len({ type(value) for value in equal }) or set(equal) & set(unequal):   # Two different values of one kind
+            return True
+        for (bound, is_strict) in lower:
+            for value in equal:
+                if type(value) == type(bound) and (value < bound or (is_strict and value == bound)):
+                    return True
+            for (upper_bound, is_upper_strict) in upper:
+                if type(upper_bound) == type(bound) and (upper_bound < bound or ((is_strict or is_upper_strict) and upper_bound == bound)):
+                    return True
+        for (bound, is_strict) in upper:
+            for value in equal:
+                if type(value) == type(bound) and (value > bound or (is_strict and value == bound)):
+                    return True
+    return False
+
+def combine_terms(operator, terms):
+    """The term for operator (AND or OR) over terms: nested terms with the same operator
+       are flattened, duplicates removed and constants folded"""
+
+    absorbing = operator == OR   # TRUE for OR, FALSE for AND
+    result = []
+    seen = set()
+    stack = list(reversed(terms))
+    while stack:
+        term = stack.pop()
+        if isinstance(term, bool):
+            if term == absorbing:
+                return absorbing
+            continue
+        if term[0] == operator:
+            stack.extend(reversed(term[1]))
+            continue
+        if term not in seen:
+            seen.add(term)
+            result.append(term)
+    if operator == AND and is_contradiction(result):
+        return False
+    if not result:
+        return not absorbing
+    if len(result) == 1:
+        return result[0]
+    return (operator, tuple(result))
+
+def make_condition_term(expr):
+    """The condition expr as a term: True or False, (AND/OR, terms), (compare, lvalue,
+       rvalue), (CONSTANT, value) for a boolean column, (NOT, value) for its negation or
+       (None, node) for anything else. NOTs are pushed down to the comparisons."""
+
+    results = []
+    stack = [ (expr, False, False) ]
+    while stack:
+        (node, is_negated, is_visited) = stack.pop()
+        node_type = node.get_nodetype()
+        if node_type == NOT:
+            stack.append((node.get_children()[0], not is_negated, False))
+        elif node_type in (AND, OR):
+            if is_visited:
+                terms = results[-len(node.get_children()):]
+                del results[-len(node.get_children()):]
+                operator = node_type
+                if is_negated:
+                    operator = OR if node_type == AND else AND
+                results.append(combine_terms(operator, terms))
+            else:
+                stack.append((node, is_negated, True))
+                stack.extend((child, is_negated, False) for child in reversed(node.get_children()))
+        elif node_type == CONSTANT and node.get_value() in (TRUE, FALSE):
+            results.append((node.get_value() == TRUE) != is_negated)
+        elif node_type == CONSTANT:
+            results.append((NOT if is_negated else CONSTANT, node.get_value()))
+        elif node_type in negated_compare and all(child.get_nodetype() == CONSTANT for child in node.get_children()):
+            operator = negated_compare[node_type] if is_negated else node_type
+            (lvalue, rvalue) = [ child.get_value() for child in node.get_children() ]
+            results.append(make_compare_term(operator, lvalue, rvalue))
+        else:
+            term = (None, node)
+            results.append((NOT, term) if is_negated else term)
+    return results[0]
+
+def make_condition_expr(term):
+    """The condition tree of a term, with AND and OR as left deep binary trees"""
+
+    results = []
+    stack = [ (term, False) ]
+    while stack:
+        (term, is_visited) = stack.pop()
+        if isinstance(term, bool):
+            results.append(ConstNode(TRUE if term else FALSE))
+        elif term[0] in (AND, OR):
+            if is_visited:
+                operands = results[-len(term[1]):]
+                del results[-len(term[1]):]
+                expr = operands[0]
+                for operand in operands[1:]:
+                    expr = TreeNode(term[0], [expr, operand])
+                results.append(expr)
+            else:
+                stack.append((term, True))
+                stack.extend((operand, False) for operand in reversed(term[1]))
+        elif term[0] == CONSTANT:
+            results.append(ConstNode(term[1]))
+        elif term[0] == NOT and isinstance(term[1], tuple):
+            results.append(TreeNode(NOT, [term[1][1].clone()]))
+        elif term[0] == NOT:
+            results.append(TreeNode(NOT, [ConstNode(term[1])]))
+        elif term[0] is None:
+            results.append(term[1].clone())
+        else:
+            results.append(TreeNode(term[0], [ConstNode(term[1]), ConstNode(term[2])]))
+    return results[0]
+
+def simplify_condition(expr):
+    """Returns a simplified copy of the condition expr: NOTs pushed down to the
+       comparisons, nested ANDs and ORs flattened, duplicate operands removed, comparisons
+       of literals folded and contradictions replaced by FALSE. The result is TRUE or
+       FALSE (a constant node) if the condition always or never holds."""
+
+    return make_condition_expr(make_condition_term(expr))
+
+def simplify_conditions(expr):
+    """Simplifies the conditions in a statement; a condition that always holds is
+       removed. Returns False if a condition never holds: then the statement has an
+       empty result, and need not be run."""
+
+    is_satisfiable = True
+    for condition in find_nodes(expr, CONDITION):
+        simplified = simplify_condition(condition.get_children()[0])
+        if simplified.get_nodetype() == CONSTANT and simplified.get_value() == TRUE:
+            (parent, index) = condition.get_parent()
+            parent.set_child(index, condition.get_children()[1])
+            continue
+        condition.set_child(0, simplified)
+        if simplified.get_nodetype() == CONSTANT and simplified.get_value() == FALSE:
+            is_satisfiable = False
+    return is_satisfiable
+
+def test_simplify_condition():
+    a_is_2 = TreeNode(EQUALS, [ConstNode("a"), ConstNode("2")])
+    expr = TreeNode(NOT, [TreeNode(OR, [TreeNode(NOT, [a_is_2]), TreeNode(EQUALS, [ConstNode("2"), ConstNode("3")])])])
+    expr = TreeNode(AND, [expr, TreeNode(AND, [a_is_2.clone(), TreeNode(BIGGER, [ConstNode("b"), ConstNode("1")])])])
+    print(gen_conditional(expr))
+    print(gen_conditional(simplify_condition(expr))) # Should be '(((a) = (2)) AND ((b) > (1)))'
+    expr = TreeNode(AND, [a_is_2.clone(), TreeNode(EQUALS, [ConstNode("3"), ConstNode("a")])])
+    print(gen_conditional(simplify_condition(expr))) # Should be '(FALSE)'
+    expr = TreeNode(AND, [TreeNode(SMALLER, [ConstNode("a"), ConstNode("2")]), TreeNode(BIGGER_EQUAL, [ConstNode("a"), ConstNode("2")])])
+    print(gen_conditional(simplify_condition(expr))) # Should be '(FALSE)'
+    condition_expr = TreeNode(AND, [TreeNode(EQUALS, [ConstNode("1"), ConstNode("1")]), TreeNode(NOT, [ConstNode(FALSE)])])
+    expr = TreeNode(ASSIGN, [ConstNode("R"), TreeNode(PROJECTION, [ConstNode(["a"]), TreeNode(CONDITION, [condition_expr, ConstNode("X")])])])
+    print(simplify_conditions(expr), find_nodes(expr, CONDITION)) # Should be 'True []'
+    expr = TreeNode(AND, [a_is_2.clone(), TreeNode(EQUALS, [ConstNode("a"), ConstNode("'2'")])])
+    print(gen_conditional(simplify_condition(expr))) # Should be "(((a) = (2)) AND ((a) = ('2')))": a number and a string are not compared
+
+def simplify_statements(statements):
+    """Simplifies the conditions of statements (ASSIGN expressions, in the order they
+       run) and returns True if the result of the last one is known to be empty: because a
+       condition never holds, or because it reads a table that is empty for that reason.
+       Such statements need not be run."""
+
+    empty_tables = set()
+    is_empty = False
+    for statement in statements:
+        is_empty = not simplify_conditions(statement)
+        if any(table in empty_tables for table in get_input_tables(statement).values()):
+            is_empty = True   # Every statement joins its inputs, so one empty table is enough
+        if is_empty:
+            empty_tables.add(statement.get_children()[0].get_value())
+    return is_empty
+
+def optimize_statements(statements):
+    """Optimizes a program of select statements (ASSIGN expressions in canonical form, in
+       the order they run; the last one writes the result) and returns their SQL, or []
+       if the result is known to be empty (see simplify_statements). Conditions are
+       pushed down into the statements of the tables that are read only once, starting
+       from the result, so they can move down more than one statement, and the columns
+       that no later statement reads are removed from the projections."""
+
+    n_reads = Counter(table for statement in statements for table in get_input_tables(statement).values())
+    sources = { statement.get_children()[0].get_value(): statement for statement in statements[:-1] }
+    sources = { table: source for table, source in sources.items() if n_reads[table] == 1 }
+    for statement in reversed(statements):
+        push_down_conditions(statement, sources)
+    if simplify_statements(statements):
+        return []
+    prune_projections(statements)
+    return [ gen_select_stmt(make_select_view(statement)) for statement in statements ]
+
+def make_test_statements(condition):
+    """A: persons and their address, B: addresses and their municipality, C: the join of
+       A and B with condition (on the columns A.x and B.*)"""
+
+    A_expr = TreeNode(ASSIGN, [ConstNode("A"), TreeNode(RENAME, [ConstNode(["x", "adres"]), TreeNode(PROJECTION, [ConstNode(["id", "naam", "adres"]), TreeNode(INPUT1, [ConstNode("tbl_persoon")])])])])
+    B_expr = TreeNode(ASSIGN, [ConstNode("B"), TreeNode(RENAME, [ConstNode(["x", "gemeente"]), TreeNode(PROJECTION, [ConstNode(["id", "gemeente"]), TreeNode(INPUT1, [ConstNode("tbl_adres")])])])])
+    join_expr = TreeNode(INPUT2, [TreeNode(RENAME_ALL, [ConstNode("A"), ConstNode("A")]), TreeNode(RENAME_ALL, [ConstNode("B"), ConstNode("B")])])
+    condition = TreeNode(AND, [TreeNode(EQUALS, [ConstNode("A.x"), ConstNode("B.id")]), condition])
+    C_expr = TreeNode(ASSIGN, [ConstNode("C"), TreeNode(PROJECTION, [ConstNode(["A.id", "B.x"]), TreeNode(CONDITION, [condition, join_expr])])])
+    return [ A_expr, B_expr, C_expr ]
+
+def test_optimize_statements():
+    statements = make_test_statements(TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("2")]))
+    print(all(test_canonical_select(statement) for statement in statements)) # Should be 'True'
+    for statement in optimize_statements(statements):
+        print(statement) # B.x = 2 is pushed down into B, and A.naam is removed
+    print(optimize_statements(make_test_statements(TreeNode(AND, [TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("2")]), TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("3")])])))) # Should be []: B.x = 2 AND B.x = 3 never holds
+    print(len(optimize_statements(make_test_statements(TreeNode(AND, [TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("2")]), TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("'2'")])]))))) # Should be 3
+    statements = make_test_statements(TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("2")]))
+    join_expr = TreeNode(INPUT2, [TreeNode(RENAME_ALL, [ConstNode("C"), ConstNode("C")]), TreeNode(RENAME_ALL, [ConstNode("tbl_gemeente"), ConstNode("tbl_gemeente")])])
+    condition = TreeNode(AND, [TreeNode(EQUALS, [ConstNode("C.x"), ConstNode("tbl_gemeente.id")]), TreeNode(EQUALS, [ConstNode("C.id"), ConstNode("7")])])
+    statements.append(TreeNode(ASSIGN, [ConstNode("D"), TreeNode(PROJECTION, [ConstNode(["C.id", "tbl_gemeente.naam"]), TreeNode(CONDITION, [condition, join_expr])])]))
+    for statement in optimize_statements(statements):
+        print(statement) # C.id = 7 moves down into C (as A.id), and from there into A (as id)
+
+def get_input_tables(expr):
+    """Returns alias -> table name for the inputs of a select statement; the single input
+       of an INPUT1 has alias None, since its columns are not prefixed"""
+
+    input_node = find_node(expr, INPUTS)
+    if not input_node:
+        return {}
+    if input_node.get_nodetype() == INPUT1:
+        return { None: input_node.get_children()[0].get_value() }
+    tables = {}
+    for child in input_node.get_children():
+        if child.get_nodetype() == RENAME_ALL:
+            tables[child.get_children()[0].get_value()] = child.get_children()[1].get_value()
+    return tables
+
+def split_column(column):
+    """Splits A.x into (A, x), and x into (None, x)"""
+
+    if "." in column:
+        return tuple(column.split(".", 1))
+    return (None, column)
+
+def get_output_names(expr):
+    """Returns projected column -> output column name for a select statement in canonical
+       form, or None if it has no projection"""
+
+    renames = []
+    subexpr = expr.get_children()[1]
+    while subexpr.get_nodetype() in [ RENAME, EXTRA_COLUMN ]:
+        if subexpr.get_nodetype() == RENAME:
+            renames.append(subexpr.get_children()[0].get_value())
+        subexpr = subexpr.get_children()[1]
+    if subexpr.get_nodetype() != PROJECTION:
+        return None
+
+    output_names = {}
+    for column in subexpr.get_children()[0].get_value():
+        output_names[column] = split_column(column)[1]
+    for rename in reversed(renames):
+        for column, output_name in output_names.items():
+            if output_name == rename[1] or column == rename[1]:
+                output_names[column] = rename[0]
+                break
+    return output_names
+
+def prune_projections(statements):
+    """Removes the columns that no later statement reads from the projections of the
+       statements (ASSIGN expressions in canonical form) that write the tables the later
+       ones read. Wildcards like A.* are replaced by the columns of A that are needed, if
+       A is one of the statements. The last statement keeps its columns. Returns the
+       number of removed (named) columns."""
+
+    producers = { statement.get_children()[0].get_value(): statement for statement in statements }
+    required = {}   # table name -> output columns read from it, None for all
+    n_removed = 0
+    for n, statement in enumerate(reversed(statements)):
+        name = statement.get_children()[0].get_value()
+        output_names = get_output_names(statement)
+        projection = find_node(statement, PROJECTION)
+        tables = get_input_tables(statement)
+
+        if n > 0 and output_names is not None and required.get(name, None) is not None:
+            needed = required[name]
+            columns = []
+            for column in projection.get_children()[0].get_value():
+                (alias, column_name) = split_column(column)
+                if column_name == "*":
+                    producer_names = get_output_names(producers[tables[alias]]) if tables.get(alias) in producers else None
+                    if producer_names is None:
+                        columns.append(column)
+                    else:
+                        columns.extend(alias + "." + x for x in producer_names.values() if x in needed and alias + "." + x not in output_names)
+                elif output_names[column] in needed:
+                    columns.append(column)
+                else:
+                    n_removed += 1
+            if columns:
+                projection.get_children()[0].value = columns
+
+        read_columns = { table: set() for table in tables.values() }
+        if projection:
+            column_nodes = [ projection.get_children()[0] ] + find_nodes(find_node(statement, CONDITION) or projection, CONSTANT)
+        else:
+            column_nodes = []
+            read_columns = { table: None for table in tables.values() }
+        for column_node in column_nodes:
+            values = column_node.get_value()
+            for column in (values if isinstance(values, (list, set)) else [ values ]):
+                if not isinstance(column, str):
+                    continue
+                (alias, column_name) = split_column(column)
+                if alias in tables and read_columns[tables[alias]] is not None:
+                    if column_name == "*":
+                        read_columns[tables[alias]] = None
+                    else:
+                        read_columns[tables[alias]].add(column_name)
+        for table, columns in read_columns.items():
+            if table not in producers:
+                continue
+            if columns is None or (table in required and required[table] is None):
+                required[table] = None
+            else:
+                required.setdefault(table, set()).update(columns)
+    return n_removed
+
+def test_prune_projections():
+    statements = make_test_statements(TreeNode(EQUALS, [ConstNode("B.x"), ConstNode("2")]))
+    print(prune_projections(statements)) # Should be 1
+    print_as_SQL(statements[0]) # Should be 'SELECT id, adres AS x INTO A FROM tbl_persoon ': C does not read A.naam
+    print_as_SQL(statements[2]) # The result keeps its columns
+
+WILDCARDS = "*?["
+
+class ColumnSet:
+    """The columns of a projection, split into literal names (in a set) and wildcard
+       patterns (compiled once, grouped by the table in front of their first dot, or
+       under None if they do not start with a literal table name)."""
+
+    def __init__(self, columns):
+        self.literals = set()
+        self.patterns = {}
+        for column in columns:
+            prefix = column
+            for wildcard in WILDCARDS:
+                prefix = prefix.split(wildcard)[0]
+            if prefix == column:
+                self.literals.add(column)
+            else:
+                table = prefix.split(".")[0] if "." in prefix else None
+                self.patterns.setdefault(table, []).append((column, re.compile(fnmatch.translate(column))))
+
+    def get_patterns(self):
+        return [ pattern for patterns in self.patterns.values() for pattern in patterns ]
+
+    def get_matches(self, literal):
+        """The patterns that match a literal column name"""
+
+        tables = [ None ]
+        if "." in literal:
+            tables.append(literal.split(".")[0])
+        for table in tables:
+            for (column, regex) in self.patterns.get(table, ()):
+                if regex.match(literal):
+                    yield column
+
+    def intersection(self, other):
+        """The same set as intersection_with_wildcards(self columns, other columns): a
+           matching pair adds its first column if that has no *, and else its second"""
+
+        result = self.literals & other.literals
+        for literal in self.literals:
+            if any(other.get_matches(literal)):
+                result.add(literal)
+        for literal in other.literals:
+            for column in self.get_matches(literal):
+                result.add(column if "*" not in column else literal)
+        other_patterns = other.get_patterns()
+        for (column1, regex1) in self.get_patterns():
+            for (column2, regex2) in other_patterns:
+                if "*" in column1 and "*" in column2:
+                    continue
+                if regex2.match(column1) or regex1.match(column2):
+                    result.add(column1 if "*" not in column1 else column2)
+        return result
+
 def intersection_with_wildcards(l, m):
+    """The columns of l and m that match a column of the other list, leaving out the
+       patterns with a *. Linear in the number of literal columns, see ColumnSet."""
+
+    return ColumnSet(l).intersection(ColumnSet(m))
+
+def intersection_with_wildcards_pairwise(l, m):
 
     result = set()
     for elt1 in l:
@@ -380,8 +1242,17 @@ def intersection_with_wildcards(l, m):
                     result.add(elt2)
     return result
 
+def test_intersection_with_wildcards():
+    l = [ "A.id", "A.naam", "B.*", "C.x?" ]
+    m = [ "A.*", "B.id", "C.xy", "id" ]
+    print(intersection_with_wildcards(l, m)) # A.id, A.naam, B.id, C.x?
+    print(intersection_with_wildcards(l, m) == intersection_with_wildcards_pairwise(l, m))
+
 def lift_cleanup_node(cleanup_node, expr_format):
 
+    if profiling.n_active:
+        profiling.count("lift_cleanup_node")
+
     this_type = cleanup_node.get_nodetype()
     prev_node = cleanup_node
     (parent, index) = cleanup_node.get_parent()
@@ -391,6 +1262,8 @@ def lift_cleanup_node(cleanup_node, expr_format):
 
     delete_node = False
     while not delete_node and cleanup_node.get_nodetype() not in node_format[index]:
+        if profiling.n_active:
+            profiling.count("lift_cleanup_node_iterations")
         if this_type == RENAME:
             if parent.get_nodetype() == RENAME_ALL:
                 cleanup_node.children[0].value = [ parent.get_children()[0].value + "." + x for x in cleanup_node.children[0].value ]
@@ -423,14 +1296,217 @@ def lift_cleanup_node(cleanup_node, expr_format):
         parent.set_child(index, cleanup_node)
 
 def cleanup_expr(expr, expr_format):
+    """Lifts deviating nodes until expr is in expr_format.
+
+       The deviating nodes are collected once. Lifting a node only changes the position
+       of the lifted node itself, of its old child (which takes its place) and of its new
+       child (the subtree it is inserted above), so only those are checked again. Both
+       precede all other deviating nodes in depth first order, so they are handled first
+       (from a stack); this keeps the order of the lifts, and hence the result, the same
+       as repeatedly calling find_deviation_node from the root."""
+
+    with profiling.timed("cleanup"):
+        worklist = find_deviation_nodes(expr, expr_format, { ASSIGN } )
+        pending = set(worklist)
+        moved_nodes = []
+        next_index = 0
 
-    cleanup_node = find_deviation_node(expr, expr_format, { ASSIGN } )
+        while True:
+            if moved_nodes:
+                cleanup_node = moved_nodes.pop()
+            elif next_index < len(worklist):
+                cleanup_node = worklist[next_index]
+                next_index += 1
+            else:
+                break
+            if cleanup_node not in pending:
+                continue
+            pending.remove(cleanup_node)
+
+            (parent, index) = cleanup_node.get_parent()
+            lift_cleanup_node(cleanup_node, expr_format)
 
-    while cleanup_node:
-        lift_cleanup_node(cleanup_node, expr_format)
-        cleanup_node = find_deviation_node(expr, expr_format, { ASSIGN } )
+            dirty_nodes = [ parent.get_children()[index] ]
+            (new_parent, new_index) = cleanup_node.get_parent()
+            if new_parent.get_children()[new_index] is cleanup_node:
+                dirty_nodes.append(cleanup_node.get_children()[1])
+            for dirty_node in dirty_nodes:
+                pending.discard(dirty_node)
+                if is_deviation_node(dirty_node, expr_format):
+                    pending.add(dirty_node)
+                    moved_nodes.append(dirty_node)
     return expr
 
+def find_path(expr, node_types):
+    """The path (list of child indexes) to the node find_node would find, or None"""
+
+    stack = [ (expr, []) ]
+    while stack:
+        (node, path) = stack.pop()
+        if node.get_nodetype() in node_types:
+            return path
+        children = node.get_children()
+        for n in range(len(children) - 1, -1, -1):
+            if children[n]:
+                stack.append((children[n], path + [ n ]))
+    return None
+
+def substitute_persistent(source, target):
+    """substitute for persistent trees: returns the new target"""
+
+    source_name = source.get_children()[0].get_value()
+    path = find_path(target, INPUTS)
+    input_node = get_path_nodes(target, path)[-1]
+    for n, child in enumerate(input_node.get_children()):
+        name = child.get_children()[1].get_value()
+        if name == source_name:
+            return replace_path(target, path + [ n, 1 ], source.get_children()[1])
+    return target
+
+def replace_columns_persistent(expr, src_column, tgt_column):
+    """replace_columns_conditional for persistent trees: returns the new condition"""
+
+    if expr.get_nodetype() == CONSTANT:
+        if expr.get_value() == src_column:
+            return make_persistent_node(CONSTANT, (), tgt_column)
+        return expr
+    children = [ replace_columns_persistent(child, src_column, tgt_column) for child in expr.get_children() ]
+    if all(child is old_child for child, old_child in zip(children, expr.get_children())):
+        return expr
+    return make_persistent_node(expr.get_nodetype(), children, expr.get_value())
+
+def lift_persistent_node(expr, path, expr_format):
+    """lift_cleanup_node for the node at path of a persistent tree: returns (new tree,
+       path of the lifted node in it), where the path is None if the node was merged
+       into a projection. nodes holds the (new versions of) the nodes on the path; a
+       node is put into its parent when the lift moves up past it, and above where the
+       lift stops."""
+
+    nodes = get_path_nodes(expr, path)
+    cleanup_node = nodes.pop()
+    this_type = cleanup_node.get_nodetype()
+    level = len(nodes) - 1
+    index = path[level]
+    node_format = expr_format[nodes[level].get_nodetype()]
+    if cleanup_node.get_nodetype() not in node_format[index]:
+        nodes[level] = nodes[level].set_child(index, cleanup_node.get_children()[1])
+
+    delete_node = False
+    skip_index = None   # The child the lift came from, except for the first parent
+    while not delete_node and cleanup_node.get_nodetype() not in node_format[index]:
+        parent = nodes[level]
+        parent_type = parent.get_nodetype()
+        columns = cleanup_node.get_children()[0].get_value()
+        if this_type == RENAME:
+            if parent_type == RENAME_ALL:
+                columns = [ parent.get_children()[0].get_value() + "." + x for x in columns ]
+                cleanup_node = cleanup_node.set_child(0, make_persistent_node(CONSTANT, (), columns))
+            elif parent_type == CONDITION:
+                parent = parent.set_child(0, replace_columns_persistent(parent.get_children()[0], columns[0], columns[1]))
+            elif parent_type == PROJECTION:
+                parent_columns = list(parent.get_children()[0].get_value())
+                for n, value in enumerate(parent_columns):
+                    if value == columns[0]:
+                        parent_columns[n] = columns[1]
+                        parent = parent.set_child(0, make_persistent_node(CONSTANT, (), parent_columns))
+                        break
+        elif this_type == PROJECTION:
+            if parent_type == RENAME_ALL:
+                columns = [ parent.get_children()[0].get_value() + "." + x for x in columns ]
+                cleanup_node = cleanup_node.set_child(0, make_persistent_node(CONSTANT, (), columns))
+            elif parent_type in INPUTS:
+                columns = list(columns)
+                for n, child in enumerate(parent.get_children()):
+                    if n == skip_index:
+                        continue
+                    columns.append(child.get_children()[0].get_value() + ".*")
+                cleanup_node = cleanup_node.set_child(0, make_persistent_node(CONSTANT, (), columns))
+            elif parent_type == PROJECTION:
+                parent_columns = parent.get_children()[0].get_value()
+                columns = intersection_with_wildcards(columns, parent_columns)
+                parent = parent.set_child(0, make_persistent_node(CONSTANT, (), columns))
+                delete_node = True
+        nodes[level] = parent
+        if delete_node:
+            break
+        nodes[level - 1] = nodes[level - 1].set_child(path[level - 1], nodes[level])
+        level -= 1
+        skip_index = index = path[level]
+        node_format = expr_format[nodes[level].get_nodetype()]
+    if not delete_node:
+        cleanup_node = cleanup_node.set_child(1, nodes[level].get_children()[index])
+        nodes[level] = nodes[level].set_child(index, cleanup_node)
+        return (replace_path(expr, path[:level], nodes[level]), path[:level + 1])
+    return (replace_path(expr, path[:level], nodes[level]), None)
+
+def move_path(path, lifted_path, new_path):
+    """Where the node at path is after lift_persistent_node lifted the node at lifted_path
+       to new_path (None: merged into a projection). The lifted node's subtree (below its
+       child 1) moves up one level, and then everything below new_path one level down."""
+
+    n = len(lifted_path)
+    if path[:n] == lifted_path:
+        path = lifted_path + path[n + 1:]
+    if new_path is not None and path[:len(new_path)] == new_path:
+        path = new_path + [ 1 ] + path[len(new_path):]
+    return path
+
+def cleanup_persistent(expr, expr_format):
+    """cleanup_expr for persistent trees: returns the cleaned up tree and leaves expr
+       (and any other tree that shares nodes with it) as it is.
+
+       The tree is searched depth first once; path and spine are the child indexes and
+       the nodes down to the next node to check. As in cleanup_expr, a lift only changes
+       the position of the lifted node's old child and of its new child, so only those
+       are checked again (dirty, handled first from a stack). After a lift the paths
+       are moved and the spine is read again from the new tree, both O(depth)."""
+
+    path = []
+    spine = [ expr ]
+    dirty = []
+    while True:
+        if dirty:
+            lifted_path = dirty.pop()
+            if lifted_path == path:
+                continue    # Not checked yet, the search gets there next
+            nodes = get_path_nodes(expr, lifted_path)
+            if nodes[-1].get_nodetype() in expr_format[nodes[-2].get_nodetype()][lifted_path[-1]]:
+                continue
+        elif spine:
+            node = spine[-1]
+            node_types = expr_format[spine[-2].get_nodetype()][path[-1]] if path else { ASSIGN }
+            if node.get_nodetype() in node_types:
+                if node.get_children():
+                    path.append(0)
+                    spine.append(node.get_children()[0])
+                    continue
+                while path:    # Next node: the next sibling of the node or of an ancestor
+                    n = path.pop()
+                    spine.pop()
+                    if n + 1 < len(spine[-1].get_children()):
+                        path.append(n + 1)
+                        spine.append(spine[-1].get_children()[n + 1])
+                        break
+                else:
+                    spine = []
+                continue
+            lifted_path = list(path)
+        else:
+            return expr
+
+        (expr, new_path) = lift_persistent_node(expr, lifted_path, expr_format)
+        old_child_path = move_path(lifted_path, lifted_path, new_path)
+        dirty = [ move_path(dirty_path, lifted_path, new_path) for dirty_path in dirty ]
+        if lifted_path == path:
+            path = old_child_path
+        else:
+            path = move_path(path, lifted_path, new_path) if spine else path
+            dirty.append(old_child_path)
+        if new_path is not None:
+            dirty.append(new_path + [ 1 ])
+        if spine:
+            spine = get_path_nodes(expr, path)
+
 def substitute_test():
     tbl_expr = ConstNode("tbl_persoon")
     from_expr = TreeNode(INPUT1, [tbl_expr])
@@ -482,15 +1558,17 @@ def substitute_test():
     print_as_SQL(B_equals_expr)
     print_as_SQL(C_equals_expr)
 
-    A2_expr = A_equals_expr.clone()
-    B2_expr = B_equals_expr.clone()
-    C2_expr = C_equals_expr.clone()
+    A2_expr = make_persistent(A_equals_expr)
+    B2_expr = make_persistent(B_equals_expr)
+    C2_expr = make_persistent(C_equals_expr)
 
     A2_expr.show()
     C2_expr.show()
-    substitute(A2_expr, C2_expr)
-    cleanup_expr(C2_expr, canonical_select_stmt)
-    C2_expr.show()
+    C3_expr = substitute_persistent(A2_expr, C2_expr)
+    print(C3_expr.get_children()[0] is C2_expr.get_children()[0]) # Should be 'True': only the path to the input is copied
+    C3_expr = cleanup_persistent(C3_expr, canonical_select_stmt)
+    C3_expr.show()
+    print_as_SQL(C2_expr) # C2_expr itself is not changed
 
 if __name__ == "__main__":
     substitute_test()
\ No newline at end of file
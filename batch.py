@@ -0,0 +1,115 @@
+import os
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+from catalog import Catalog, get_default_catalog
+from sqloptimizer4 import InterParseTree
+
+DEFAULT_CHUNK_SIZE = 64   # Expressions per task; a task costs about as much as compiling a few expressions
+MAX_CHUNK_SIZE = 1024
+TASKS_PER_WORKER = 4      # Chunks in flight per worker, so no worker waits for the next one
+
+# index: position in the input, statements: the generated SQL, or None if the expression
+# could not be compiled, error: the exception (as a string) in that case
+CompileResult = namedtuple("CompileResult", ["index", "expression", "statements", "error"])
+
+
+worker_catalog = None
+worker_is_fused = False
+
+def init_worker(catalog_data, is_fused):
+    """Runs once in every worker process: the catalog is sent (and unpickled) once per
+       worker instead of once per task, and is only read from then on"""
+
+    global worker_catalog, worker_is_fused
+    worker_catalog = Catalog.from_dict(catalog_data)
+    worker_is_fused = is_fused
+
+
+def compile_expression(index, expression, catalog, is_fused):
+    try:
+        statements = InterParseTree(expression).generate_ralg_expr(catalog, is_fused)
+    except (SyntaxError, KeyError) as e:
+        return CompileResult(index, expression, None, f"{type(e).__name__}: {e}")
+    return CompileResult(index, expression, statements, None)
+
+
+def compile_chunk(chunk):
+    """chunk: a list of (index, expression); compiled in a worker process"""
+
+    return [ compile_expression(index, expression, worker_catalog, worker_is_fused) for index, expression in chunk ]
+
+
+def get_chunk_size(n_expressions, max_workers):
+    """Big enough that sending a task costs little compared to compiling it, small enough
+       that every worker gets several tasks"""
+
+    if n_expressions is None:
+        return DEFAULT_CHUNK_SIZE
+    return max(1, min(MAX_CHUNK_SIZE, n_expressions // (max_workers * TASKS_PER_WORKER)))
+
+
+def compile_batch(expressions, catalog = None, is_fused = False, max_workers = None, chunk_size = None, is_ordered = True):
+    """Compiles an iterable of expression strings in a pool of max_workers processes (the
+       number of cores by default) and yields a CompileResult for each of them: in the
+       order of expressions, or with is_ordered = False as soon as they are done.
+
+       The expressions are read lazily and only a few chunks per worker are in flight, so
+       expressions can be a generator over a very large input. With max_workers = 1 the
+       expressions are compiled in this process."""
+
+    if catalog is None:
+        catalog = get_default_catalog()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if chunk_size is None:
+        n_expressions = len(expressions) if hasattr(expressions, "__len__") else None
+        chunk_size = get_chunk_size(n_expressions, max_workers)
+
+    indexed = enumerate(expressions)
+    if max_workers == 1:
+        for index, expression in indexed:
+            yield compile_expression(index, expression, catalog, is_fused)
+        return
+
+    with ProcessPoolExecutor(max_workers, initializer = init_worker, initargs = (catalog.to_dict(), is_fused)) as executor:
+        pending = deque()
+        is_done = False
+        while True:
+            while not is_done and len(pending) < max_workers * TASKS_PER_WORKER:
+                chunk = list(islice(indexed, chunk_size))
+                if not chunk:
+                    is_done = True
+                    break
+                pending.append(executor.submit(compile_chunk, chunk))
+            if not pending:
+                break
+            if is_ordered:
+                yield from pending.popleft().result()
+            else:
+                (done, not_done) = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield from future.result()
+
+
+def test_compile_batch():
+    relations = [ "woont_op", "ligt_in", "onderdeel_van" ]
+    expressions = [ f"o({relations[n % 3]},{relations[(n + 1) % 3]},{relations[(n + 2) % 3]})" for n in range(20000) ]
+    expressions[5] = "o(woont_op"
+
+    serial = list(compile_batch(expressions, max_workers = 1))
+    print(serial[5].error) # The batch goes on after an error
+    for max_workers in sorted({ 1, 2, 4, os.cpu_count() or 1 }):
+        start = time.perf_counter()
+        results = list(compile_batch(expressions, max_workers = max_workers))
+        elapsed = time.perf_counter() - start
+        print(f"{max_workers} workers: {len(expressions) / elapsed:.0f} expressions/s", results == serial)
+    results = sorted(compile_batch(expressions, max_workers = 2, is_ordered = False))
+    print(results == serial)
+
+
+if __name__ == "__main__":
+    test_compile_batch()
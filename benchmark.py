@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import SQLoptimizer
+import profiling
+from catalog import get_default_catalog
+from execution import SQLiteBackend, create_tables
+from sqloptimizer4 import InterParseTree
+
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.25    # A phase that is this much slower than the baseline is a regression
+MIN_DIFFERENCE = 0.0005     # Seconds; smaller differences are noise
+
+
+class ExpressionGenerator():
+    """Generates expressions from a seeded random generator, so that every run of the
+       benchmark gets the same ones"""
+
+    def __init__(self, seed = 0, catalog = None):
+        if catalog is None:
+            catalog = get_default_catalog()
+        self.random = random.Random(seed)
+        self.relations = sorted(catalog.relations)
+
+    def relation(self):
+        return self.random.choice(self.relations)
+
+    def deep_chain(self, depth):
+        """o(r1,o(r2,...o(rn-1,rn)...))"""
+
+        expression = self.relation()
+        for n in range(depth):
+            expression = f"o({self.relation()},{expression})"
+        return expression
+
+    def wide_chain(self, width):
+        """o(r1,r2,...,rn)"""
+
+        return "o(" + ",".join(self.relation() for n in range(width)) + ")"
+
+    def nested_intersections(self, depth, width = 2):
+        """A full tree of i() with width arguments per level, and compositions of two
+           relations as leaves"""
+
+        if depth == 0:
+            return self.wide_chain(2)
+        return "i(" + ",".join(self.nested_intersections(depth - 1, width) for n in range(width)) + ")"
+
+    def random_expression(self, size):
+        """A random mix of o() and i() with about size relations"""
+
+        if size <= 1:
+            return self.relation()
+        n_args = self.random.randint(2, min(4, size))
+        sizes = [ size // n_args ] * n_args
+        sizes[0] += size - sum(sizes)
+        operator = self.random.choice("ooi")
+        return f"{operator}(" + ",".join(self.random_expression(arg_size) for arg_size in sizes) + ")"
+
+    def select_stack(self, n_renames, n_projections, n_columns = 8):
+        """An SQLoptimizer ASSIGN statement over a join of two inputs, with n_renames
+           renames stacked on each input and n_projections projections on the second one;
+           cleanup_expr has to lift all of them above the join"""
+
+        columns = [ f"c{n}" for n in range(n_columns) ]
+        inputs = []
+        for alias, table in [ ("A", "X"), ("B", "Y") ]:
+            expr = SQLoptimizer.ConstNode(table)
+            if alias == "B":
+                for n in range(n_projections):
+                    expr = SQLoptimizer.TreeNode(SQLoptimizer.PROJECTION, [ SQLoptimizer.ConstNode(self.random.sample(columns, n_columns // 2)), expr ])
+            for n in range(n_renames):
+                rename = [ self.random.choice(columns), self.random.choice(columns) ]
+                expr = SQLoptimizer.TreeNode(SQLoptimizer.RENAME, [ SQLoptimizer.ConstNode(rename), expr ])
+            inputs.append(SQLoptimizer.TreeNode(SQLoptimizer.RENAME_ALL, [ SQLoptimizer.ConstNode(alias), expr ]))
+        join_expr = SQLoptimizer.TreeNode(SQLoptimizer.INPUT2, inputs)
+        condition_expr = SQLoptimizer.TreeNode(SQLoptimizer.EQUALS, [ SQLoptimizer.ConstNode("A.c0"), SQLoptimizer.ConstNode("B.c1") ])
+        expr = SQLoptimizer.TreeNode(SQLoptimizer.CONDITION, [ condition_expr, join_expr ])
+        expr = SQLoptimizer.TreeNode(SQLoptimizer.PROJECTION, [ SQLoptimizer.ConstNode([ f"{alias}.{column}" for alias in "AB" for column in columns ]), expr ])
+        return SQLoptimizer.TreeNode(SQLoptimizer.ASSIGN, [ SQLoptimizer.ConstNode("R"), expr ])
+
+
+def get_cases(generator, is_quick = False):
+    """(name, kind, argument) of every benchmark case; kind is "expression" (argument:
+       the expression string) or "select" (argument: a function that builds the tree)"""
+
+    scale = 1 if is_quick else 10
+    cases = []
+    for depth in (10, 10 * scale, 100 * scale):
+        cases.append((f"deep_chain_{depth}", "expression", generator.deep_chain(depth)))
+    for width in (10, 10 * scale, 100 * scale):
+        cases.append((f"wide_chain_{width}", "expression", generator.wide_chain(width)))
+    for depth in (3, 6 if is_quick else 9):
+        cases.append((f"nested_intersections_{depth}", "expression", generator.nested_intersections(depth)))
+    for size in (10 * scale, 100 * scale):
+        cases.append((f"random_{size}", "expression", generator.random_expression(size)))
+    for n_renames in (10, 10 * scale, 40 * scale):
+        seed = generator.random.randrange(1 << 30)
+        def make_select(n_renames = n_renames, seed = seed):
+            return ExpressionGenerator(seed).select_stack(n_renames, n_renames // 10 + 1)
+        cases.append((f"select_stack_{n_renames}", "select", make_select))
+    return cases
+
+
+def get_execution_cases(generator):
+    cases = [ (f"execute_chain_{width}", generator.wide_chain(width)) for width in (2, 3, 4) ]
+    cases.append(("execute_intersections_2", generator.nested_intersections(2)))
+    return cases
+
+
+def time_call(function, repeat):
+    """(median seconds, minimum seconds, result of the last call) of calling function()"""
+
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return (statistics.median(times), min(times), result)
+
+
+def run_expression_case(expression, repeat):
+    results = {}
+    (results["parse"], results["parse_min"], tree) = time_call(lambda: InterParseTree(expression), repeat)
+    for phase, is_fused in [ ("codegen", False), ("codegen_fused", True) ]:
+        (results[phase], results[phase + "_min"], statements) = time_call(lambda: tree.generate_ralg_expr(is_fused = is_fused), repeat)
+        results[phase + "_statements"] = len(statements)
+        with profiling.profile() as p:
+            tree.generate_ralg_expr(is_fused = is_fused, is_dropped = True)
+        results[phase + "_peak_temp_tables"] = p.counters["peak_temp_tables"]
+    return results
+
+
+def run_select_case(make_select, repeat):
+    results = {}
+    times = []
+    for n in range(repeat):
+        expr = make_select()   # cleanup_expr changes the tree, so each run gets a new one
+        start = time.perf_counter()
+        SQLoptimizer.cleanup_expr(expr, SQLoptimizer.canonical_select_stmt)
+        times.append(time.perf_counter() - start)
+    results["cleanup"] = statistics.median(times)
+    results["cleanup_min"] = min(times)
+    (results["codegen"], results["codegen_min"], statement) = time_call(lambda: SQLoptimizer.gen_select_stmt(SQLoptimizer.make_select_view(expr)), repeat)
+    return results
+
+
+def run_execution_cases(cases, repeat, n_rows = 1000):
+    results = {}
+    (handle, path) = tempfile.mkstemp(suffix = ".db")
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(path)
+        create_tables(connection, n_rows = n_rows)
+        connection.close()
+        backend = SQLiteBackend(path, pool_size = 1)
+        for name, expression in cases:
+            case_results = {}
+            for is_fused, phase in [ (False, "execute"), (True, "execute_fused") ]:
+                statements = InterParseTree(expression).generate_ralg_expr(is_fused = is_fused)
+                (case_results[phase], case_results[phase + "_min"], n_result_rows) = time_call(lambda: sum(1 for row in backend.execute(statements)), repeat)
+            case_results["rows"] = n_result_rows
+            results[name] = case_results
+        backend.close()
+    finally:
+        os.remove(path)
+    return results
+
+
+def run_benchmarks(seed = 0, repeat = DEFAULT_REPEAT, is_quick = False, is_executed = False):
+    """Runs all cases and returns the results as a dict that can be written as JSON:
+       { "meta": {...}, "results": { case: { phase: median seconds, ... } } }"""
+
+    generator = ExpressionGenerator(seed)
+    results = {}
+    for name, kind, argument in get_cases(generator, is_quick):
+        if kind == "expression":
+            results[name] = run_expression_case(argument, repeat)
+        else:
+            results[name] = run_select_case(argument, repeat)
+    if is_executed:
+        results.update(run_execution_cases(get_execution_cases(generator), repeat))
+    meta = {
+        "seed": seed,
+        "repeat": repeat,
+        "quick": is_quick,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    return { "meta": meta, "results": results }
+
+
+def is_timing(phase):
+    return phase in ("parse", "cleanup", "codegen", "codegen_fused", "execute", "execute_fused")
+
+
+def compare(current, baseline, threshold = DEFAULT_THRESHOLD, min_difference = MIN_DIFFERENCE):
+    """Returns the regressions of current against baseline (both as returned by
+       run_benchmarks): (case, phase, baseline seconds, current seconds) for every phase
+       that got more than threshold (relatively) and min_difference (absolutely) slower"""
+
+    regressions = []
+    for case, phases in current["results"].items():
+        baseline_phases = baseline["results"].get(case, {})
+        for phase, seconds in phases.items():
+            if not is_timing(phase) or phase not in baseline_phases:
+                continue
+            baseline_seconds = baseline_phases[phase]
+            if seconds > baseline_seconds * (1 + threshold) and seconds - baseline_seconds > min_difference:
+                regressions.append((case, phase, baseline_seconds, seconds))
+    return regressions
+
+
+def print_results(results):
+    for case, phases in results["results"].items():
+        timings = "  ".join(f"{phase}={seconds * 1000:.3f}ms" for phase, seconds in phases.items() if is_timing(phase))
+        print(f"{case:28} {timings}")
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks parsing, cleanup, code generation and execution")
+    parser.add_argument("--output", help = "write the results to this JSON file")
+    parser.add_argument("--baseline", help = "compare with the results in this JSON file; exits with 1 on regressions")
+    parser.add_argument("--threshold", type = float, default = DEFAULT_THRESHOLD)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--repeat", type = int, default = DEFAULT_REPEAT)
+    parser.add_argument("--quick", action = "store_true", help = "smaller cases")
+    parser.add_argument("--sqlite", action = "store_true", help = "also time execution against SQLite")
+    options = parser.parse_args(args)
+
+    results = run_benchmarks(options.seed, options.repeat, options.quick, options.sqlite)
+    print_results(results)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.threshold)
+        for (case, phase, baseline_seconds, seconds) in regressions:
+            print(f"REGRESSION {case} {phase}: {baseline_seconds * 1000:.3f}ms -> {seconds * 1000:.3f}ms")
+        if regressions:
+            return 1
+    return 0
+
+
+def test_benchmark():
+    generator = ExpressionGenerator(1)
+    print(generator.deep_chain(3))
+    print(generator.nested_intersections(2))
+    print(ExpressionGenerator(1).deep_chain(3) == ExpressionGenerator(1).deep_chain(3)) # The same seed gives the same expressions
+    results = run_benchmarks(repeat = 1, is_quick = True, is_executed = True)
+    print_results(results)
+    slower = json.loads(json.dumps(results))
+    slower["results"]["deep_chain_10"]["parse"] += 1.0
+    print(compare(slower, results)) # One regression
+    print(sorted(results["results"]["nested_intersections_3"])) # Parsing and both ways of code generation are timed
+
+
+if __name__ == "__main__":
+    sys.exit(main())
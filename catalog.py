@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+from joinorder import Estimate
+
+Relation = namedtuple("Relation", ["name", "table", "domain_column", "codomain_column"])
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json")
+
+
+class Catalog():
+    """The relations that expressions refer to, with their statistics and the indexed
+       columns of their tables. All lookups are dict lookups.
+
+       The version changes whenever a relation or its statistics change, so that
+       anything compiled against an older version can be thrown away."""
+
+    def __init__(self):
+        self.relations = {}    # relation name -> Relation
+        self.statistics = {}   # relation name -> Estimate
+        self.indexes = {}      # table -> set of indexed columns
+        self.table_relations = {}   # table -> set of names of the relations on it
+        self.stale_tables = set()
+        self.table_changes = {}     # table -> number of times it was marked changed
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def add_relation(self, name, table, domain_column, codomain_column, statistics = None):
+        with self.lock:
+            self.relations[name] = Relation(name, table, domain_column, codomain_column)
+            self.table_relations.setdefault(table, set()).add(name)
+            if statistics is not None:
+                self.statistics[name] = Estimate(*statistics)
+            else:
+                self.stale_tables.add(table)
+            self.version += 1
+
+    def add_index(self, table, column):
+        with self.lock:
+            self.indexes.setdefault(table, set()).add(column)
+            self.version += 1
+
+    def get_relation(self, name):
+        return self.relations[name]
+
+    def get_design(self, name):
+        """(table, domain column, codomain column), as used by code generation"""
+        relation = self.relations[name]
+        return (relation.table, relation.domain_column, relation.codomain_column)
+
+    def get_statistics(self, name):
+        return self.statistics[name]
+
+    def get_table_statistics(self, table):
+        """(rows, { column: distinct values }) of a table, from the statistics of the
+           relations on it, or None if there are none"""
+
+        rows = None
+        column_values = {}
+        for name in self.table_relations.get(table, ()):
+            statistics = self.statistics.get(name)
+            if statistics is None:
+                continue
+            relation = self.relations[name]
+            rows = statistics.rows
+            column_values[relation.domain_column] = statistics.domain_values
+            column_values[relation.codomain_column] = statistics.codomain_values
+        if rows is None:
+            return None
+        return (rows, column_values)
+
+    def has_index(self, table, column):
+        return column in self.indexes.get(table, ())
+
+    def mark_changed(self, table):
+        """Marks the statistics of the relations on table, and anything computed from
+           the table, as out of date"""
+        with self.lock:
+            self.stale_tables.add(table)
+            self.table_changes[table] = self.table_changes.get(table, 0) + 1
+            self.version += 1
+
+    def refresh_statistics(self, connection, is_full = False):
+        """Recounts the statistics of the relations on changed tables (or of all relations
+           when is_full is set), using a DB-API connection to the database that holds them.
+           Returns the names of the relations that were refreshed."""
+
+        with self.lock:
+            if is_full:
+                tables = set(self.table_relations)
+            else:
+                tables = set(self.stale_tables)
+            names = [ name for table in tables for name in self.table_relations.get(table, ()) ]
+            relations = [ self.relations[name] for name in names ]
+
+        statistics = {}
+        cursor = connection.cursor()
+        for relation in relations:
+            cursor.execute(
+                f"SELECT COUNT(*), COUNT(DISTINCT {relation.domain_column}), COUNT(DISTINCT {relation.codomain_column}) "
+                f"FROM {relation.table}"
+            )
+            statistics[relation.name] = Estimate(*cursor.fetchone())
+
+        with self.lock:
+            self.statistics.update(statistics)
+            self.stale_tables -= tables
+            if statistics:
+                self.version += 1
+        return names
+
+    def to_dict(self):
+        relations = {}
+        for name, relation in self.relations.items():
+            relations[name] = {
+                "table": relation.table,
+                "domain": relation.domain_column,
+                "codomain": relation.codomain_column
+            }
+            if name in self.statistics:
+                relations[name].update(self.statistics[name]._asdict())
+        return {
+            "relations": relations,
+            "indexes": { table: sorted(columns) for table, columns in self.indexes.items() }
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent = 4)
+
+    @classmethod
+    def from_dict(cls, data):
+        catalog = cls()
+        for name, relation in data.get("relations", {}).items():
+            if "rows" in relation:
+                statistics = (relation["rows"], relation["domain_values"], relation["codomain_values"])
+            else:
+                statistics = None
+            catalog.add_relation(name, relation["table"], relation["domain"], relation["codomain"], statistics)
+        for table, columns in data.get("indexes", {}).items():
+            for column in columns:
+                catalog.add_index(table, column)
+        return catalog
+
+    @classmethod
+    def load(cls, path):
+        """Loads a catalog from a JSON file, see catalog.json"""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def load_sqlite(cls, connection, relations_table = "relations"):
+        """Loads the relations from the table relations_table (name, table_name,
+           domain_column, codomain_column) of an SQLite database, and takes the indexes
+           and statistics from the database itself. connection is a path or a connection."""
+
+        if isinstance(connection, str):
+            connection = sqlite3.connect(connection)
+        catalog = cls()
+        rows = connection.execute(f"SELECT name, table_name, domain_column, codomain_column FROM {relations_table}").fetchall()
+        for (name, table, domain_column, codomain_column) in rows:
+            catalog.add_relation(name, table, domain_column, codomain_column)
+        for table in catalog.table_relations:
+            for index in connection.execute(f"PRAGMA index_list({table})").fetchall():
+                for index_column in connection.execute(f"PRAGMA index_info({index[1]})").fetchall():
+                    catalog.add_index(table, index_column[2])
+        catalog.refresh_statistics(connection)
+        return catalog
+
+
+default_catalog = None
+
+def get_default_catalog():
+    """The catalog in catalog.json, loaded on first use"""
+
+    global default_catalog
+    if default_catalog is None:
+        default_catalog = Catalog.load(DEFAULT_CATALOG_PATH)
+    return default_catalog
+
+
+def test_catalog():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE relations (name, table_name, domain_column, codomain_column)")
+    connection.execute("INSERT INTO relations VALUES ('woont_op', 'tbl_persoon', 'persoons_id', 'adres_id')")
+    connection.execute("CREATE TABLE tbl_persoon (persoons_id, adres_id)")
+    connection.execute("CREATE INDEX idx_persoon ON tbl_persoon (persoons_id)")
+    connection.executemany("INSERT INTO tbl_persoon VALUES (?, ?)", [ (n, n // 2) for n in range(10) ])
+
+    catalog = Catalog.load_sqlite(connection)
+    print(catalog.get_statistics("woont_op")) # Should be 10 rows, 10 domain values, 5 codomain values
+    print(catalog.has_index("tbl_persoon", "persoons_id"))
+    print(catalog.refresh_statistics(connection)) # Nothing changed, so nothing is refreshed
+    connection.execute("INSERT INTO tbl_persoon VALUES (10, 5)")
+    catalog.mark_changed("tbl_persoon")
+    print(catalog.refresh_statistics(connection))
+    print(catalog.get_statistics("woont_op"))
+    print(get_default_catalog().get_design("ligt_in"))
+
+
+if __name__ == "__main__":
+    test_catalog()
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+from catalog import get_default_catalog
+from sqloptimizer4 import InterParseTree, get_fingerprint
+
+
+class CompileCache():
+    """A bounded, thread safe cache that maps expressions to the SQL statements
+       generated for them. Expressions are looked up by the fingerprint of their parse
+       tree, so expressions that only differ in layout, in the nesting of compositions or
+       in the order of the arguments of an intersection share a cache entry.
+
+       Entries are evicted when there are more than max_size of them (least recently
+       used first) or when they are older than max_age seconds (None: never). The whole
+       cache is invalidated when the catalog version changes. With is_fused, the
+       statements are generated by generate_fused_plans."""
+
+    def __init__(self, max_size = 1024, max_age = None, catalog = None, is_fused = False):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.catalog = catalog
+        self.is_fused = is_fused
+        self.entries = OrderedDict()   # (fingerprint, catalog version) -> (time, statements)
+        self.lock = threading.Lock()
+        self.catalog_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_catalog(self):
+        if self.catalog is None:
+            return get_default_catalog()
+        return self.catalog
+
+    def compile(self, expression):
+        catalog = self.get_catalog()
+        catalog_version = catalog.version
+        tree = InterParseTree(expression)
+        key = (get_fingerprint(tree.root), catalog_version)
+        now = time.monotonic()
+
+        with self.lock:
+            if catalog_version != self.catalog_version:
+                if self.entries:
+                    self.invalidations += 1
+                    self.entries.clear()
+                self.catalog_version = catalog_version
+            entry = self.entries.get(key)
+            if entry is not None:
+                if self.max_age is None or now - entry[0] <= self.max_age:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return list(entry[1])
+                del self.entries[key]
+                self.evictions += 1
+            self.misses += 1
+
+        # Compile outside of the lock; two threads may compile the same expression at
+        # the same time, in which case the last one wins.
+        statements = tuple(tree.generate_ralg_expr(catalog, self.is_fused))
+
+        with self.lock:
+            if catalog_version == self.catalog_version:
+                self.entries[key] = (now, statements)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last = False)
+                    self.evictions += 1
+        return list(statements)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+def test_compile_cache():
+    cache = CompileCache(max_size = 2)
+    print(cache.compile("woont_op"))
+    print(cache.compile(" woont_op "))
+    print(cache.compile("o(o(onderdeel_van,ligt_in),woont_op)") == cache.compile("o(onderdeel_van, o(ligt_in,woont_op))")) # One compile
+    print(cache.compile("ligt_in"))
+    print(cache.compile("onderdeel_van"))
+    print(cache.get_stats()) # Should be 2 hits, 4 misses, 2 evictions
+
+
+if __name__ == "__main__":
+    test_compile_cache()
@@ -0,0 +1,210 @@
+import json
+from collections import namedtuple
+
+from catalog import get_default_catalog
+from sqloptimizer4 import InterParseTree, ColSpec, AssignNode, RenameNode, ProjectionNode, ConditionalNode, JoinNode, TableNode, ClosureNode, IntersectionNode
+
+COLUMN_WIDTH = 8            # Assumed bytes per column
+DEFAULT_SELECTIVITY = 0.1   # For conditions the statistics say nothing about
+DEFAULT_ROWS = 1000         # For tables the catalog has no statistics for
+CLOSURE_DEPTH = 10          # Assumed number of steps of a closure without a depth bound
+
+# rows: estimated number of rows, width: bytes per row, cost: estimated number of rows
+# read, joined and written to compute the node, values: column -> distinct values
+PlanEstimate = namedtuple("PlanEstimate", ["rows", "width", "cost", "values"])
+
+
+class CostModel():
+    """Estimates the plan trees of a compiled expression, from catalog statistics.
+       Temporary tables written by earlier plans are estimated from those plans."""
+
+    def __init__(self, catalog = None):
+        if catalog is None:
+            catalog = get_default_catalog()
+        self.catalog = catalog
+        self.temp_tables = {}   # table name -> (rows, { column: distinct values })
+
+    def estimate_plans(self, plans):
+        """Annotates every node of every plan with its estimate (node.estimate) and
+           returns the total cost"""
+
+        return sum(self.estimate(plan).cost for plan in plans)
+
+    def estimate(self, plan):
+        for node in plan.DepthFirstReversed():
+            node.estimate = self.estimate_node(node)
+        return plan.estimate
+
+    def estimate_node(self, node):
+        if isinstance(node, TableNode):
+            if node.tablename in self.temp_tables:
+                (rows, column_values) = self.temp_tables[node.tablename]
+            else:
+                table_statistics = self.catalog.get_table_statistics(node.tablename)
+                if table_statistics is None:
+                    table_statistics = (DEFAULT_ROWS, {})
+                (rows, column_values) = table_statistics
+            values = { ColSpec(node.tablealias, column): n_values for column, n_values in column_values.items() }
+            return PlanEstimate(rows, len(values) * COLUMN_WIDTH, rows, values)
+
+        children = [ child.estimate for child in node.get_children() ]
+        if isinstance(node, JoinNode):
+            # Cross product; the conditions above it make it a hash join
+            rows = 1
+            values = {}
+            for child in children:
+                rows *= child.rows
+                values.update(child.values)
+            cost = sum(child.cost + child.rows for child in children)
+            return PlanEstimate(rows, sum(child.width for child in children), cost, values)
+
+        child = children[0]
+        if isinstance(node, ConditionalNode):
+            selectivity = 1.0
+            for values in node.get_equivalence_classes():
+                selectivity *= get_class_selectivity(values, child.values)
+            rows = max(child.rows * selectivity, 1)
+            values = { column: min(n_values, rows) for column, n_values in child.values.items() }
+            return PlanEstimate(rows, child.width, child.cost + rows, values)
+        if isinstance(node, ProjectionNode):
+            values = { column: child.values.get(column, child.rows) for column in node.columns }
+            return PlanEstimate(child.rows, len(node.columns) * COLUMN_WIDTH, child.cost, values)
+        if isinstance(node, RenameNode):
+            values = { node.arguments.get(column, column): n_values for column, n_values in child.values.items() }
+            return PlanEstimate(child.rows, child.width, child.cost, values)
+        if isinstance(node, ClosureNode):
+            # Every step joins the pairs found in the previous step with the relation
+            # again; assume each step finds as many pairs as the relation has
+            depth = node.max_depth if node.max_depth is not None else CLOSURE_DEPTH
+            table = node.get_child(0).tablealias
+            n_domain_values = child.values.get(ColSpec(table, node.domain_column), child.rows)
+            n_codomain_values = child.values.get(ColSpec(table, node.codomain_column), child.rows)
+            rows = min(child.rows * depth, n_domain_values * n_codomain_values)
+            self.temp_tables[node.name] = (rows, { "domain": n_domain_values, "codomain": n_codomain_values })
+            return PlanEstimate(rows, 2 * COLUMN_WIDTH, child.cost + depth * (child.rows + rows), {})
+        if isinstance(node, IntersectionNode):
+            # At most as large as its smallest input; each input is read once
+            rows = min(child.rows for child in children)
+            column_values = {}
+            for name, n in [ ("domain", 0), ("codomain", 1) ]:
+                column_values[name] = min(child.values.get(ColSpec(table.tablealias, columns[n]), child.rows) for child, table, columns in zip(children, node.children, node.columns))
+            self.temp_tables[node.name] = (rows, column_values)
+            return PlanEstimate(rows, 2 * COLUMN_WIDTH, sum(child.cost + child.rows for child in children) + rows, {})
+        if isinstance(node, AssignNode):
+            # The temporary table is written, and can be read by the next plans
+            column_values = { get_column_name(column): n_values for column, n_values in child.values.items() }
+            self.temp_tables[node.name] = (child.rows, column_values)
+            return PlanEstimate(child.rows, child.width, child.cost + child.rows, child.values)
+        return child
+
+
+def get_class_selectivity(values, column_values):
+    """The selectivity of making all values (an equivalence class of a ConditionalNode)
+       equal. Equalities that follow from the others (a == c from a == b and b == c) are
+       not counted twice: a class of k values holds k - 1 independent equalities."""
+
+    n_values = sorted(max(column_values[value], 1) for value in values if value in column_values)
+    if len(n_values) == len(values):
+        # Only columns with statistics: the values of the column with the fewest are kept
+        n_values = n_values[1:]
+    selectivity = DEFAULT_SELECTIVITY ** (len(values) - 1 - len(n_values))
+    for n in n_values:
+        selectivity /= n
+    return selectivity
+
+
+def get_column_name(column):
+    if isinstance(column, ColSpec):
+        return column.column
+    return column
+
+
+def get_node_description(node):
+    if isinstance(node, AssignNode):
+        return ("Assign", node.name)
+    if isinstance(node, RenameNode):
+        return ("Rename", str(node))
+    if isinstance(node, ProjectionNode):
+        return ("Projection", str(node))
+    if isinstance(node, ConditionalNode):
+        return ("Conditional", str(node))
+    if isinstance(node, JoinNode):
+        return ("Join", "")
+    if isinstance(node, ClosureNode):
+        return ("Closure", node.name if node.max_depth is None else f"{node.name} depth {node.max_depth}")
+    if isinstance(node, IntersectionNode):
+        return ("Intersection", node.name)
+    if isinstance(node, TableNode):
+        return ("Table", str(node))
+    return (type(node).__name__, "")
+
+
+def explain_node(node):
+    """The annotated plan tree as nested dicts"""
+
+    results = {}
+    for subnode in node.DepthFirstReversed():
+        (node_type, detail) = get_node_description(subnode)
+        estimate = subnode.estimate
+        results[id(subnode)] = {
+            "node": node_type,
+            "detail": detail,
+            "rows": estimate.rows,
+            "width": estimate.width,
+            "cost": estimate.cost,
+            "children": [ results[id(child)] for child in subnode.get_children() ]
+        }
+    return results[id(node)]
+
+
+def explain(expression, catalog = None, is_fused = False, format = "text"):
+    """Compiles expression (a string or an InterParseTree) and shows the estimated plans,
+       as text or (with format = "json") as a JSON string"""
+
+    if isinstance(expression, str):
+        expression = InterParseTree(expression)
+    plans = expression.generate_plans(catalog, is_fused)
+    total_cost = CostModel(catalog).estimate_plans(plans)
+    explained = [ explain_node(plan) for plan in plans ]
+    if format == "json":
+        return json.dumps({ "cost": total_cost, "plans": explained }, indent = 2)
+
+    lines = []
+    for plan in explained:
+        stack = [ (plan, 0) ]
+        while stack:
+            (node, depth) = stack.pop()
+            detail = f" {node['detail']}" if node["detail"] else ""
+            lines.append(f"{'  ' * depth}{node['node']}{detail}  (rows={node['rows']:.0f} width={node['width']} cost={node['cost']:.0f})")
+            stack.extend((child, depth + 1) for child in reversed(node["children"]))
+    lines.append(f"Total cost: {total_cost:.0f}")
+    return "\n".join(lines)
+
+
+def choose_plans(expression, catalog = None):
+    """Compiles expression in every way the optimizer knows (as written and with the
+       compositions reordered, each with and without fusing) and returns the plans with
+       the lowest estimated cost, with that cost"""
+
+    if isinstance(expression, str):
+        expression = InterParseTree(expression)
+    reordered = InterParseTree(expression.expression).reorder_compositions(catalog)
+    best = None
+    for tree in (expression, reordered):
+        for is_fused in (False, True):
+            plans = tree.generate_plans(catalog, is_fused)
+            cost = CostModel(catalog).estimate_plans(plans)
+            if best is None or cost < best[1]:
+                best = (plans, cost)
+    return best
+
+
+def test_explain():
+    print(explain("o(onderdeel_van,ligt_in,woont_op)"))
+    print(explain("woont_op", format = "json"))
+    (plans, cost) = choose_plans("o(onderdeel_van,ligt_in,woont_op)")
+    print(cost, len(plans)) # The fused plan: a single statement
+
+
+if __name__ == "__main__":
+    test_explain()
@@ -0,0 +1,273 @@
+import os
+import queue
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from catalog import get_default_catalog
+from sqloptimizer4 import ConditionalNode, InterParseTree, Loop, gen_statements, simplify_plans
+
+DEFAULT_FETCH_SIZE = 1000
+
+select_into_pattern = re.compile(r"\s*(?P<with>WITH\b.*\)\s+)?SELECT\s+(?P<columns>.*?)\s+INTO\s+(?P<table>\w+)\s+(?P<rest>FROM\b.*?)\s*$", re.DOTALL | re.IGNORECASE)
+drop_pattern = re.compile(r"\s*DROP\s+TABLE\s+(?P<table>\w+)\s*$", re.IGNORECASE)
+
+
+def translate_statement(statement, keep_tables = ()):
+    """Translates [WITH ...] SELECT ... INTO table ... into SQLite's CREATE TEMP TABLE
+       table AS [WITH ...] SELECT ...; returns (statement, table), where table is None
+       for other statements. The tables in keep_tables are created as ordinary tables,
+       which other connections can read and which stay after the connection closes."""
+
+    match = select_into_pattern.match(statement)
+    if match is None:
+        return (statement, None)
+    table = match.group("table")
+    create = "CREATE TABLE" if table in keep_tables else "CREATE TEMP TABLE"
+    return (f"{create} {table} AS {match.group('with') or ''}SELECT {match.group('columns')} {match.group('rest')}", table)
+
+
+class ConnectionPool():
+    """A pool of at most max_size connections to an SQLite database file. Connections
+       are opened when they are first needed and reused after that."""
+
+    def __init__(self, database, max_size = 4):
+        self.database = database
+        self.max_size = max_size
+        self.connections = queue.LifoQueue()
+        self.n_connections = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.n_connections < self.max_size:
+                self.n_connections += 1
+                # Transactions are started and ended explicitly
+                return sqlite3.connect(self.database, isolation_level = None, check_same_thread = False)
+        return self.connections.get()
+
+    def release(self, connection):
+        self.connections.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.lock:
+            while True:
+                try:
+                    self.connections.get_nowait().close()
+                except queue.Empty:
+                    break
+                self.n_connections -= 1
+
+
+class SQLiteBackend():
+    """Runs compiled plans (the statements of generate_ralg_expr) against an SQLite
+       database, each plan in one transaction on a connection from the pool. The temporary
+       tables of a plan are dropped when its result has been read."""
+
+    def __init__(self, database, pool_size = 4, fetch_size = DEFAULT_FETCH_SIZE, catalog = None):
+        self.pool = ConnectionPool(database, pool_size)
+        self.fetch_size = fetch_size
+        self.catalog = catalog
+
+    def execute(self, statements, keep_tables = ()):
+        """Runs the statements and yields the rows of the last one that is not a DROP
+           TABLE (for SELECT ... INTO, the rows of the table it writes), fetched
+           fetch_size rows at a time. The DROP TABLE statements after it (see
+           gen_statements) are run before the rows are read. The tables in keep_tables are
+           written as ordinary tables, and are not dropped."""
+
+        n_result = len(statements) - 1
+        while n_result > 0 and not isinstance(statements[n_result], Loop) and drop_pattern.match(statements[n_result]):
+            n_result -= 1
+        connection = self.pool.acquire()
+        temp_tables = {}   # Used as an ordered set
+        try:
+            cursor = connection.cursor()
+            cursor.execute("BEGIN")
+            for statement in statements[:n_result]:
+                self.run_statement(cursor, statement, temp_tables, keep_tables)
+            if isinstance(statements[n_result], Loop):
+                self.run_statement(cursor, statements[n_result], temp_tables, keep_tables)
+                statement = f"SELECT * FROM {statements[n_result].name}"
+            else:
+                (statement, table) = translate_statement(statements[n_result], keep_tables)
+                if table is not None:
+                    cursor.execute(statement)
+                    if table not in keep_tables:
+                        temp_tables[table] = None
+                    statement = f"SELECT * FROM {table}"
+            for drop_statement in statements[n_result + 1:]:
+                self.run_statement(cursor, drop_statement, temp_tables, keep_tables)
+            cursor.execute(statement)
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield from rows
+            for table in reversed(list(temp_tables)):
+                cursor.execute(f"DROP TABLE {table}")
+            cursor.execute("COMMIT")
+        except BaseException:
+            # Also when the caller stops reading (GeneratorExit): the temporary tables
+            # are created in the transaction, so the rollback removes them as well
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        finally:
+            self.pool.release(connection)
+
+    def run_statement(self, cursor, statement, temp_tables, keep_tables = ()):
+        """Runs a statement, or all runs of a Loop, and keeps track of the temporary
+           tables that exist"""
+
+        if isinstance(statement, Loop):
+            n_iterations = 0
+            while statement.max_iterations is None or n_iterations < statement.max_iterations:
+                for loop_statement in statement.statements:
+                    self.run_statement(cursor, loop_statement, temp_tables, keep_tables)
+                n_iterations += 1
+                if cursor.execute(f"SELECT 1 FROM {statement.table} LIMIT 1").fetchone() is None:
+                    break
+            return
+        (translated, table) = translate_statement(statement, keep_tables)
+        cursor.execute(translated)
+        if table is not None and table not in keep_tables:
+            temp_tables[table] = None
+        match = drop_pattern.match(statement)
+        if match is not None:
+            temp_tables.pop(match.group("table"), None)
+
+    def execute_plans(self, plans, is_dropped = True):
+        """Simplifies the conditions of the plans (of InterParseTree.generate_plans) and
+           yields the rows of their result. When the result is known to be empty, nothing
+           is sent to the database. With is_dropped the temporary tables are dropped right
+           after their last use instead of at the end (see gen_statements)."""
+
+        if simplify_plans(plans):
+            return iter(())
+        return self.execute(gen_statements(plans, is_dropped))
+
+    def execute_expression(self, expression, is_fused = False, is_recursive = True):
+        """Compiles an expression string and yields the rows of its result"""
+
+        return self.execute_plans(InterParseTree(expression).generate_plans(self.catalog, is_fused, is_recursive))
+
+    def time_expression(self, expression, is_fused = False):
+        """(number of result rows, compile seconds, execute seconds) of an expression"""
+
+        start = time.perf_counter()
+        plans = InterParseTree(expression).generate_plans(self.catalog, is_fused)
+        compiled = time.perf_counter()
+        n_rows = sum(1 for row in self.execute_plans(plans))
+        return (n_rows, compiled - start, time.perf_counter() - compiled)
+
+    def close(self):
+        self.pool.close()
+
+
+def create_tables(connection, catalog = None, n_rows = 1000, n_values = None, seed = 0):
+    """Creates the tables of the relations in the catalog, with n_rows random rows each
+       whose columns take n_values (default: n_rows / 2) values, and indexes on the
+       indexed columns"""
+
+    if catalog is None:
+        catalog = get_default_catalog()
+    if n_values is None:
+        n_values = max(n_rows // 2, 1)
+    rng = random.Random(seed)
+    for table, names in sorted(catalog.table_relations.items()):
+        columns = []
+        for name in sorted(names):
+            relation = catalog.get_relation(name)
+            columns.extend(column for column in (relation.domain_column, relation.codomain_column) if column not in columns)
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+        rows = [ tuple(rng.randrange(n_values) for column in columns) for n in range(n_rows) ]
+        connection.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})", rows)
+        for column in sorted(catalog.indexes.get(table, ())):
+            connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})")
+    connection.commit()
+
+
+def test_sqlite_backend():
+    print(translate_statement("SELECT X1.domain AS domain INTO T4 FROM T3 AS X0 JOIN T1 AS X1 WHERE (X0.domain == X1.codomain)")[0])
+
+    (handle, path) = tempfile.mkstemp(suffix = ".db")
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(path)
+        create_tables(connection, n_rows = 2000)
+        connection.close()
+
+        backend = SQLiteBackend(path, pool_size = 2)
+        expression = "o(onderdeel_van,ligt_in,woont_op)"
+        rows = sorted(backend.execute_expression(expression))
+        fused_rows = sorted(backend.execute_expression(expression, is_fused = True))
+        print(len(rows), rows == fused_rows) # Both ways of compiling give the same result
+        for row in backend.execute_expression(expression):
+            break   # Stops reading: the transaction is rolled back
+        print(len(list(backend.execute_expression(expression)))) # The temp tables are gone again
+        print(backend.time_expression(expression))
+        print(backend.pool.n_connections) # Should be 1: the connection is reused
+        plans = InterParseTree(expression).generate_plans()
+        projection = plans[0].get_child(0).get_child(0)
+        projection.children[0] = ConditionalNode(projection.get_child(0))
+        projection.get_child(0).add_conditions([ "a" ], [ "b" ])
+        print(list(backend.execute_plans(plans))) # Should be []: the statements are not run
+
+        for (expression, is_recursive) in [ ("o(i(onderdeel_van,ligt_in),woont_op)", True), ("c(o(ligt_in,woont_op),2)", False) ]:
+            statements = InterParseTree(expression).generate_ralg_expr(is_recursive = is_recursive, is_dropped = True)
+            with backend.pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute("BEGIN")
+                temp_tables = {}
+                for statement in statements:
+                    backend.run_statement(cursor, statement, temp_tables)
+                print(list(temp_tables)) # Should be only the result: T7, then T4
+                connection.rollback()
+            print(sorted(backend.execute(statements)) == sorted(backend.execute_expression(expression, is_recursive = is_recursive)))
+
+        backend.close()
+    finally:
+        os.remove(path)
+
+
+def test_closure():
+    (handle, path) = tempfile.mkstemp(suffix = ".db")
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(path)
+        create_tables(connection, n_rows = 300, n_values = 400)   # Sparse, so the closures stay small
+        connection.close()
+
+        backend = SQLiteBackend(path, pool_size = 1)
+        for expression in [ "c(onderdeel_van)", "c(o(ligt_in,woont_op),2)" ]:
+            rows = sorted(backend.execute_expression(expression))
+            loop_rows = sorted(backend.execute_expression(expression, is_recursive = False))
+            print(len(rows), rows == loop_rows) # WITH RECURSIVE and the Loop give the same result
+        rows = set(backend.execute_expression("c(ligt_in,3)"))
+        unrolled_rows = set(backend.execute_expression("ligt_in")) | set(backend.execute_expression("o(ligt_in,ligt_in)")) | set(backend.execute_expression("o(ligt_in,ligt_in,ligt_in)"))
+        print(rows == unrolled_rows) # The closure of depth 3 is r | o(r,r) | o(r,r,r)
+        backend.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    test_sqlite_backend()
+    test_closure()
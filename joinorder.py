@@ -0,0 +1,131 @@
+import math
+from collections import namedtuple
+
+# Estimated number of rows, and of distinct values in the domain and codomain columns
+Estimate = namedtuple("Estimate", ["rows", "domain_values", "codomain_values"])
+
+
+class ChainEstimates():
+    """Estimates for the sub-chains i..j of a composition chain. The selectivity of every
+       join is taken from the distinct counts of the base relations, so the estimate of a
+       sub-chain does not depend on its association; this is what makes the dynamic
+       programming in order_chain exact."""
+
+    def __init__(self, estimates):
+        self.estimates = estimates
+        self.log_rows = [ 0.0 ]
+        self.log_selectivities = [ 0.0 ]
+        for n, estimate in enumerate(estimates):
+            self.log_rows.append(self.log_rows[-1] + math.log(max(estimate.rows, 1)))
+            if n + 1 < len(estimates):
+                join_values = max(estimate.domain_values, estimates[n + 1].codomain_values, 1)
+                self.log_selectivities.append(self.log_selectivities[-1] + math.log(join_values))
+
+    def get_estimate(self, i, j):
+        if i == j:
+            return self.estimates[i]
+        log_rows = self.log_rows[j + 1] - self.log_rows[i] - (self.log_selectivities[j] - self.log_selectivities[i])
+        rows = math.exp(min(max(log_rows, 0.0), 700.0))
+        return Estimate(rows, min(self.estimates[j].domain_values, rows), min(self.estimates[i].codomain_values, rows))
+
+
+def order_chain(estimates, max_dp_size = 64):
+    """Chooses the association of the composition chain o(R0, R1, ..., Rn-1) that writes
+       the fewest intermediate rows. Returns (plan, estimate, cost), where plan is an
+       index for a single relation or a (left plan, right plan) tuple.
+
+       Chains of at most max_dp_size relations are solved exactly by dynamic programming
+       over the sub-chains, like matrix chain ordering (O(n^3)). Longer chains are solved
+       greedily by repeatedly composing the adjacent pair with the smallest result."""
+
+    chain = ChainEstimates(estimates)
+    if len(estimates) <= max_dp_size:
+        return order_chain_dp(chain)
+    return order_chain_greedy(chain)
+
+
+def order_chain_dp(chain):
+
+    n = len(chain.estimates)
+    # costs[i][j], splits[i][j]: the cost and split point of the best plan for i..j
+    costs = [ [ 0.0 ] * n for _ in range(n) ]
+    splits = [ [ None ] * n for _ in range(n) ]
+    for length in range(2, n + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            best_cost = None
+            for k in range(i, j):
+                cost = costs[i][k] + costs[k + 1][j]
+                if best_cost is None or cost < best_cost:
+                    best_cost = cost
+                    splits[i][j] = k
+            costs[i][j] = best_cost + chain.get_estimate(i, j).rows
+
+    plans = {}
+    stack = [ (0, n - 1, False) ]
+    while stack:
+        (i, j, is_visited) = stack.pop()
+        split = splits[i][j]
+        if split is None:
+            plans[(i, j)] = i
+        elif is_visited:
+            plans[(i, j)] = (plans[(i, split)], plans[(split + 1, j)])
+        else:
+            stack.append((i, j, True))
+            stack.append((i, split, False))
+            stack.append((split + 1, j, False))
+    return (plans[(0, n - 1)], chain.get_estimate(0, n - 1), costs[0][n - 1])
+
+
+def order_chain_greedy(chain):
+
+    parts = [ (n, n, n) for n in range(len(chain.estimates)) ]   # (plan, first, last)
+    cost = 0.0
+    while len(parts) > 1:
+        best_index = None
+        for n in range(len(parts) - 1):
+            rows = chain.get_estimate(parts[n][1], parts[n + 1][2]).rows
+            if best_index is None or rows < best_rows:
+                best_index = n
+                best_rows = rows
+        cost += best_rows
+        (left, right) = parts[best_index:best_index + 2]
+        parts[best_index:best_index + 2] = [ ((left[0], right[0]), left[1], right[2]) ]
+    return (parts[0][0], chain.get_estimate(0, len(chain.estimates) - 1), cost)
+
+
+def chain_cost(estimates, plan):
+    """The cost of a given plan, for comparing it with the one order_chain chooses"""
+
+    chain = ChainEstimates(estimates)
+    results = {}   # id(subplan) -> (first, last, cost)
+    stack = [ (plan, False) ]
+    while stack:
+        (subplan, is_visited) = stack.pop()
+        if not isinstance(subplan, tuple):
+            results[id(subplan)] = (subplan, subplan, 0.0)
+        elif is_visited:
+            (first, _, left_cost) = results[id(subplan[0])]
+            (_, last, right_cost) = results[id(subplan[1])]
+            cost = left_cost + right_cost + chain.get_estimate(first, last).rows
+            results[id(subplan)] = (first, last, cost)
+        else:
+            stack.append((subplan, True))
+            stack.append((subplan[0], False))
+            stack.append((subplan[1], False))
+    return results[id(plan)][2]
+
+
+def test_order_chain():
+    persons = Estimate(17000000, 17000000, 8000000)
+    addresses = Estimate(8000000, 8000000, 350)
+    municipalities = Estimate(350, 350, 12)
+    estimates = [ municipalities, addresses, persons ]
+    (plan, estimate, cost) = order_chain(estimates)
+    print(plan, estimate, cost) # Should be ((0, 1), 2): municipality and address first
+    print(chain_cost(estimates, (0, (1, 2))))
+    print(order_chain([ persons ] * 200)[2])
+
+
+if __name__ == "__main__":
+    test_order_chain()
@@ -0,0 +1,301 @@
+import itertools
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+
+from catalog import Catalog, get_default_catalog
+from execution import SQLiteBackend, create_tables
+from sqloptimizer4 import InterParseTree, AssignNode, ClosureNode, IntersectionNode, ParseTreeNode, TableNode, canonicalize, gen_statements
+
+TABLE_PREFIX = "M_"
+
+# table: the table that holds the result, args: the digests of the arguments of a
+# composition (to find it inside longer chains), None for other operators, changes:
+# table -> catalog.table_changes of the base tables it was computed from, rows: its size
+CacheEntry = namedtuple("CacheEntry", ["table", "args", "changes", "rows"])
+
+run_ids = itertools.count()
+
+
+class MaterializedCatalog():
+    """A catalog in which the tables of the cache entries are relations as well, with
+       the columns domain and codomain. Everything else is read from catalog."""
+
+    def __init__(self, catalog, tables):
+        self.catalog = catalog
+        self.tables = tables
+
+    def get_design(self, name):
+        if name in self.tables:
+            return (name, "domain", "codomain")
+        return self.catalog.get_design(name)
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+
+class MaterializedCache():
+    """Keeps the results of (sub)expressions in tables of the database of backend, so
+       later expressions that contain the same subexpression read its table instead of
+       computing it again. Subexpressions are found by the fingerprint of their canonical
+       tree (see canonicalize); a composition is also found inside a longer composition
+       chain, as a run of consecutive arguments.
+
+       Tables are dropped when there are more than max_entries of them or they hold more
+       than max_rows (None: no limit) rows together, least recently used first, and when
+       one of the base tables they were computed from is marked changed in the catalog
+       (catalog.mark_changed).
+
+       A run writes its tables under names of its own, which are renamed to the tables
+       of the entries under the lock; when another run added the same entry first, the
+       table of this run is dropped instead."""
+
+    def __init__(self, backend, catalog = None, max_entries = 64, max_rows = None):
+        self.backend = backend
+        self.catalog = catalog if catalog is not None else backend.catalog
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()   # fingerprint -> CacheEntry
+        self.chain_starts = {}         # digest of the first argument -> { fingerprints of compositions }
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_catalog(self):
+        if self.catalog is None:
+            return get_default_catalog()
+        return self.catalog
+
+    def is_valid(self, entry):
+        table_changes = self.get_catalog().table_changes
+        return all(table_changes.get(table, 0) == n_changes for table, n_changes in entry.changes.items())
+
+    def lookup(self, fingerprint):
+        """The entry for fingerprint, or None; an entry whose base tables changed is
+           dropped. Must be called with the lock held."""
+
+        entry = self.entries.get(fingerprint)
+        if entry is None:
+            return None
+        if not self.is_valid(entry):
+            self.remove(fingerprint)
+            self.invalidations += 1
+            return None
+        self.entries.move_to_end(fingerprint)
+        return entry
+
+    def remove(self, fingerprint):
+        """Forgets an entry and drops its table. Must be called with the lock held."""
+
+        entry = self.entries.pop(fingerprint)
+        if entry.args is not None:
+            fingerprints = self.chain_starts[entry.args[0]]
+            fingerprints.discard(fingerprint)
+            if not fingerprints:
+                del self.chain_starts[entry.args[0]]
+        with self.backend.pool.connection() as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {entry.table}")
+
+    def replace_runs(self, args, arg_digests, base_tables):
+        """Replaces the runs of consecutive arguments of a composition that are cached
+           by the tables that hold them, longest run first"""
+
+        result = []
+        n = 0
+        while n < len(args):
+            best = None
+            for fingerprint in list(self.chain_starts.get(arg_digests[n], ())):
+                run = self.entries[fingerprint].args
+                if len(run) < len(args) and tuple(arg_digests[n:n + len(run)]) == run and (best is None or len(run) > len(best[1].args)):
+                    entry = self.lookup(fingerprint)
+                    if entry is not None:
+                        best = (fingerprint, entry)
+            if best is None:
+                result.append(args[n])
+                n += 1
+            else:
+                self.hits += 1
+                result.append(ParseTreeNode(best[1].table, []))
+                base_tables[id(result[-1])] = set(best[1].changes)
+                n += len(best[1].args)
+        return result
+
+    def prepare(self, expression):
+        """Compiles expression against the cache: returns (plans, new entries), where
+           the new entries are (fingerprint, CacheEntry) of the subexpressions the plans
+           compute (with rows still None, and the table the plans write for this run)"""
+
+        catalog = self.get_catalog()
+        tree = InterParseTree(expression)
+        digests = {}
+        (root, _) = canonicalize(tree.root, digests)
+
+        results = {}       # id(canonical node) -> node to compile
+        base_tables = {}   # id(node to compile) -> the base tables it reads
+        computed = []      # (node to compile, canonical node) of the operators
+        with self.lock:
+            stack = [ (root, False) ]
+            while stack:
+                (node, is_visited) = stack.pop()
+                if not node.children:
+                    if node.data.isdigit():
+                        base_tables[id(node)] = set()
+                    else:
+                        base_tables[id(node)] = { catalog.get_relation(node.data).table }
+                    results[id(node)] = node
+                elif not is_visited:
+                    entry = self.lookup(digests[id(node)].hex())
+                    if entry is None:
+                        stack.append((node, True))
+                        stack.extend((child, False) for child in node.children)
+                    else:
+                        self.hits += 1
+                        results[id(node)] = ParseTreeNode(entry.table, [])
+                        base_tables[id(results[id(node)])] = set(entry.changes)
+                else:
+                    self.misses += 1
+                    args = [ results[id(child)] for child in node.children ]
+                    if node.data == "o":
+                        args = self.replace_runs(args, [ digests[id(child)] for child in node.children ], base_tables)
+                    compiled = ParseTreeNode(node.data, args)
+                    base_tables[id(compiled)] = set().union(*(base_tables[id(arg)] for arg in args))
+                    results[id(node)] = compiled
+                    computed.append((compiled, node))
+            cached_tables = { entry.table for entry in self.entries.values() }
+
+        tree.root = results[id(root)]
+        tablenames = {}
+        plans = tree.generate_plans(MaterializedCatalog(catalog, cached_tables), tablenames = tablenames)
+
+        table_changes = catalog.table_changes
+        new_entries = []
+        renames = {}
+        run = f"_{os.getpid()}_{next(run_ids)}"
+        for (compiled, node) in computed:
+            fingerprint = digests[id(node)].hex()
+            table = TABLE_PREFIX + fingerprint + run
+            renames[tablenames[id(compiled)]] = table
+            args = tuple(digests[id(child)] for child in node.children) if node.data == "o" else None
+            changes = { base_table: table_changes.get(base_table, 0) for base_table in base_tables[id(compiled)] }
+            new_entries.append((fingerprint, CacheEntry(table, args, changes, None)))
+        for plan in plans:
+            for plan_node in plan.DepthFirst():
+                if isinstance(plan_node, TableNode) and plan_node.tablename in renames:
+                    plan_node.tablename = renames[plan_node.tablename]
+                elif isinstance(plan_node, (AssignNode, ClosureNode, IntersectionNode)) and plan_node.name in renames:
+                    plan_node.name = renames[plan_node.name]
+        return (plans, new_entries)
+
+    def execute(self, expression):
+        """Computes expression, reusing and adding cache entries; returns the rows of
+           its result as a list"""
+
+        return self.execute_prepared(*self.prepare(expression))
+
+    def execute_prepared(self, plans, new_entries):
+        """Runs the plans of prepare and adds its new entries; returns the rows of the
+           result as a list"""
+
+        keep_tables = { entry.table for (_, entry) in new_entries }
+        rows = list(self.backend.execute(gen_statements(plans), keep_tables))
+
+        with self.backend.pool.connection() as connection:
+            new_entries = [ (fingerprint, entry._replace(rows = connection.execute(f"SELECT COUNT(*) FROM {entry.table}").fetchone()[0])) for (fingerprint, entry) in new_entries ]
+            with self.lock:
+                for fingerprint, entry in new_entries:
+                    if self.lookup(fingerprint) is not None:
+                        # Computed by another run at the same time, which added it first
+                        connection.execute(f"DROP TABLE {entry.table}")
+                        continue
+                    table = TABLE_PREFIX + fingerprint
+                    connection.execute(f"ALTER TABLE {entry.table} RENAME TO {table}")
+                    self.entries[fingerprint] = entry._replace(table = table)
+                    if entry.args is not None:
+                        self.chain_starts.setdefault(entry.args[0], set()).add(fingerprint)
+                self.evict()
+        return rows
+
+    def evict(self):
+        """Drops the least recently used entries until the cache is within its limits.
+           Must be called with the lock held."""
+
+        n_rows = sum(entry.rows for entry in self.entries.values())
+        while self.entries and (len(self.entries) > self.max_entries or (self.max_rows is not None and n_rows > self.max_rows)):
+            fingerprint = next(iter(self.entries))
+            n_rows -= self.entries[fingerprint].rows
+            self.remove(fingerprint)
+            self.evictions += 1
+
+    def invalidate(self):
+        """Drops the entries whose base tables changed"""
+
+        with self.lock:
+            for fingerprint, entry in list(self.entries.items()):
+                if not self.is_valid(entry):
+                    self.remove(fingerprint)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            for fingerprint in list(self.entries):
+                self.remove(fingerprint)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "rows": sum(entry.rows for entry in self.entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+def test_materialized_cache():
+    (handle, path) = tempfile.mkstemp(suffix = ".db")
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(path)
+        create_tables(connection, n_rows = 500)
+        connection.close()
+
+        catalog = Catalog.from_dict(get_default_catalog().to_dict())
+        backend = SQLiteBackend(path, pool_size = 2, catalog = catalog)
+        cache = MaterializedCache(backend, max_entries = 3)
+        expected = sorted(backend.execute_expression("o(onderdeel_van,ligt_in,woont_op)"))
+
+        cache.execute("o(ligt_in,woont_op)")
+        (plans, new_entries) = cache.prepare("o(onderdeel_van,o(ligt_in,woont_op))")
+        print(len(new_entries), gen_statements(plans)[-1]) # Joins the table of o(ligt_in,woont_op)
+        print(sorted(cache.execute("o(onderdeel_van,o(ligt_in,woont_op))")) == expected)
+        print(sorted(cache.execute("o(o(onderdeel_van,ligt_in),woont_op)")) == expected) # The same canonical expression: a hit
+        print(cache.get_stats())
+
+        catalog.mark_changed("tbl_persoon")
+        cache.invalidate()
+        print(cache.get_stats()) # Both entries read tbl_persoon: dropped
+        for expression in [ "i(ligt_in,woont_op)", "c(onderdeel_van,2)", "o(onderdeel_van,ligt_in)", "o(ligt_in,onderdeel_van)", "o(ligt_in,ligt_in)" ]:
+            cache.execute(expression)
+        print(cache.get_stats()) # One entry evicted
+
+        # Two runs that both miss i(c(ligt_in),ligt_in): the one that ends last keeps the
+        # entries of the first, and drops only its own tables
+        runs = [ cache.prepare("i(c(ligt_in),ligt_in)") for n in range(2) ]
+        expected = sorted(backend.execute_expression("i(c(ligt_in),ligt_in)"))
+        print([ sorted(cache.execute_prepared(*run)) == expected for run in runs ], cache.get_stats()["misses"]) # Should be [True, True] 12
+        print(sorted(cache.execute("c(ligt_in)")) == sorted(backend.execute_expression("c(ligt_in)")), cache.get_stats()["hits"]) # A hit: 4
+        with backend.pool.connection() as connection:
+            print(sorted(name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'") if name.startswith(TABLE_PREFIX)) == sorted(entry.table for entry in cache.entries.values()))
+        cache.clear()
+        backend.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    test_materialized_cache()
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# The number of profiles that are active in any thread. The instrumented code checks
+# this before doing anything else, so profiling costs one global lookup when it is off.
+n_active = 0
+
+local = threading.local()   # local.profiles: the active profiles of a thread
+lock = threading.Lock()
+hooks = []
+null_context = nullcontext()
+
+
+class Profile():
+    """Wall time and number of calls per phase, and counters, of the optimizer code that
+       ran while the profile was active"""
+
+    def __init__(self):
+        self.timings = {}         # phase -> [ seconds, calls ]
+        self.counters = Counter()
+
+    def add_timing(self, phase, seconds):
+        timing = self.timings.setdefault(phase, [ 0.0, 0 ])
+        timing[0] += seconds
+        timing[1] += 1
+
+    def to_dict(self):
+        """Flat metric name -> value, e.g. for exporting to a metrics system"""
+
+        metrics = {}
+        for phase, (seconds, calls) in self.timings.items():
+            metrics[f"{phase}.seconds"] = seconds
+            metrics[f"{phase}.calls"] = calls
+        metrics.update(self.counters)
+        return metrics
+
+    def __str__(self):
+        lines = [ f"{phase:24} {seconds * 1000:10.3f} ms {calls:8} calls" for phase, (seconds, calls) in self.timings.items() ]
+        lines.extend(f"{name:24} {count:10}" for name, count in self.counters.most_common())
+        return "\n".join(lines)
+
+
+def get_profiles():
+    return getattr(local, "profiles", [])
+
+
+@contextmanager
+def profile(callback = None):
+    """Profiles the optimizer code this thread runs within the with block:
+
+           with profiling.profile() as p:
+               InterParseTree(expression).generate_ralg_expr()
+           print(p.to_dict())
+
+       When the block ends, callback (if given) and the hooks of add_hook are called with
+       the profile."""
+
+    global n_active
+    result = Profile()
+    if not hasattr(local, "profiles"):
+        local.profiles = []
+    local.profiles.append(result)
+    with lock:
+        n_active += 1
+    try:
+        yield result
+    finally:
+        with lock:
+            n_active -= 1
+        local.profiles.remove(result)
+        for hook in ([ callback ] if callback else []) + hooks:
+            hook(result)
+
+
+def add_hook(hook):
+    """Calls hook(profile) at the end of every profile() block"""
+
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def count(name, n = 1):
+    """Adds n to a counter of the active profiles. In hot code, check n_active first:
+       if profiling.n_active: profiling.count(...)"""
+
+    if n_active:
+        for active_profile in get_profiles():
+            active_profile.counters[name] += n
+
+
+def maximum(name, value):
+    """Sets a counter of the active profiles to value if that is larger, for metrics
+       such as a peak"""
+
+    if n_active:
+        for active_profile in get_profiles():
+            active_profile.counters[name] = max(active_profile.counters[name], value)
+
+
+@contextmanager
+def timing(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for active_profile in get_profiles():
+            active_profile.add_timing(phase, seconds)
+
+
+def timed(phase):
+    """Context manager that adds the wall time of the with block to a phase of the active
+       profiles; does nothing when no profile is active"""
+
+    if n_active and get_profiles():
+        return timing(phase)
+    return null_context
+
+
+def test_profiling():
+    import SQLoptimizer
+    from benchmark import ExpressionGenerator
+    from sqloptimizer4 import InterParseTree
+
+    collected = []
+    add_hook(collected.append)
+    with profile() as p:
+        InterParseTree("o(onderdeel_van,ligt_in,woont_op)").generate_ralg_expr()
+    remove_hook(collected.append)
+    print(p)
+    print(collected[0] is p)
+
+    expr = ExpressionGenerator().select_stack(20, 3)
+    with profile(lambda cleanup_profile: print(cleanup_profile.to_dict())):
+        SQLoptimizer.cleanup_expr(expr, SQLoptimizer.canonical_select_stmt)
+
+    InterParseTree("woont_op").generate_ralg_expr()   # Not profiled
+    print(p.timings["parse"][1]) # Should still be 1
+
+    start = time.perf_counter()
+    for n in range(100000):
+        with timed("parse"):
+            pass
+    print(f"{(time.perf_counter() - start) * 10:.3f} us per disabled timed block")
+
+
+if __name__ == "__main__":
+    # The optimizer modules import this file as profiling, not as __main__
+    import profiling
+    profiling.test_profiling()
@@ -0,0 +1,199 @@
+from collections import Counter
+
+from sqloptimizer4 import InterParseTree, ColSpec, RenameNode, ProjectionNode, ConditionalNode, JoinNode, TableNode, gen_select_stmt, make_select_expr, make_comp_expr
+
+
+def get_table_reads(plans):
+    """Table name -> the number of times the plans read it"""
+
+    return Counter(node.tablename for plan in plans for node in plan.DepthFirst() if isinstance(node, TableNode))
+
+
+def get_source_colspec(plan, column):
+    """Follows an output column of plan back through its rename and projection to the
+       column of its input, the way ConditionalNode.combine follows renames"""
+
+    expr = plan.get_child(0)
+    if isinstance(expr, RenameNode):
+        for colspec, alias in expr.arguments.items():
+            if alias == column:
+                return colspec
+        expr = expr.get_child(0)
+    if isinstance(expr, ProjectionNode):
+        for colspec in expr.columns:
+            if colspec.column == column:
+                return colspec
+    return None
+
+
+def get_conditional(plan):
+    """The ConditionalNode of plan; one is added below its projection if it has none"""
+
+    parent = plan
+    while isinstance(parent.get_child(0), (RenameNode, ProjectionNode)):
+        parent = parent.get_child(0)
+    if not isinstance(parent.get_child(0), ConditionalNode):
+        parent.children[0] = ConditionalNode(parent.get_child(0))
+    return parent.get_child(0)
+
+
+def get_source_value(plan, value, alias):
+    if isinstance(value, ColSpec) and value.table == alias:
+        return get_source_colspec(plan, value.column)
+    return value
+
+
+def push_down_conditions(plans):
+    """Splits the conditions of every ConditionalNode and moves those that only refer to
+       one input below the join: into the plan that writes that input if nothing else
+       reads it, and otherwise onto the input itself. Plans are handled last to first, so
+       a moved condition can move on into the plans before it. Returns the number of
+       conditions that were moved."""
+
+    producers = { plan.name: plan for plan in plans }
+    table_reads = get_table_reads(plans)
+    n_moved = 0
+    for plan in reversed(plans):
+        for node in list(plan.DepthFirst()):
+            if not isinstance(node, ConditionalNode):
+                continue
+            source = node.get_child(0)
+            if isinstance(source, JoinNode):
+                inputs = source.get_children()
+            else:
+                inputs = [ source ]
+            input_indexes = {}
+            for n, table in enumerate(inputs):
+                if isinstance(table, ConditionalNode) and source is not table:
+                    table = table.get_child(0)
+                if isinstance(table, TableNode):
+                    input_indexes[table.tablealias] = n
+
+            lvalues = []
+            rvalues = []
+            for lvalue, rvalue in node.conditions:
+                aliases = { value.table for value in (lvalue, rvalue) if isinstance(value, ColSpec) }
+                if len(aliases) == 1 and next(iter(aliases)) in input_indexes:
+                    alias = aliases.pop()
+                    n = input_indexes[alias]
+                    table = inputs[n]
+                    if isinstance(table, ConditionalNode):
+                        table = table.get_child(0)
+                    producer = producers.get(table.tablename)
+                    if producer is not None and producer is not plan and table_reads[table.tablename] == 1:
+                        source_lvalue = get_source_value(producer, lvalue, alias)
+                        source_rvalue = get_source_value(producer, rvalue, alias)
+                        if source_lvalue is not None and source_rvalue is not None:
+                            producer_conditional = get_conditional(producer)
+                            producer_conditional.add_condition(source_lvalue, source_rvalue)
+                            n_moved += 1
+                            continue
+                    if isinstance(source, JoinNode):
+                        if not isinstance(inputs[n], ConditionalNode):
+                            source.children[n] = ConditionalNode(inputs[n])
+                        source.children[n].add_condition(lvalue, rvalue)
+                        n_moved += 1
+                        continue
+                lvalues.append(lvalue)
+                rvalues.append(rvalue)
+            node.add_conditions(lvalues, rvalues)
+    return n_moved
+
+
+def find_plan_node(plan, node_class):
+
+    for node in plan.DepthFirst():
+        if isinstance(node, node_class):
+            return node
+    return None
+
+
+def get_output_column(rename, colspec):
+    if rename is not None and colspec in rename.arguments:
+        return rename.arguments[colspec]
+    return colspec.column
+
+
+def get_read_columns(plan):
+    """Table name -> the set of columns plan reads from it, or None if it reads them all"""
+
+    aliases = {}
+    for node in plan.DepthFirst():
+        if isinstance(node, TableNode):
+            aliases[node.tablealias] = node.tablename
+    projection = find_plan_node(plan, ProjectionNode)
+    if projection is None:
+        return { tablename: None for tablename in aliases.values() }
+
+    read_columns = { tablename: set() for tablename in aliases.values() }
+    colspecs = list(projection.columns)
+    for node in plan.DepthFirst():
+        if isinstance(node, ConditionalNode):
+            colspecs.extend(value for condition in node.conditions for value in condition if isinstance(value, ColSpec))
+    for colspec in colspecs:
+        if colspec.table in aliases:
+            read_columns[aliases[colspec.table]].add(colspec.column)
+    return read_columns
+
+
+def prune_columns(plans):
+    """Removes the columns that no later plan reads from the projections (and renames) of
+       the plans that write temp tables, so every table only holds columns that are used.
+       The last plan is the result and keeps its columns. Returns the number of removed
+       columns."""
+
+    producers = { plan.name: plan for plan in plans }
+    required = {}   # table name -> columns read from it so far, None for all
+    n_removed = 0
+    for n, plan in enumerate(reversed(plans)):
+        if n > 0 and plan.name in required and required[plan.name] is not None:
+            rename = plan.get_child(0) if isinstance(plan.get_child(0), RenameNode) else None
+            projection = find_plan_node(plan, ProjectionNode)
+            if projection is not None:
+                needed = required[plan.name]
+                columns = { colspec: None for colspec in projection.columns if get_output_column(rename, colspec) in needed }
+                if columns:
+                    n_removed += len(projection.columns) - len(columns)
+                    projection.columns = columns
+                    if rename is not None:
+                        rename.arguments = { colspec: alias for colspec, alias in rename.arguments.items() if colspec in columns }
+        for tablename, columns in get_read_columns(plan).items():
+            if tablename not in producers:
+                continue
+            if columns is None or (tablename in required and required[tablename] is None):
+                required[tablename] = None
+            else:
+                required.setdefault(tablename, set()).update(columns)
+    return n_removed
+
+
+def test_push_down_conditions():
+    plans = InterParseTree("o(ligt_in,woont_op)").generate_plans()
+    conditional = plans[-1].get_child(0).get_child(0).get_child(0)
+    conditional.add_condition(ColSpec("X0", "codomain"), 5)
+    conditional.add_condition(ColSpec("X1", "domain"), ColSpec("X1", "codomain"))
+    print(push_down_conditions(plans)) # Should be 2
+    for plan in plans:
+        print(gen_select_stmt(plan)) # The conditions are moved into the SELECTs INTO T1 and T3
+
+    plans = InterParseTree("o(ligt_in,woont_op)").generate_plans(is_fused = True)
+    conditional = plans[-1].get_child(0).get_child(0).get_child(0)
+    conditional.add_condition(ColSpec("X0", "gemeente_id"), 5)
+    print(push_down_conditions(plans))
+    print(gen_select_stmt(plans[0])) # The condition is moved onto tbl_ades
+
+
+def test_prune_columns():
+    plans = [
+        make_select_expr(["persoons_id", "adres_id", "geboortedatum"], ["domain", "codomain", None], "T1", "tbl_persoon", "T0"),
+        make_select_expr(["adres_id", "gemeente_id", "straat"], ["domain", "codomain", None], "T3", "tbl_ades", "T2"),
+        make_comp_expr("T4", ["T3", "T1"])
+    ]
+    print(prune_columns(plans)) # Should be 2: geboortedatum and straat are not read
+    for plan in plans:
+        print(gen_select_stmt(plan))
+
+
+if __name__ == "__main__":
+    test_push_down_conditions()
+    test_prune_columns()
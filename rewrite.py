@@ -0,0 +1,276 @@
+import time
+from collections import Counter, deque
+
+import SQLoptimizer
+import profiling
+from sqloptimizer4 import InterParseTree, NodeType, ParseTreeNode, format_expression, get_fingerprint
+
+
+class Rule():
+    """A rewrite rule: it matches the nodes of node_type (a NodeType flag, which can
+       combine several types) that have a child of child_type (if given), and replace(node)
+       returns the node to put in its place, or None if the node does not match after all.
+
+       replace must not change node. It may read the whole subtree, but a rule should
+       only depend on node and its children: after a rewrite the engine only checks the
+       new nodes, their parent and their children again."""
+
+    def __init__(self, name, node_type, replace, child_type = None):
+        self.name = name
+        self.node_type = node_type
+        self.replace = replace
+        self.child_type = child_type
+
+
+def set_child(parent, index, child):
+    if hasattr(parent, "set_child"):
+        parent.set_child(index, child)   # Also sets the parent of an SQLoptimizer node
+    else:
+        parent.children[index] = child
+
+
+class RuleEngine():
+    """Rewrites trees with a set of rules until no rule matches. The rules are indexed by
+       node type, so a node is only matched against the rules for its type.
+       get_node_type(node) returns the NodeType of a node, or None for nodes no rule can
+       match. The number of times each rule fired is counted in firings."""
+
+    def __init__(self, rules, get_node_type, max_rewrites = None):
+        self.rules = {}   # NodeType -> [ rules ]
+        for rule in rules:
+            for node_type in rule.node_type:
+                self.rules.setdefault(node_type, []).append(rule)
+        self.get_node_type = get_node_type
+        self.max_rewrites = max_rewrites
+        self.firings = Counter()
+
+    def match(self, node):
+        """The replacement of the first rule that matches node, with the rule, or None"""
+
+        for rule in self.rules.get(self.get_node_type(node), ()):
+            if rule.child_type is not None and not any(self.get_node_type(child) in rule.child_type for child in node.children if child):
+                continue
+            replacement = rule.replace(node)
+            if replacement is not None:
+                return (rule, replacement)
+        return None
+
+    def rewrite(self, root):
+        """Rewrites the tree root to a fixpoint and returns the new root. Nodes are
+           checked parents first, so a rule that rewrites a whole chain (see
+           flatten_arguments) fires once at its top. After a rewrite only the nodes
+           around it are checked again, from a worklist, instead of walking the whole
+           tree once more."""
+
+        nodes = {}     # id(node) -> node, for every node that was ever in the tree
+        parents = {}   # id(node) -> (parent, index); the parent of the root is None
+        worklist = deque()
+        queued = set()
+        detached = set()
+
+        def queue(node):
+            if id(node) not in queued and self.get_node_type(node) in self.rules:
+                queued.add(id(node))
+                worklist.append(node)
+
+        stack = [ (root, None, 0) ]
+        while stack:
+            (node, parent, index) = stack.pop()
+            nodes[id(node)] = node
+            parents[id(node)] = (parent, index)
+            queue(node)
+            stack.extend((child, node, n) for n, child in reversed(list(enumerate(node.children))) if child)
+
+        n_rewrites = 0
+        while worklist:
+            node = worklist.popleft()
+            queued.discard(id(node))
+            if id(node) in detached:
+                continue
+            result = self.match(node)
+            if result is None:
+                continue
+            (rule, replacement) = result
+            self.firings[rule.name] += 1
+            if profiling.n_active:
+                profiling.count("rule." + rule.name)
+            n_rewrites += 1
+            if self.max_rewrites is not None and n_rewrites > self.max_rewrites:
+                raise RuntimeError(f"no fixpoint after {self.max_rewrites} rewrites")
+
+            (parent, index) = parents[id(node)]
+            if parent is None:
+                root = replacement
+            else:
+                set_child(parent, index, replacement)
+
+            # Register the new nodes of the replacement; the old nodes it reuses keep
+            # their children
+            new_nodes = []
+            kept = set()
+            stack = [ (replacement, parent, index) ]
+            while stack:
+                (new_node, new_parent, new_index) = stack.pop()
+                parents[id(new_node)] = (new_parent, new_index)
+                if id(new_node) in nodes:
+                    kept.add(id(new_node))
+                    continue
+                nodes[id(new_node)] = new_node
+                new_nodes.append(new_node)
+                stack.extend((child, new_node, n) for n, child in enumerate(new_node.children) if child)
+
+            # The replaced node and the subtrees it dropped are no longer in the tree
+            stack = [ node ]
+            while stack:
+                old_node = stack.pop()
+                if id(old_node) in kept:
+                    continue
+                detached.add(id(old_node))
+                stack.extend(child for child in old_node.children if child)
+
+            for new_node in reversed(new_nodes):
+                queue(new_node)
+            for child in replacement.children:
+                if child:
+                    queue(child)
+            queue(replacement)
+            if parent is not None:
+                queue(parent)
+        return root
+
+
+# Rules for InterParseTree parse trees
+
+operator_node_types = { "o": NodeType.COMPOSITION, "i": NodeType.INTERSECTION, "c": NodeType.CLOSURE }
+
+def get_parse_node_type(node):
+    if not node.children:
+        return NodeType.TABLE
+    return operator_node_types.get(node.data)
+
+
+def flatten_arguments(node):
+    """o(a,o(b,c)) -> o(a,b,c), and the same for i(). The whole chain is flattened at
+       once, so a chain of n nested operators takes one rewrite instead of n."""
+
+    args = []
+    stack = list(reversed(node.children))
+    while stack:
+        child = stack.pop()
+        if child.data == node.data and child.children:
+            stack.extend(reversed(child.children))
+        else:
+            args.append(child)
+    return ParseTreeNode(node.data, args)
+
+
+def remove_duplicate_arguments(node):
+    """i(a,b,a) -> i(a,b), and i(a,a) -> a"""
+
+    fingerprints = set()
+    args = []
+    for child in node.children:
+        fingerprint = get_fingerprint(child)
+        if fingerprint not in fingerprints:
+            fingerprints.add(fingerprint)
+            args.append(child)
+    if len(args) == len(node.children):
+        return None
+    if len(args) == 1:
+        return args[0]
+    return ParseTreeNode(node.data, args)
+
+
+parse_tree_rules = [
+    Rule("o-associativity", NodeType.COMPOSITION, flatten_arguments, NodeType.COMPOSITION),
+    Rule("i-associativity", NodeType.INTERSECTION, flatten_arguments, NodeType.INTERSECTION),
+    Rule("i-idempotence", NodeType.INTERSECTION, remove_duplicate_arguments)
+]
+
+
+def rewrite_parse_tree(tree, rules = None):
+    """Rewrites the parse tree of an InterParseTree in place; returns the engine, for
+       its firings"""
+
+    engine = RuleEngine(parse_tree_rules if rules is None else rules, get_parse_node_type)
+    tree.root = engine.rewrite(tree.root)
+    return engine
+
+
+# Rules for SQLoptimizer expressions
+
+select_node_types = { getattr(SQLoptimizer, node_type.name): node_type for node_type in NodeType if hasattr(SQLoptimizer, node_type.name) }
+
+def get_select_node_type(node):
+    return select_node_types.get(node.get_nodetype())
+
+
+def collapse_renames(node):
+    """rho(b <- a, rho(a <- c, X)) -> rho(b <- c, X), and rho(c <- c, X) -> X"""
+
+    input_node = node.get_children()[1]
+    (new_name, old_name) = node.get_children()[0].get_value()
+    if input_node.get_nodetype() == SQLoptimizer.RENAME and input_node.get_children()[0].get_value()[0] == old_name:
+        old_name = input_node.get_children()[0].get_value()[1]
+        input_node = input_node.get_children()[1]
+    elif new_name != old_name:
+        return None
+    if new_name == old_name:
+        return input_node
+    return SQLoptimizer.TreeNode(SQLoptimizer.RENAME, [ SQLoptimizer.ConstNode([ new_name, old_name ]), input_node ])
+
+
+def merge_projections(node):
+    """pi(L, pi(M, X)) -> pi(L & M, X), like lift_cleanup_node merges projections"""
+
+    input_node = node.get_children()[1]
+    if input_node.get_nodetype() != SQLoptimizer.PROJECTION:
+        return None
+    input_columns = input_node.get_children()[0].get_value()
+    intersection = SQLoptimizer.intersection_with_wildcards(input_columns, node.get_children()[0].get_value())
+    # In the order of the outer projection, so the SELECT lists the columns in a fixed order
+    columns = list(dict.fromkeys(column for column in node.get_children()[0].get_value() + input_columns if column in intersection))
+    return SQLoptimizer.TreeNode(SQLoptimizer.PROJECTION, [ SQLoptimizer.ConstNode(columns), input_node.get_children()[1] ])
+
+
+select_rules = [
+    Rule("rename-of-rename", NodeType.RENAME, collapse_renames),
+    Rule("projection-of-projection", NodeType.PROJECTION, merge_projections, NodeType.PROJECTION)
+]
+
+
+def rewrite_select(expr, rules = None):
+    """Rewrites an SQLoptimizer expression; returns (new root, engine)"""
+
+    engine = RuleEngine(select_rules if rules is None else rules, get_select_node_type)
+    return (engine.rewrite(expr), engine)
+
+
+def test_rewrite():
+    tree = InterParseTree("o(o(onderdeel_van,ligt_in),o(ligt_in,woont_op))")
+    engine = rewrite_parse_tree(tree)
+    print(format_expression(tree.root), dict(engine.firings)) # o(onderdeel_van,ligt_in,ligt_in,woont_op)
+    tree = InterParseTree("i(woont_op,i(ligt_in,woont_op),o(i(ligt_in,ligt_in)))")
+    engine = rewrite_parse_tree(tree)
+    print(format_expression(tree.root), dict(engine.firings)) # i(woont_op,ligt_in,o(ligt_in))
+
+    TreeNode = SQLoptimizer.TreeNode
+    ConstNode = SQLoptimizer.ConstNode
+    expr = TreeNode(SQLoptimizer.INPUT1, [ ConstNode("X") ])
+    expr = TreeNode(SQLoptimizer.PROJECTION, [ ConstNode([ "a", "b", "c" ]), expr ])
+    expr = TreeNode(SQLoptimizer.PROJECTION, [ ConstNode([ "a", "b" ]), expr ])
+    expr = TreeNode(SQLoptimizer.RENAME, [ ConstNode([ "d", "a" ]), expr ])
+    expr = TreeNode(SQLoptimizer.RENAME, [ ConstNode([ "e", "d" ]), expr ])
+    expr = TreeNode(SQLoptimizer.ASSIGN, [ ConstNode("R"), expr ])
+    (expr, engine) = rewrite_select(expr)
+    print(SQLoptimizer.gen_select_stmt(SQLoptimizer.make_select_view(expr)), dict(engine.firings)) # SELECT a AS e, b INTO R FROM X
+
+    for depth in (1000, 10000, 100000):
+        tree = InterParseTree("o(" * depth + "woont_op" + ",ligt_in)" * depth)
+        start = time.perf_counter()
+        engine = rewrite_parse_tree(tree)
+        print(depth, len(tree.root.children), f"{time.perf_counter() - start:.3f}s") # Linear in the depth
+
+
+if __name__ == "__main__":
+    test_rewrite()
@@ -0,0 +1,206 @@
+import itertools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from execution import SQLiteBackend, create_tables
+from sqloptimizer4 import InterParseTree, TableNode, gen_statements, simplify_plans
+
+BUSY_TIMEOUT = 60000   # Milliseconds a task waits for the database lock that another task holds
+
+# table: the table the task writes, statements: its statements, inputs: the indexes of
+# the tasks whose tables it reads
+Task = namedtuple("Task", ["table", "statements", "inputs"])
+
+# wall_seconds: of the whole run, task_seconds: the sum over the tasks, critical_path:
+# the tables of the longest chain of dependent tasks, critical_path_seconds: the time
+# its tasks took together, peak_concurrency: the most tasks that ran at the same time
+ScheduleStats = namedtuple("ScheduleStats", ["wall_seconds", "task_seconds", "critical_path_seconds", "critical_path", "peak_concurrency"])
+
+run_ids = itertools.count()
+
+
+def build_dag(plans):
+    """One task per plan (of InterParseTree.generate_plans), which depends on the tasks
+       that write the tables it reads. The plans are in post-order, so the inputs of a
+       task always come before it."""
+
+    producers = { plan.name: n for n, plan in enumerate(plans) }
+    tasks = []
+    for plan in plans:
+        inputs = { producers[node.tablename] for node in plan.DepthFirst() if isinstance(node, TableNode) and node.tablename in producers }
+        tasks.append(Task(plan.name, gen_statements([ plan ]), sorted(inputs)))
+    return tasks
+
+
+def get_critical_path(tasks, seconds):
+    """(seconds, task indexes) of the chain of dependent tasks that took the longest,
+       given the seconds every task took"""
+
+    path_seconds = []
+    previous = []
+    for n, task in enumerate(tasks):
+        longest = max(task.inputs, key = lambda input: path_seconds[input], default = None)
+        path_seconds.append(seconds[n] + (path_seconds[longest] if longest is not None else 0.0))
+        previous.append(longest)
+    if not tasks:
+        return (0.0, [])
+    n = max(range(len(tasks)), key = lambda n: path_seconds[n])
+    total = path_seconds[n]
+    path = []
+    while n is not None:
+        path.append(n)
+        n = previous[n]
+    return (total, path[::-1])
+
+
+class DAGScheduler():
+    """Runs the plans of an expression as a DAG of tasks on the database of backend:
+       a task starts as soon as the tasks it reads from are done, so independent branches
+       run at the same time, at most max_concurrency of them, each on its own worker
+       thread and connection from the pool of backend.
+
+       The tables of the tasks are ordinary tables (temporary ones are only visible to
+       the connection that created them), with a name that is unique to the run; a table
+       is dropped as soon as the last task that reads it is done. SQLite allows one writer
+       at a time, so there its tasks wait for each other's lock (up to BUSY_TIMEOUT)."""
+
+    def __init__(self, backend, max_concurrency = 4):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers = max_concurrency)
+        self.lock = threading.Lock()
+        self.stats = None   # ScheduleStats of the last run
+
+    def rename_tables(self, plans):
+        """Gives the tables the plans write a name that is unique to this run; changes
+           the plans, and returns new name -> old name"""
+
+        prefix = f"D{os.getpid()}_{next(run_ids)}_"
+        renames = { plan.name: prefix + plan.name for plan in plans }
+        for plan in plans:
+            for node in plan.DepthFirst():
+                if isinstance(node, TableNode) and node.tablename in renames:
+                    node.tablename = renames[node.tablename]
+            plan.name = renames[plan.name]
+        return { new: old for old, new in renames.items() }
+
+    def drop_tables(self, connection, tables):
+        for table in tables:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def run_task(self, task, tasks, n_readers, start):
+        """Runs the statements of a task on a connection of its own, then drops the
+           tables of its inputs that no other task reads anymore. Returns the (start,
+           end) seconds of the task since the start of the run."""
+
+        with self.backend.pool.connection() as connection:
+            connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+            task_start = time.perf_counter() - start
+            cursor = connection.cursor()
+            temp_tables = {}
+            for statement in task.statements:
+                self.backend.run_statement(cursor, statement, temp_tables, { task.table })
+            task_end = time.perf_counter() - start
+            self.drop_tables(connection, reversed(list(temp_tables)))   # Those of a Loop
+            with self.lock:
+                n_readers.subtract(tasks[input].table for input in task.inputs)
+                unread = [ tasks[input].table for input in task.inputs if n_readers[tasks[input].table] == 0 ]
+            self.drop_tables(connection, unread)
+        return (task_start, task_end)
+
+    def execute_plans(self, plans):
+        """Simplifies the conditions of the plans and runs them; returns the rows of the
+           result as a list, and sets self.stats. Renames the tables of the plans."""
+
+        if simplify_plans(plans):
+            self.stats = ScheduleStats(0.0, 0.0, 0.0, [], 0)
+            return []
+        names = self.rename_tables(plans)
+        tasks = build_dag(plans)
+        result = tasks[-1].table
+        n_readers = Counter(tasks[input].table for task in tasks for input in task.inputs)
+        dependents = [ [] for task in tasks ]
+        for n, task in enumerate(tasks):
+            for input in task.inputs:
+                dependents[input].append(n)
+        n_waiting = [ len(task.inputs) for task in tasks ]
+
+        start = time.perf_counter()
+        ready = [ n for n in range(len(tasks)) if n_waiting[n] == 0 ]
+        running = {}   # future -> task index
+        times = [ None ] * len(tasks)
+        peak_concurrency = 0
+        try:
+            while ready or running:
+                while ready and len(running) < self.max_concurrency:
+                    n = ready.pop(0)
+                    running[self.executor.submit(self.run_task, tasks[n], tasks, n_readers, start)] = n
+                peak_concurrency = max(peak_concurrency, len(running))
+                (done, _) = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    n = running.pop(future)
+                    times[n] = future.result()
+                    for dependent in dependents[n]:
+                        n_waiting[dependent] -= 1
+                        if n_waiting[dependent] == 0:
+                            ready.append(dependent)
+            with self.backend.pool.connection() as connection:
+                rows = connection.execute(f"SELECT * FROM {result}").fetchall()
+        finally:
+            for future in running:
+                future.cancel()
+            wait(running)
+            with self.backend.pool.connection() as connection:
+                self.drop_tables(connection, [ task.table for task in reversed(tasks) ])
+
+        wall_seconds = time.perf_counter() - start
+        seconds = [ (end - task_start) if task_start is not None else 0.0 for (task_start, end) in times ]
+        (critical_path_seconds, critical_path) = get_critical_path(tasks, seconds)
+        self.stats = ScheduleStats(wall_seconds, sum(seconds), critical_path_seconds, [ names[tasks[n].table] for n in critical_path ], peak_concurrency)
+        return rows
+
+    def execute_expression(self, expression, is_fused = False, is_recursive = True):
+        """Compiles an expression string and returns the rows of its result"""
+
+        return self.execute_plans(InterParseTree(expression).generate_plans(self.backend.catalog, is_fused, is_recursive))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def test_scheduler():
+    tasks = build_dag(InterParseTree("o(onderdeel_van,o(ligt_in,woont_op))").generate_plans())
+    print([ (task.table, task.inputs) for task in tasks ]) # The three leaves depend on nothing
+    print(get_critical_path(tasks, [ 1.0, 3.0, 1.0, 1.0, 1.0 ])) # Should be (5.0, [1, 3, 4])
+    tasks = build_dag(InterParseTree("o(i(onderdeel_van,ligt_in),woont_op)").generate_plans())
+    print([ (task.table, task.inputs) for task in tasks ]) # The intersection T4 waits for T1 and T3, T6 for nothing
+
+    (handle, path) = tempfile.mkstemp(suffix = ".db")
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(path)
+        create_tables(connection, n_rows = 300, n_values = 400)
+        connection.close()
+
+        backend = SQLiteBackend(path, pool_size = 3)
+        for max_concurrency in (1, 3):
+            scheduler = DAGScheduler(backend, max_concurrency)
+            for expression in [ "o(onderdeel_van,o(ligt_in,woont_op))", "o(c(ligt_in),c(woont_op,2))", "o(i(onderdeel_van,ligt_in),woont_op)", "i(o(ligt_in,woont_op),c(o(ligt_in,woont_op),2))" ]:
+                for is_recursive in (True, False):
+                    rows = sorted(scheduler.execute_expression(expression, is_recursive = is_recursive))
+                    print(rows == sorted(backend.execute_expression(expression, is_recursive = is_recursive)), scheduler.stats.critical_path, scheduler.stats.peak_concurrency)
+            scheduler.close()
+        with backend.pool.connection() as connection:
+            print(connection.execute("SELECT name FROM sqlite_master WHERE name LIKE 'D%'").fetchall()) # Should be []: all tables are dropped
+        backend.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    test_scheduler()
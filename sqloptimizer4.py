@@ -1,6 +1,15 @@
+import hashlib
+import io
+import re
+import sys
+import time
 from enum import Flag, unique, auto
 from collections import namedtuple
 
+from catalog import get_default_catalog
+from joinorder import order_chain
+import profiling
+
 @unique
 class NodeType(Flag):
     ASSIGN = auto()
@@ -27,6 +36,9 @@ class NodeType(Flag):
     BIGGER = auto()
     SMALLER_EQUAL = auto()
     BIGGER_EQUAL  = auto()
+    COMPOSITION = auto()
+    INTERSECTION = auto()
+    CLOSURE = auto()
 
     INPUTS = INPUT1 | INPUT2
     COMPARE = EQUALS | NOT_EQUAL | SMALLER | BIGGER | SMALLER_EQUAL | BIGGER_EQUAL
@@ -36,12 +48,16 @@ class NodeType(Flag):
 
 
 class TreeNode():
+    # The plan node classes below add their own attributes, and keep a __dict__
+    __slots__ = ("children", "estimate")
+
     def __init__(self, children = None):
         if not children:
             children = []
         if not isinstance(children, list):
             children = [ children ]
         self.children = children
+        self.estimate = None   # Set by costmodel.CostModel
 
     def get_child(self, n):
         if n >= len(self.children):
@@ -52,19 +68,29 @@ class TreeNode():
         return self.children
 
     def DepthFirst(self):
-        yield self
-        for child in self.children:
-            yield from child.DepthFirst()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
     
     def DepthFirstReversed(self):
-        for child in self.children:
-            yield from child.DepthFirst()
-        yield self
+        """Yields the children of a node before the node itself"""
+        stack = [(self, False)]
+        while stack:
+            (node, is_visited) = stack.pop()
+            if is_visited:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
 
     def add_child(self, child):
         self.children.append(child)
 
 class ParseTreeNode(TreeNode):
+    __slots__ = ("data",)
+
     def __init__(self, data, children = []):
         self.data = data
         super().__init__(children)
@@ -79,87 +105,133 @@ class ParseTreeNode(TreeNode):
         return self.data
 
 
+NAME = "name"
+NUMBER = "number"
+OPERATOR = "operator"
+OPEN = "("
+CLOSE = ")"
+COMMA = ","
+END = "end"
+
+OPERATORS = "cio"               # a() and k() of the original grammar have no semantics here, and are unknown operators
+CLOSURE_OPERATOR = "c"         # c(r) is the transitive closure of r, c(r,n) that of at most n steps
+ASSOCIATIVE_OPERATORS = "io"   # o(o(a,b),c) == o(a,o(b,c)) == o(a,b,c)
+COMMUTATIVE_OPERATORS = "i"    # i(a,b) == i(b,a)
+FINGERPRINT_SIZE = 16          # Bytes
+
+token_pattern = re.compile(r"(?P<name>[A-Za-z_]+)|(?P<number>\d+)|(?P<punct>[(),])|(?P<space>\s+)|(?P<error>.)", re.DOTALL)
+
+def tokenize(expression):
+    """Splits expression into a list of (token type, value, offset) tuples, ending with END.
+       A single letter operator name is only an operator if it is followed by "(";
+       otherwise it is a (too short) relation name."""
+
+    tokens = []
+    for match in token_pattern.finditer(expression):
+        kind = match.lastgroup
+        value = match.group()
+        if kind == "name":
+            tokens.append((NAME, value, match.start()))
+        elif kind == "number":
+            tokens.append((NUMBER, value, match.start()))
+        elif kind == "punct":
+            if value == OPEN and tokens and tokens[-1][0] == NAME and len(tokens[-1][1]) == 1 and tokens[-1][1] in OPERATORS:
+                tokens[-1] = (OPERATOR, tokens[-1][1], tokens[-1][2])
+            tokens.append((value, value, match.start()))
+        elif kind == "error":
+            raise SyntaxError(f"unexpected character '{value}' at position {match.start()}",
+                              ("<expression>", 1, match.start() + 1, expression))
+    tokens.append((END, "", len(expression)))
+    return tokens
+
+
 class InterParseTree():
     def __init__(self, expression):
         self.expression = expression
-        self.root = self.parse()
+        with profiling.timed("parse"):
+            self.root = self.parse()
 
     def parse(self):
-        self.parse_pos = 0
-        (ok, tree) = self.parse_expr()
-        if ok:
-            return tree
-        else:
-            raise SyntaxError
-
-    def parse_operator_expr(self):
-        cur_pos = self.parse_pos
-        (ok, operator) = self.parse_operator()
-        if not ok:
-            self.parse_pos = cur_pos
-            return (False, None)
-        if self.expression[self.parse_pos] != "(":
-            self.parse_pos = cur_pos
-            return (False, None)
-        self.parse_pos += 1
-        (ok, args) = self.parse_args()
-        if not ok:
-            self.parse_pos = cur_pos
-            return (False, None)
-        if self.expression[self.parse_pos] != ")":
-            self.parse_pos = cur_pos
-            return (False, None)
-        self.parse_pos += 1
-        return (True, ParseTreeNode(operator, args))
-
-    def parse_operator(self):
-        operator = self.expression[self.parse_pos]
-        if operator not in "aiko":
-            return (False, None)
-        self.parse_pos += 1
-        return (True, operator)
-
-    def parse_args(self):
-        cur_pos = self.parse_pos
-        (ok, arg) = self.parse_expr()
-        if not ok:
-            return (False, None)
-        if self.expression[self.parse_pos] == ",":
-            self.parse_pos += 1
-            (ok, args) = self.parse_args()
-            if ok:
-                return (True, [arg] + args)
-            else:
-                self.parse_pos = cur_pos
-                return (False, None)
-        else:
-            return (True, [arg])
-
-    def parse_expr(self):
-        (ok, op_expr) = self.parse_operator_expr()
-        if ok:
-            return (True, op_expr)
-        cur_pos = self.parse_pos
-        arrow_name = ""
-        while self.parse_pos < len(self.expression) and \
-              self.expression[self.parse_pos] in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_":
-            arrow_name += self.expression[self.parse_pos]
-            self.parse_pos += 1
-        if len(arrow_name) < 2:
-            self.parse_pos = cur_pos
-            return (False, None)
-        return (True, ParseTreeNode(arrow_name, []))
+        """Parses the expression in a single pass over its tokens. Operator expressions
+           are kept on an explicit stack instead of the Python call stack, so the depth
+           of the nesting is not limited by the recursion limit."""
+
+        tokens = tokenize(self.expression)
+        pos = 0
+        stack = []   # (operator, args) of the operator expressions that are not closed yet
+        while True:
+            (token_type, value, offset) = tokens[pos]
+            pos += 1
+            if token_type == OPERATOR:
+                # tokenize only returns an operator when it is followed by "("
+                stack.append((value, []))
+                pos += 1
+                continue
+            if token_type == NUMBER:
+                # Only the depth of a closure, its second argument, is a number
+                if not stack or stack[-1][0] != CLOSURE_OPERATOR or len(stack[-1][1]) != 1:
+                    self.syntax_error("a number can only be the depth of a closure", offset)
+                if int(value) < 1:
+                    self.syntax_error("the depth of a closure must be at least 1", offset)
+            elif token_type != NAME:
+                self.syntax_error("expected operator or relation name", offset)
+            elif tokens[pos][0] == OPEN:
+                self.syntax_error(f"unknown operator '{value}'", offset)
+            elif len(value) < 2:
+                self.syntax_error(f"relation name '{value}' is too short", offset)
+            node = ParseTreeNode(value, [])
+
+            while True:
+                (token_type, value, offset) = tokens[pos]
+                if not stack:
+                    if token_type != END:
+                        self.syntax_error("expected end of expression", offset)
+                    return node
+                stack[-1][1].append(node)
+                pos += 1
+                if token_type == COMMA:
+                    break
+                if token_type != CLOSE:
+                    self.syntax_error("expected ',' or ')'", offset)
+                (operator, args) = stack.pop()
+                if operator == CLOSURE_OPERATOR and len(args) > 2:
+                    self.syntax_error("a closure has a relation and an optional depth", offset)
+                if operator == CLOSURE_OPERATOR and len(args) == 2 and not args[1].data.isdigit():
+                    self.syntax_error("the depth of a closure must be a number", offset)
+                node = ParseTreeNode(operator, args)
+
+    def syntax_error(self, message, offset):
+        raise SyntaxError(f"{message} at position {offset}", ("<expression>", 1, offset + 1, self.expression))
     
-    def generate_ralg_expr(self):
-
-        db_designs = {
-            "woont_op": ("tbl_persoon", "persoons_id", "adres_id"),
-            "ligt_in": ("tbl_ades", "adres_id", "gemeente_id"),
-            "onderdeel_van": ("tbl_gemeente", "gemeente_id", "provincie_id")
-        }
-        tablenames = {}
+    def generate_ralg_expr(self, catalog = None, is_fused = False, is_recursive = True, is_dropped = False, is_reused = False):
+        """Returns the list of SQL statements that compute the expression; the table the
+           last SELECT (or Loop) writes holds the relation, and only DROP TABLE statements
+           can follow it. With is_recursive = False closures
+           are computed by a Loop (see ClosureNode.gen_loop_statements) instead of a
+           WITH RECURSIVE query. For is_dropped and is_reused see gen_statements."""
+
+        with profiling.timed("plan"):
+            plans = self.generate_plans(catalog, is_fused, is_recursive)
+        with profiling.timed("codegen"):
+            return gen_statements(plans, is_dropped, is_reused)
+
+    def generate_plans(self, catalog = None, is_fused = False, is_recursive = True, tablenames = None):
+        """Returns the plan trees (AssignNode, ClosureNode or IntersectionNode) of the statements of
+           generate_ralg_expr. If tablenames (a dict) is given, the name of the table
+           that holds each node's result is stored in it, by id of the node; only
+           without is_fused, where every node gets a table."""
+
+        if is_fused:
+            return self.generate_fused_plans(catalog, is_recursive)
+        if catalog is None:
+            catalog = get_default_catalog()
+        plans = []
+        if tablenames is None:
+            tablenames = {}
         n_tables = 0
         for node in self.root.DepthFirstReversed():
+            if node.data.isdigit():    # the depth of a closure
+                continue
             if len(node.data) == 1:    # operator
                 if node.data == "o":   # composition
                     src_tablenames = [ tablenames[id(child)] for child in node.children ] 
@@ -167,19 +239,262 @@ class InterParseTree():
                     n_tables += 1
                     tablenames[id(node)] = tgt_tablename
                     ralg_expr = make_comp_expr(tgt_tablename, src_tablenames)
+                elif node.data == CLOSURE_OPERATOR:
+                    tgt_tablename = f"T{n_tables}"
+                    n_tables += 1
+                    tablenames[id(node)] = tgt_tablename
+                    ralg_expr = make_closure_expr(tgt_tablename, (tablenames[id(node.children[0])], "domain", "codomain"), get_closure_depth(node), is_recursive)
+                else:                  # intersection
+                    tgt_tablename = f"T{n_tables}"
+                    n_tables += 1
+                    tablenames[id(node)] = tgt_tablename
+                    ralg_expr = make_intersection_expr(tgt_tablename, [ (tablenames[id(child)], "domain", "codomain") for child in node.children ])
             else:
                 src_tablename = f"T{n_tables}"
                 tgt_tablename = f"T{n_tables + 1}"
                 n_tables += 2
                 tablenames[id(node)] = tgt_tablename
-                db_design = db_designs[node.data]
+                db_design = catalog.get_design(node.data)
                 ralg_expr = make_select_expr(db_design[1:3], ("domain", "codomain"), tgt_tablename, db_design[0], src_tablename)
             
-            print(gen_select_stmt(ralg_expr))
+            plans.append(ralg_expr)
+        return plans
+
+    def reorder_compositions(self, catalog = None):
+        """Replaces every composition chain (nested o() expressions flattened into one
+           chain) by the association of binary compositions that writes the fewest
+           intermediate rows, according to the statistics in the catalog."""
+
+        if catalog is None:
+            catalog = get_default_catalog()
+
+        # Compositions that are an argument of a composition are part of the parent's chain
+        chain_ids = set()
+        for node in self.root.DepthFirst():
+            if node.data == "o":
+                chain_ids.update(id(child) for child in node.children if child.data == "o")
+
+        results = {}   # id(node) -> (reordered node, estimate)
+        for node in self.root.DepthFirstReversed():
+            if id(node) in chain_ids:
+                continue
+            if node.data.isdigit():
+                results[id(node)] = (node, None)   # the depth of a closure
+            elif not node.children:
+                results[id(node)] = (node, catalog.get_statistics(node.data))
+            elif node.data == "o":
+                elements = []
+                stack = list(reversed(node.children))
+                while stack:
+                    child = stack.pop()
+                    if child.data == "o":
+                        stack.extend(reversed(child.children))
+                    else:
+                        elements.append(results[id(child)])
+                (plan, estimate, _) = order_chain([ element_estimate for (_, element_estimate) in elements ])
+                results[id(node)] = (make_plan_tree(plan, [ element for (element, _) in elements ]), estimate)
+            else:
+                # Other operators are not reordered; assume they are as large as their largest argument
+                args = [ results[id(child)] for child in node.children ]
+                estimate = max((arg_estimate for (_, arg_estimate) in args if arg_estimate is not None), key = lambda arg_estimate: arg_estimate.rows)
+                results[id(node)] = (ParseTreeNode(node.data, [ arg for (arg, _) in args ]), estimate)
+        self.root = results[id(self.root)][0]
+        return self
+
+    def generate_fused_plans(self, catalog = None, is_recursive = True):
+        """Like generate_plans, but every composition chain is flattened into a single
+           SELECT that joins the base tables directly. A subexpression is only written to
+           a temporary table when it is used more than once, or is (an argument of) a
+           closure or an intersection."""
+
+        if catalog is None:
+            catalog = get_default_catalog()
+
+        # Equal subexpressions get the same id, so reuse can be detected
+        node_ids = {}
+        subexpr_ids = {}
+        subexprs = []   # (operator or relation name, ids of the arguments)
+        for node in self.root.DepthFirstReversed():
+            subexpr = (node.data, tuple(node_ids[id(child)] for child in node.children))
+            if subexpr not in subexpr_ids:
+                subexpr_ids[subexpr] = len(subexprs)
+                subexprs.append(subexpr)
+            node_ids[id(node)] = subexpr_ids[subexpr]
+        root_id = node_ids[id(self.root)]
+
+        n_uses = [ 0 ] * len(subexprs)
+        materialized_args = set()   # Read as a table by a closure or an intersection
+        for (data, arg_ids) in subexprs:
+            for arg_id in arg_ids:
+                n_uses[arg_id] += 1
+            if data == CLOSURE_OPERATOR:
+                materialized_args.add(arg_ids[0])
+            elif data == "i":
+                materialized_args.update(arg_id for arg_id in arg_ids if subexprs[arg_id][1])
+
+        plans = []
+        tablenames = {}
+        for subexpr_id, (data, arg_ids) in enumerate(subexprs):   # arguments come first
+            if not arg_ids and data.isdigit():
+                continue
+            if data == CLOSURE_OPERATOR:
+                arg_id = arg_ids[0]
+                if arg_id in tablenames:
+                    closure_input = (tablenames[arg_id], "domain", "codomain")
+                else:
+                    closure_input = catalog.get_design(subexprs[arg_id][0])
+                max_depth = int(subexprs[arg_ids[1]][0]) if len(arg_ids) > 1 else None
+                tgt_tablename = f"T{len(tablenames)}"
+                tablenames[subexpr_id] = tgt_tablename
+                plans.append(make_closure_expr(tgt_tablename, closure_input, max_depth, is_recursive))
+                continue
+            if data == "i":
+                inputs = [ (tablenames[arg_id], "domain", "codomain") if arg_id in tablenames else catalog.get_design(subexprs[arg_id][0]) for arg_id in arg_ids ]
+                tgt_tablename = f"T{len(tablenames)}"
+                tablenames[subexpr_id] = tgt_tablename
+                plans.append(make_intersection_expr(tgt_tablename, inputs))
+                continue
+            if subexpr_id != root_id and subexpr_id not in materialized_args and (n_uses[subexpr_id] < 2 or not arg_ids):
+                continue
+            inputs = []
+            stack = [ subexpr_id ]
+            while stack:
+                input_id = stack.pop()
+                (data, input_arg_ids) = subexprs[input_id]
+                if input_id in tablenames:
+                    inputs.append((tablenames[input_id], "domain", "codomain"))
+                elif not input_arg_ids:
+                    inputs.append(catalog.get_design(data))
+                else:   # a composition; closures and intersections have a table
+                    stack.extend(reversed(input_arg_ids))
+            tgt_tablename = f"T{len(tablenames)}"
+            tablenames[subexpr_id] = tgt_tablename
+            plans.append(make_chain_expr(tgt_tablename, inputs))
+        return plans
+
+
+def make_plan_tree(plan, elements):
+    """Builds the binary o() tree for a plan from order_chain"""
+
+    if not isinstance(plan, tuple):
+        return ParseTreeNode("o", [ elements[plan] ])
+    nodes = {}
+    stack = [ (plan, False) ]
+    while stack:
+        (subplan, is_visited) = stack.pop()
+        if not isinstance(subplan, tuple):
+            nodes[id(subplan)] = elements[subplan]
+        elif is_visited:
+            nodes[id(subplan)] = ParseTreeNode("o", [ nodes[id(subplan[0])], nodes[id(subplan[1])] ])
+        else:
+            stack.append((subplan, True))
+            stack.append((subplan[0], False))
+            stack.append((subplan[1], False))
+    return nodes[id(plan)]
+
+
+def canonicalize(root, digests = None):
+    """Returns (canonical tree, fingerprint) of the parse tree root. In the canonical
+       tree the arguments of associative operators are flattened into their parent and
+       the arguments of commutative operators are sorted, so equivalent ways of writing
+       an expression get the same tree. The fingerprint (a hex string) is a hash of the
+       canonical tree that does not change between processes, so it can be used as a
+       cache key. Both take linear time, apart from sorting the arguments.
+
+       If digests (a dict) is given, the digest (bytes) of every node of the canonical
+       tree is stored in it, by id of the node."""
+
+    # Arguments with the same associative operator as their parent are part of the
+    # parent's chain, and are not canonicalized on their own
+    chain_ids = set()
+    for node in root.DepthFirst():
+        if node.data in ASSOCIATIVE_OPERATORS:
+            chain_ids.update(id(child) for child in node.children if child.data == node.data and child.children)
+
+    leaf_digests = {}   # name -> digest, so every name is interned and hashed once
+    results = {}        # id(node) -> (canonical node, digest)
+    for node in root.DepthFirstReversed():
+        if id(node) in chain_ids:
+            continue
+        if not node.children:
+            if node.data not in leaf_digests:
+                leaf_digests[sys.intern(node.data)] = hashlib.blake2b(b"'" + node.data.encode(), digest_size = FINGERPRINT_SIZE).digest()
+            name = sys.intern(node.data)
+            results[id(node)] = (ParseTreeNode(name, []), leaf_digests[name])
+            if digests is not None:
+                digests[id(results[id(node)][0])] = leaf_digests[name]
+            continue
+        args = []
+        stack = list(reversed(node.children))
+        while stack:
+            child = stack.pop()
+            if id(child) in chain_ids:
+                stack.extend(reversed(child.children))
+            else:
+                args.append(results.pop(id(child)))
+        if node.data in COMMUTATIVE_OPERATORS:
+            args.sort(key = lambda arg: arg[1])
+        digest = hashlib.blake2b(node.data.encode() + b"(" + b"".join(arg_digest for (_, arg_digest) in args) + b")", digest_size = FINGERPRINT_SIZE).digest()
+        results[id(node)] = (ParseTreeNode(node.data, [ arg for (arg, _) in args ]), digest)
+        if digests is not None:
+            digests[id(results[id(node)][0])] = digest
+    (tree, digest) = results[id(root)]
+    return (tree, digest.hex())
+
+
+def get_fingerprint(root):
+    return canonicalize(root)[1]
+
+
+def format_expression(root):
+    """The expression text of a parse tree, e.g. of the canonical tree"""
+
+    parts = []
+    stack = [ root ]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            parts.append(node)
+        elif node.children:
+            parts.append(node.data + "(")
+            stack.append(")")
+            for n, child in enumerate(reversed(node.children)):
+                stack.append(child)
+                if n < len(node.children) - 1:
+                    stack.append(",")
+        else:
+            parts.append(node.data)
+    return "".join(parts)
+
+
+def get_closure_depth(node):
+    """The depth of a closure node c(r,n), or None for c(r)"""
+
+    if len(node.children) > 1:
+        return int(node.children[1].data)
+    return None
 
 
 ColSpec = namedtuple("ColSpec", ["table", "column"])
 
+# Statements that are run again and again, until the last run wrote no rows to table or
+# it ran max_iterations (None: no limit) times; name is the table that holds the result
+Loop = namedtuple("Loop", ["name", "statements", "table", "max_iterations"])
+
+
+def write_to_string(node):
+    """The SQL that node.write(out) writes, as a string"""
+
+    out = io.StringIO()
+    node.write(out)
+    return out.getvalue()
+
+
+def write_colspec(colspec, out):
+    out.write(colspec.table)
+    out.write(".")
+    out.write(colspec.column)
+
 
 class RenameNode(TreeNode):
 
@@ -192,6 +507,8 @@ class RenameNode(TreeNode):
             self.arguments[ColSpec(table, column)] = alias
 
     def combine(self, other):
+        if profiling.n_active:
+            profiling.count("combine")
         for colspec, alias in other.arguments.items():
             renamed_colspec = ColSpec(colspec.table, alias)
             if renamed_colspec in self.arguments:
@@ -202,51 +519,56 @@ class RenameNode(TreeNode):
                 self.arguments[colspec] = alias
         return self
 
-    def __str__(self):
-        result = ""
+    def write(self, out):
+        """Writes the column list of the SELECT to out"""
+
         if len(self.children) == 1 and isinstance(self.children[0], ProjectionNode):
-            columns = list(self.children[0].columns)
-            for colspec in columns:
-                if result != "":
-                    result += ", "
-                result += f"{colspec.table}.{colspec.column}"
+            for n, colspec in enumerate(self.children[0].columns):
+                if n > 0:
+                    out.write(", ")
+                write_colspec(colspec, out)
                 if colspec in self.arguments:
-                    result += f" AS {self.arguments[colspec]}"
+                    out.write(f" AS {self.arguments[colspec]}")
         else:
-            for colspec, alias in self.arguments.items():
-                if result != "":
-                    result += ", "
-                result += f"{colspec.table}.{colspec.column} AS {self.arguments[colspec]}"
-        return result
+            for n, (colspec, alias) in enumerate(self.arguments.items()):
+                if n > 0:
+                    out.write(", ")
+                write_colspec(colspec, out)
+                out.write(f" AS {alias}")
+
+    def __str__(self):
+        return write_to_string(self)
 
 
 class ProjectionNode(TreeNode):
 
     def __init__(self, table = None):
         super().__init__(table)
-        self.columns = set()
+        self.columns = {}   # Used as an ordered set, so the SQL lists the columns in a fixed order
     
     def add_columns(self, table, columns):
         for column in columns:
-            self.columns.add(ColSpec(table, column))
+            self.columns[ColSpec(table, column)] = None
 
     def combine(self, other):
+        if profiling.n_active:
+            profiling.count("combine")
         if isinstance(other, ProjectionNode):
-            self.columns &= other.columns
+            self.columns = { colspec: None for colspec in self.columns if colspec in other.columns }
         elif isinstance(other, RenameNode):
             for colspec, alias in other.arguments.items():
                 renamed_colspec = ColSpec(colspec.table, alias)
                 if renamed_colspec in self.columns:
-                    self.columns.remove(renamed_colspec)
-                    self.columns.add(colspec)
+                    self.columns = { (colspec if column == renamed_colspec else column): None for column in self.columns }
+
+    def write(self, out):
+        for n, colspec in enumerate(self.columns):
+            if n > 0:
+                out.write(", ")
+            write_colspec(colspec, out)
 
     def __str__(self):
-        result = ""
-        for colspec in self.columns:
-            if result != "":
-                result += ", "
-            result += f"{colspec.table}.{colspec.column}"
-        return result
+        return write_to_string(self)
 
 
 class TableNode(TreeNode):
@@ -256,8 +578,11 @@ class TableNode(TreeNode):
         self.tablename = tablename
         self.tablealias = tablealias
 
+    def write(self, out):
+        out.write(f"{self.tablename} AS {self.tablealias}")
+
     def __str__(self):
-        return f"{self.tablename} AS {self.tablealias}"
+        return write_to_string(self)
 
 
 class AssignNode(TreeNode):
@@ -269,6 +594,9 @@ class AssignNode(TreeNode):
     def set_name(self, name):
         self.name = name
 
+    def write(self, out):
+        out.write(self.name)
+
     def __str__(self):
         return self.name
 
@@ -278,85 +606,298 @@ class JoinNode(TreeNode):
     def __init__(self, tables):
         super().__init__(tables)
 
+    def write(self, out):
+        for n, table in enumerate(self.children):
+            if n > 0:
+                out.write(" JOIN ")
+            if isinstance(table, ConditionalNode) and table.has_conditions():
+                # A condition that was pushed down onto one of the joined tables
+                out.write("(SELECT * FROM ")
+                table.get_child(0).write(out)
+                out.write(" WHERE ")
+                table.write(out)
+                out.write(f") AS {table.get_child(0).tablealias}")
+            elif isinstance(table, ConditionalNode):
+                table.get_child(0).write(out)
+            else:
+                table.write(out)
+
+    def __str__(self):
+        return write_to_string(self)
+
 
 class ConditionalNode(TreeNode):
+    """A conjunction of equalities (lvalue == rvalue) between columns (ColSpec) and
+       constants, stored as an ordered set of (lvalue, rvalue) pairs. An equality that
+       is already there, also with its sides swapped, is not added again."""
 
     def __init__(self, table = None):
         super().__init__(table)
-    
+        self.conditions = {}     # Used as an ordered set of (lvalue, rvalue)
+        self.value_index = {}    # value -> the conditions it is a side of, as an ordered set
+        self.is_contradiction = False
+
+    @property
+    def lvalues(self):
+        return [ lvalue for (lvalue, rvalue) in self.conditions ]
+
+    @property
+    def rvalues(self):
+        return [ rvalue for (lvalue, rvalue) in self.conditions ]
+
+    def add_condition(self, lvalue, rvalue):
+        """Adds lvalue == rvalue; returns False if it was already there"""
+
+        if (lvalue, rvalue) in self.conditions or (rvalue, lvalue) in self.conditions:
+            return False
+        self.conditions[(lvalue, rvalue)] = None
+        self.value_index.setdefault(lvalue, {})[(lvalue, rvalue)] = None
+        self.value_index.setdefault(rvalue, {})[(lvalue, rvalue)] = None
+        return True
+
     def add_conditions(self, lvalues, rvalues):
-        # Assume lvalue and rvalue are both lists of the same length
-        self.lvalues = lvalues
-        self.rvalues = rvalues
+        """Replaces the conditions by lvalues[n] == rvalues[n]"""
+
+        self.conditions = {}
+        self.value_index = {}
+        for lvalue, rvalue in zip(lvalues, rvalues):
+            self.add_condition(lvalue, rvalue)
+
+    def get_conditions(self, value):
+        """The conditions that value (a ColSpec or a constant) is a side of"""
+
+        return list(self.value_index.get(value, ()))
+
+    def replace_values(self, replacements):
+        """Replaces the values that are keys of the dict replacements in all conditions,
+           in one pass over the conditions"""
+
+        if not any(value in self.value_index for value in replacements):
+            return
+        conditions = list(self.conditions)
+        self.conditions = {}
+        self.value_index = {}
+        for lvalue, rvalue in conditions:
+            self.add_condition(replacements.get(lvalue, lvalue), replacements.get(rvalue, rvalue))
 
     def combine(self, other):
+        if profiling.n_active:
+            profiling.count("combine")
         if isinstance(other, ConditionalNode):
-            self.lvalues += other.lvalues
-            self.rvalues += other.rvalues
+            for (lvalue, rvalue) in other.conditions:
+                self.add_condition(lvalue, rvalue)
         elif isinstance(other, ProjectionNode):
             pass
         elif isinstance(other, RenameNode):
-            for colspec, alias in other.arguments.items():
-                renamed_colspec = ColSpec(colspec.table, alias)
-                try:
-                    i = self.lvalues.index(renamed_colspec)
-                    self.lvalues[i] = colspec
-                except ValueError:
-                    pass
-                try:
-                    i = self.rvalues.index(renamed_colspec)
-                    self.rvalues[i] = colspec
-                except ValueError:
-                    pass
+            self.replace_values({ ColSpec(colspec.table, alias): colspec for colspec, alias in other.arguments.items() })
+
+    def has_conditions(self):
+        return len(self.conditions) > 0
+
+    def get_equivalence_classes(self):
+        """The sets of values that the conditions make equal (a == b and b == c give
+           { a, b, c }), in the order their first condition was added"""
+
+        parents = {}
+
+        def find(value):
+            root = value
+            while parents[root] != root:
+                root = parents[root]
+            while value != root:
+                (parents[value], value) = (root, parents[value])
+            return root
+
+        for lvalue, rvalue in self.conditions:
+            parents.setdefault(lvalue, lvalue)
+            parents.setdefault(rvalue, rvalue)
+            parents[find(lvalue)] = find(rvalue)
+
+        classes = {}   # root -> the values of its class, as an ordered set
+        for value in parents:
+            classes.setdefault(find(value), {})[value] = None
+        return [ set(values) for values in classes.values() ]
+
+    def simplify(self):
+        """Removes equalities of equal constants. If the equalities make a column equal
+           to two different constants they never hold: then the conditions are replaced
+           by (0 == 1) and False is returned."""
+
+        for (lvalue, rvalue) in list(self.conditions):
+            if not isinstance(lvalue, ColSpec) and not isinstance(rvalue, ColSpec) and lvalue == rvalue:
+                del self.conditions[(lvalue, rvalue)]
+                for value in (lvalue, rvalue):
+                    self.value_index[value].pop((lvalue, rvalue), None)
+
+        for values in self.get_equivalence_classes():
+            if len([ value for value in values if not isinstance(value, ColSpec) ]) > 1:
+                self.is_contradiction = True
+
+        if self.is_contradiction:
+            self.add_conditions([ 0 ], [ 1 ])
+        return not self.is_contradiction
+
+    def write(self, out):
+        for n, (lvalue, rvalue) in enumerate(self.conditions):
+            if n > 0:
+                out.write(" AND ")
+            out.write("(")
+            write_value(lvalue, out)
+            out.write(" == ")
+            write_value(rvalue, out)
+            out.write(")")
 
     def __str__(self):
-        result = ""
-        for lvalue, rvalue in zip(self.lvalues, self.rvalues):
-            if result != "":
-                result += " AND "
-                if isinstance(lvalue, ColSpec):
-                    lvalue_str = f"{lvalue.table}.{lvalue.column}"
-                elif isinstance(lvalue, str):
-                    lvalue_str = f'"{lvalue}"''
-                else:
-                    lvalue_str = str(lvalue)
-                if isinstance(rvalue, ColSpec):
-                    rvalue_str = f"{rvalue.table}.{rvalue.column}"
-                elif isinstance(rvalue, str):
-                    rvalue_str = f'"{rvalue}"''
-                else:
-                    rvalue_str = str(rvalue)
-                     
-            result += f"({lvalue_str} == {rvalue_str})"
-        return result
+        return write_to_string(self)
+
+
+class ClosureNode(TreeNode):
+    """The transitive closure of the relation in table (a TableNode) with the given
+       domain and codomain columns, written to the table name: every pair that is
+       connected by at most max_depth (None: any number of) steps."""
+
+    def __init__(self, table, name, domain_column, codomain_column, max_depth = None, is_recursive = True):
+        super().__init__(table)
+        self.name = name
+        self.domain_column = domain_column
+        self.codomain_column = codomain_column
+        self.max_depth = max_depth
+        self.is_recursive = is_recursive
+
+    def write(self, out):
+        """Writes the closure as a single WITH RECURSIVE query. UNION removes the pairs
+           that were found before, so the recursion also ends on cyclic relations; with a
+           depth bound the depth is a column, and ends it instead."""
+
+        table = self.get_child(0)
+        depth_column = ", depth" if self.max_depth is not None else ""
+        out.write(f"WITH RECURSIVE closure(domain, codomain{depth_column}) AS (SELECT ")
+        write_colspec(ColSpec(table.tablealias, self.domain_column), out)
+        out.write(", ")
+        write_colspec(ColSpec(table.tablealias, self.codomain_column), out)
+        if self.max_depth is not None:
+            out.write(", 1")
+        out.write(" FROM ")
+        table.write(out)
+        out.write(" UNION SELECT ")
+        write_colspec(ColSpec(table.tablealias, self.domain_column), out)
+        out.write(", X0.codomain")
+        if self.max_depth is not None:
+            out.write(", X0.depth + 1")
+        out.write(" FROM closure AS X0 JOIN ")
+        table.write(out)
+        out.write(" WHERE (X0.domain == ")
+        write_colspec(ColSpec(table.tablealias, self.codomain_column), out)
+        out.write(")")
+        if self.max_depth is not None:
+            out.write(f" AND (X0.depth < {self.max_depth})")
+        out.write(f") SELECT DISTINCT domain, codomain INTO {self.name} FROM closure")
+
+    def gen_loop_statements(self):
+        """The closure as semi-naive iteration, for engines without recursive queries:
+           name starts as the relation, and every run of the Loop joins only the pairs
+           found in the previous run (name_delta) with the relation again, and adds the
+           new ones to name."""
+
+        table = self.get_child(0)
+        source = f"{table.tablealias}.{self.domain_column} AS domain, {table.tablealias}.{self.codomain_column} AS codomain"
+        delta = f"{self.name}_delta"
+        new = f"{self.name}_new"
+        statements = [
+            f"SELECT DISTINCT {source} INTO {self.name} FROM {write_to_string(table)}",
+            f"SELECT domain, codomain INTO {delta} FROM {self.name}"
+        ]
+        step = [
+            f"SELECT DISTINCT {table.tablealias}.{self.domain_column} AS domain, X0.codomain AS codomain INTO {new} FROM {delta} AS X0 JOIN {write_to_string(table)}"
+            f" WHERE (X0.domain == {table.tablealias}.{self.codomain_column})"
+            f" AND NOT EXISTS (SELECT * FROM {self.name} AS X2 WHERE (X2.domain == {table.tablealias}.{self.domain_column}) AND (X2.codomain == X0.codomain))",
+            f"INSERT INTO {self.name} SELECT domain, codomain FROM {new}",
+            f"DROP TABLE {delta}",
+            f"SELECT domain, codomain INTO {delta} FROM {new}",
+            f"DROP TABLE {new}"
+        ]
+        max_iterations = self.max_depth - 1 if self.max_depth is not None else None
+        statements.append(Loop(self.name, step, delta, max_iterations))
+        return statements
+
+    def __str__(self):
+        return write_to_string(self)
+
+
+class IntersectionNode(TreeNode):
+    """The pairs that are in all the relations in tables (TableNodes), written to the
+       table name; columns holds the (domain column, codomain column) of every table"""
+
+    def __init__(self, tables, name, columns):
+        super().__init__(tables)
+        self.name = name
+        self.columns = columns
+
+    def write(self, out):
+        for n, (table, (domain_column, codomain_column)) in enumerate(zip(self.children, self.columns)):
+            if n > 0:
+                out.write(" INTERSECT ")
+            out.write("SELECT ")
+            write_colspec(ColSpec(table.tablealias, domain_column), out)
+            out.write(" AS domain, ")
+            write_colspec(ColSpec(table.tablealias, codomain_column), out)
+            out.write(" AS codomain")
+            if n == 0:
+                out.write(f" INTO {self.name}")
+            out.write(" FROM ")
+            table.write(out)
+
+    def __str__(self):
+        return write_to_string(self)
+
+
+def write_value(value, out):
+    """Writes one side of a condition: a column, a string constant or another constant"""
 
+    if isinstance(value, ColSpec):
+        write_colspec(value, out)
+    elif isinstance(value, str):
+        out.write(f'"{value}"')
+    else:
+        out.write(str(value))
+
+
+sql_operators = {
+    NodeType.OR: " OR ",
+    NodeType.AND: " AND ",
+    NodeType.EQUALS: " = ",
+    NodeType.NOT_EQUAL: " <> ",
+    NodeType.SMALLER: " < ",
+    NodeType.BIGGER: " > ",
+    NodeType.SMALLER_EQUAL: " <= ",
+    NodeType.BIGGER_EQUAL: " >= "
+}
+
+def write_conditional(expr, out):
+    """Writes a condition parse tree to out, with an explicit stack instead of recursion"""
+
+    stack = [ expr ]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.write(item)
+        elif item.data == NodeType.CONSTANT:
+            out.write("(" + item.get_value() + ")")
+        elif item.data == NodeType.COLSPEC:
+            out.write("(" + item.get_child(0).get_value() + "." + item.get_child(1).get_value() + ")")
+        elif item.data == NodeType.NOT:
+            out.write("(NOT ")
+            stack.extend([ ")", item.get_children()[0] ])
+        else:
+            out.write("(")
+            children = item.get_children()
+            stack.extend([ ")", children[1], sql_operators[item.data], children[0] ])
 
 def gen_conditional(expr):
-    
-    if expr.data == NodeType.CONSTANT:
-        return "(" + expr.get_value() + ")"
-    elif expr.data == NodeType.COLSPEC:
-        return "(" + expr.get_child(0).get_value() + "." + expr.get_child(1).get_value() + ")"
-    elif expr.data == NodeType.NOT:
-        return "(NOT " + gen_conditional(expr.get_children()[0]) + ")"
-    elif expr.data == NodeType.OR:
-        operator = " OR "
-    elif expr.data == NodeType.AND:
-        operator = " AND "
-    elif expr.data == NodeType.EQUALS:
-        operator = " = "
-    elif expr.data == NodeType.NOT_EQUAL:
-        operator = " <> "
-    elif expr.data == NodeType.SMALLER:
-        operator = " < "
-    elif expr.data == NodeType.BIGGER:
-        operator = " > "
-    elif expr.data == NodeType.SMALLER_EQUAL:
-        operator = " <= "
-    elif expr.data == NodeType.BIGGER_EQUAL:
-        operator = " >= "
-    
-    return "(" + gen_conditional(expr.get_children()[0]) + operator + gen_conditional(expr.get_children()[1]) + ")"
+
+    out = io.StringIO()
+    write_conditional(expr, out)
+    return out.getvalue()
 
 def get_colspec_name(colspec_node):
     table_name = colspec_node.get_child(0).get_value()
@@ -419,45 +960,207 @@ def get_colspec_name(colspec_node):
 #     return "SELECT " + columns_clause + into_clause + from_clause + where_clause
 
 
-def gen_select_stmt(expr):
+def write_select_stmt(expr, out):
+    """Writes the SELECT statement of a plan to out, a text stream such as a file or
+       io.StringIO, without building the statement in memory"""
 
+    if isinstance(expr, (ClosureNode, IntersectionNode)):
+        expr.write(out)
+        return
+    into_node = None
     if isinstance(expr, AssignNode):
-        into_stmt = " INTO " + str(expr)
+        into_node = expr
         expr = expr.get_child(0)
-    else:
-        into_stmt = ""
+    columns_node = None
     if isinstance(expr, RenameNode):
-        columns_stmt = str(expr)
+        columns_node = expr
         expr = expr.get_child(0).get_child(0)
     elif isinstance(expr, ProjectionNode):
-        columns_stmt = str(expr)
+        columns_node = expr
         expr = expr.get_child(0)
-    if isinstance(expr, TableNode):
-        from_stmt = " FROM " + str(expr)
-    if columns_stmt == "" and from_stmt == "":
+    where_node = None
+    if isinstance(expr, ConditionalNode):
+        if expr.has_conditions():
+            where_node = expr
+        expr = expr.get_child(0)
+    from_node = None
+    if isinstance(expr, (TableNode, JoinNode)):
+        from_node = expr
+    if columns_node is None and from_node is None:
         raise SyntaxError
-    
-    return "SELECT " + columns_stmt + into_stmt + from_stmt
-    
+
+    out.write("SELECT ")
+    if columns_node is not None:
+        columns_node.write(out)
+    if into_node is not None:
+        out.write(" INTO ")
+        into_node.write(out)
+    if from_node is not None:
+        out.write(" FROM ")
+        from_node.write(out)
+    if where_node is not None:
+        out.write(" WHERE ")
+        where_node.write(out)
+
+def gen_select_stmt(expr):
+
+    out = io.StringIO()
+    write_select_stmt(expr, out)
+    return out.getvalue()
+
+
+# last_uses: table -> index of the last plan that reads it, drops: for every plan the
+# tables that can be dropped after it, peak: the largest number of tables that exist at
+# the same time when they are dropped that way
+Liveness = namedtuple("Liveness", ["last_uses", "drops", "peak"])
+
+
+def analyze_liveness(plans):
+    """Finds the last use of the table every plan writes. The table of the last plan
+       holds the result, and is never dropped; a table that is never read is dropped
+       right after it is written."""
+
+    produced = { plan.name for plan in plans }
+    last_uses = {}
+    for n, plan in enumerate(plans):
+        for node in plan.DepthFirst():
+            if isinstance(node, TableNode) and node.tablename in produced:
+                last_uses[node.tablename] = n
+    drops = [ [] for plan in plans ]
+    for n, plan in enumerate(plans[:-1]):
+        drops[max(last_uses.get(plan.name, n), n)].append(plan.name)
+
+    n_live = 0
+    peak = 0
+    for n in range(len(plans)):
+        n_live += 1   # The inputs of a plan still exist while it writes its table
+        peak = max(peak, n_live)
+        n_live -= len(drops[n])
+    return Liveness(last_uses, drops, peak)
+
+
+def reuse_tables(plans, drops):
+    """Renames the tables of plans so that a plan writes to the name of a table that was
+       dropped before it, if there is one, instead of a new name. Changes the plans, and
+       returns the drops with the new names."""
+
+    free_names = []
+    renames = {}
+    renamed_drops = []
+    for n, plan in enumerate(plans):
+        for node in plan.DepthFirst():
+            if isinstance(node, TableNode) and node.tablename in renames:
+                node.tablename = renames[node.tablename]
+        if free_names:
+            renames[plan.name] = free_names.pop()
+            plan.name = renames[plan.name]
+        renamed_drops.append([ renames.get(table, table) for table in drops[n] ])
+        free_names.extend(reversed(renamed_drops[-1]))
+    return renamed_drops
+
+
+def gen_statements(plans, is_dropped = False, is_reused = False):
+    """The statements of plans: a SELECT for every plan, except for the closures that
+       are computed by a Loop. With is_dropped every temporary table except the result is
+       dropped right after its last use, so the DROP TABLE statements of the inputs of
+       the last plan follow the statement that writes the result; with is_reused as
+       well, and a table gets the name of a table that was dropped before (see
+       reuse_tables). The peak number of tables that exist at the same time is recorded
+       as the metric peak_temp_tables."""
+
+    is_dropped = is_dropped or is_reused
+    drops = [ [] for plan in plans ]
+    if is_dropped:
+        liveness = analyze_liveness(plans)
+        drops = liveness.drops
+        if profiling.n_active:
+            profiling.maximum("peak_temp_tables", liveness.peak)
+        if is_reused:
+            drops = reuse_tables(plans, drops)
+    elif profiling.n_active:
+        profiling.maximum("peak_temp_tables", len(plans))
+
+    statements = []
+    for plan, plan_drops in zip(plans, drops):
+        if isinstance(plan, ClosureNode) and not plan.is_recursive:
+            statements.extend(plan.gen_loop_statements())
+            if is_dropped:
+                statements.append(f"DROP TABLE {plan.name}_delta")
+        else:
+            statements.append(gen_select_stmt(plan))
+        statements.extend(f"DROP TABLE {table}" for table in plan_drops)
+    return statements
+
+
+# def make_comp_expr(output_table, input_tables):
+
+#     table1_expr = ParseTreeNode(NodeType.TEMP_TABLE, [ParseTreeNode(input_tables[0])])
+#     table2_expr = ParseTreeNode(NodeType.TEMP_TABLE, [ParseTreeNode(input_tables[1])])
+#     ren1_expr = ParseTreeNode(NodeType.RENAME_TABLE, [table1_expr, ParseTreeNode("X")])
+#     ren2_expr = ParseTreeNode(NodeType.RENAME_TABLE, [table2_expr, ParseTreeNode("Y")])
+#     join_expr = ParseTreeNode(NodeType.INPUT2, [ren1_expr, ren2_expr])
+#     colspec1_expr = ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("X"), ParseTreeNode("domain")])
+#     colspec2_expr = ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("Y"), ParseTreeNode("codomain")])
+#     eq_expr = ParseTreeNode(NodeType.EQUALS, [colspec1_expr, colspec2_expr])
+#     cond_expr = ParseTreeNode(NodeType.CONDITION, [join_expr, eq_expr])
+#     colspeclist_expr = ParseTreeNode(NodeType.COLSPECLIST, [
+#         ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("Y"), ParseTreeNode("domain")]),
+#         ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("X"), ParseTreeNode("codomain")])
+#     ])
+#     proj_expr = ParseTreeNode(NodeType.PROJECTION, [cond_expr, colspeclist_expr])
+#     assign_expr = ParseTreeNode(NodeType.ASSIGN, [proj_expr, ParseTreeNode(output_table)])
+#     return assign_expr
+
+
+def simplify_plans(plans):
+    """Simplifies the conditions of plans (see ConditionalNode.simplify) and returns
+       True if the result of the last plan is known to be empty: because a condition never
+       holds, or because the plan reads a table that is empty for that reason. Such plans
+       need not be run."""
+
+    empty_tables = set()
+    for plan in plans:
+        is_empty = False
+        for node in plan.DepthFirst():
+            if isinstance(node, ConditionalNode) and not node.simplify():
+                is_empty = True
+            elif isinstance(node, TableNode) and node.tablename in empty_tables:
+                is_empty = True   # Every plan joins its tables, so one empty table is enough
+        if is_empty and isinstance(plan, (AssignNode, ClosureNode, IntersectionNode)):
+            empty_tables.add(plan.name)
+    return bool(plans) and is_empty
+
+
+def make_chain_expr(output_table, inputs):
+    """Composes the relations in inputs in a single SELECT. Each input is a tuple
+       (table name, domain column, codomain column). Composition applies the last input
+       first, so every input's domain is joined with the codomain of the next one."""
+
+    aliases = [ f"X{n}" for n in range(len(inputs)) ]
+    tables = [ TableNode(table_name, alias) for (table_name, _, _), alias in zip(inputs, aliases) ]
+    if len(tables) == 1:
+        source = tables[0]
+    else:
+        source = JoinNode(tables)
+    condition = ConditionalNode(source)
+    condition.add_conditions(
+        [ ColSpec(aliases[n], inputs[n][1]) for n in range(len(inputs) - 1) ],
+        [ ColSpec(aliases[n + 1], inputs[n + 1][2]) for n in range(len(inputs) - 1) ]
+    )
+    projection = ProjectionNode(condition)
+    projection.add_columns(aliases[-1], [inputs[-1][1]])
+    projection.add_columns(aliases[0], [inputs[0][2]])
+    rename = RenameNode(projection)
+    rename.add_columns(aliases[-1], [inputs[-1][1]], ["domain"])
+    rename.add_columns(aliases[0], [inputs[0][2]], ["codomain"])
+    assign = AssignNode(rename, output_table)
+
+    return assign
+
 
 def make_comp_expr(output_table, input_tables):
 
-    table1_expr = ParseTreeNode(NodeType.TEMP_TABLE, [ParseTreeNode(input_tables[0])])
-    table2_expr = ParseTreeNode(NodeType.TEMP_TABLE, [ParseTreeNode(input_tables[1])])
-    ren1_expr = ParseTreeNode(NodeType.RENAME_TABLE, [table1_expr, ParseTreeNode("X")])
-    ren2_expr = ParseTreeNode(NodeType.RENAME_TABLE, [table2_expr, ParseTreeNode("Y")])
-    join_expr = ParseTreeNode(NodeType.INPUT2, [ren1_expr, ren2_expr])
-    colspec1_expr = ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("X"), ParseTreeNode("domain")])
-    colspec2_expr = ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("Y"), ParseTreeNode("codomain")])
-    eq_expr = ParseTreeNode(NodeType.EQUALS, [colspec1_expr, colspec2_expr])
-    cond_expr = ParseTreeNode(NodeType.CONDITION, [join_expr, eq_expr])
-    colspeclist_expr = ParseTreeNode(NodeType.COLSPECLIST, [
-        ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("Y"), ParseTreeNode("domain")]),
-        ParseTreeNode(NodeType.COLSPEC, [ParseTreeNode("X"), ParseTreeNode("codomain")])
-    ])
-    proj_expr = ParseTreeNode(NodeType.PROJECTION, [cond_expr, colspeclist_expr])
-    assign_expr = ParseTreeNode(NodeType.ASSIGN, [proj_expr, ParseTreeNode(output_table)])
-    return assign_expr
+    return make_chain_expr(output_table, [ (table_name, "domain", "codomain") for table_name in input_tables ])
 
 
 # def make_select_expr(columns, columns_alias, result_name, table_name, table_alias):
@@ -475,6 +1178,20 @@ def make_comp_expr(output_table, input_tables):
 #     return assign_expr
 
 
+def make_closure_expr(output_table, input, max_depth = None, is_recursive = True):
+    """The closure of input, a tuple (table name, domain column, codomain column)"""
+
+    (table_name, domain_column, codomain_column) = input
+    return ClosureNode(TableNode(table_name, "X1"), output_table, domain_column, codomain_column, max_depth, is_recursive)
+
+
+def make_intersection_expr(output_table, inputs):
+    """The intersection of inputs, tuples (table name, domain column, codomain column)"""
+
+    tables = [ TableNode(table_name, f"X{n}") for n, (table_name, _, _) in enumerate(inputs) ]
+    return IntersectionNode(tables, output_table, [ (domain_column, codomain_column) for (_, domain_column, codomain_column) in inputs ])
+
+
 def make_select_expr(columns, column_aliases, result_name, table_name, table_alias):
 
     table = TableNode(table_name, table_alias)
@@ -493,13 +1210,19 @@ def test_InterParseTree():
     t3 = InterParseTree("o(woont_op)")
     t4 = InterParseTree("o(onderdeel_van,ligt_in,woont_op)")
     t5 = InterParseTree("o(i(onderdeel_van,ligt_in),woont_op)")
+    for expression in [ "ik(woont_op,ligt_in)", "aciko(woont_op)" ]:
+        try:
+            InterParseTree(expression)
+        except SyntaxError as e:
+            print(e) # unknown operator: only single letters are operators
     t6 = InterParseTree("l(aa,bb)") # Syntax Error: operator l() unknown
     print(t1)
 
 
 def test_BFS():
     t5 = InterParseTree("o(ligt_in,woont_op)")
-    t5.generate_ralg_expr()
+    for statement in t5.generate_ralg_expr():
+        print(statement)
 
 
 def test_rename_node():
@@ -541,8 +1264,108 @@ def test_projection_node():
 def test_generate_ralg_expr():
 
     t = InterParseTree("woont_op")
-    t.generate_ralg_expr()
+    for statement in t.generate_ralg_expr():
+        print(statement)
+
+
+def test_reorder_compositions():
+
+    t = InterParseTree("o(onderdeel_van,ligt_in,woont_op)").reorder_compositions()
+    for statement in t.generate_ralg_expr():
+        print(statement) # onderdeel_van and ligt_in are composed first
+
+
+def test_generate_fused_expr():
 
+    t = InterParseTree("o(o(onderdeel_van,ligt_in),woont_op)")
+    for statement in t.generate_ralg_expr(is_fused = True):
+        print(statement) # Should be a single SELECT joining the three tables
+    t = InterParseTree("o(o(ligt_in,woont_op),o(ligt_in,woont_op))")
+    for statement in t.generate_ralg_expr(is_fused = True):
+        print(statement) # o(ligt_in,woont_op) is written to T0 once, and joined with itself in T1
 
-test_generate_ralg_expr()
 
+def test_liveness():
+
+    plans = InterParseTree("o(onderdeel_van,o(ligt_in,woont_op))").generate_plans()
+    liveness = analyze_liveness(plans)
+    print(len(plans), liveness.peak) # 5 tables, at most 4 at the same time
+    for statement in gen_statements(plans, is_reused = True):
+        print(statement) # Every table is dropped after its last use; the last plan writes T3 again, then T1 and T6 are dropped
+
+
+def test_closure():
+
+    for expression in [ "c(onderdeel_van)", "o(c(ligt_in,3),woont_op)" ]:
+        for statement in InterParseTree(expression).generate_ralg_expr():
+            print(statement) # The closure is a single WITH RECURSIVE query
+    for statement in InterParseTree("c(o(ligt_in,ligt_in),2)").generate_ralg_expr(is_fused = True, is_recursive = False):
+        print(statement) # The closure is a Loop
+    for expression in [ "o(ligt_in,3)", "c(ligt_in,woont_op)", "c(ligt_in,o(ligt_in,woont_op))" ]:
+        try:
+            InterParseTree(expression)
+        except SyntaxError as e:
+            print(e) # a number can only be the depth of a closure, then twice: the depth of a closure must be a number
+
+
+def test_intersection():
+
+    for statement in InterParseTree("o(i(onderdeel_van,ligt_in),woont_op)").generate_ralg_expr():
+        print(statement) # The intersection reads the tables of both arguments
+    for statement in InterParseTree("o(i(onderdeel_van,ligt_in),woont_op)").generate_ralg_expr(is_fused = True):
+        print(statement) # Should be an INTERSECT of the two base tables, joined with tbl_persoon
+
+
+def test_canonicalize():
+
+    for expression in [ "i(woont_op,ligt_in)", "i(ligt_in,woont_op)", "o(o(onderdeel_van,ligt_in),woont_op)", "o(onderdeel_van,o(ligt_in,woont_op))" ]:
+        (tree, fingerprint) = canonicalize(InterParseTree(expression).root)
+        print(format_expression(tree), fingerprint) # The first two and the last two are equal
+    print(get_fingerprint(InterParseTree("o(ligt_in,woont_op)").root) == get_fingerprint(InterParseTree("o(woont_op,ligt_in)").root)) # Should be False
+
+
+def test_conditional_node():
+
+    c = ConditionalNode()
+    c.add_conditions([ ColSpec("A", "domain"), ColSpec("B", "codomain") ], [ ColSpec("B", "codomain"), ColSpec("C", "domain") ])
+    d = ConditionalNode()
+    d.add_conditions([ ColSpec("C", "domain"), ColSpec("B", "codomain") ], [ ColSpec("B", "codomain"), ColSpec("A", "domain") ])
+    c.combine(d)
+    print(c) # The second condition of d is the first one of c, swapped
+    print(c.get_equivalence_classes()) # A.domain, B.codomain and C.domain are equal
+
+    r = RenameNode()
+    r.add_columns("A", ["id"], ["domain"])
+    c.combine(r)
+    print(c.get_conditions(ColSpec("A", "id")))
+
+    n = 100000
+    c = ConditionalNode()
+    c.add_conditions([ ColSpec("A", f"c{i}") for i in range(n) ], [ ColSpec("B", f"c{i}") for i in range(n) ])
+    r = RenameNode()
+    r.add_columns("A", [ f"d{i}" for i in range(n) ], [ f"c{i}" for i in range(n) ])
+    start = time.perf_counter()
+    c.combine(r)
+    c.combine(c)
+    print(len(c.conditions), f"{time.perf_counter() - start:.3f}s") # 100000 conditions, in linear time
+
+
+def test_simplify_plans():
+
+    condition = ConditionalNode(TableNode("tbl_persoon", "X0"))
+    condition.add_conditions([ ColSpec("X0", "adres_id"), ColSpec("X0", "persoons_id"), "a" ], [ ColSpec("X0", "persoons_id"), ColSpec("X0", "adres_id"), "a" ])
+    print(condition.simplify(), condition) # Should be 'True (X0.adres_id == X0.persoons_id)'
+
+    plans = InterParseTree("o(ligt_in,woont_op)").generate_plans()
+    print(simplify_plans(plans)) # Should be False
+    projection = plans[0].get_child(0).get_child(0)
+    table = projection.get_child(0)
+    condition = ConditionalNode(table)
+    condition.add_conditions([ ColSpec(table.tablealias, "gemeente_id"), ColSpec(table.tablealias, "adres_id") ], [ "1", ColSpec(table.tablealias, "gemeente_id") ])
+    condition.add_condition("2", ColSpec(table.tablealias, "adres_id"))
+    projection.children[0] = condition
+    print(simplify_plans(plans)) # Should be True: T1 is empty, and so is the composition that reads it
+    print(gen_select_stmt(plans[0]))
+
+if __name__ == "__main__":
+    test_generate_ralg_expr()